@@ -18,6 +18,8 @@ const Chat = () => {
     const [isLoading, setIsLoading] = useState(true);
     const [users, setUsers] = useState([]);
     const [selectedUsers, setSelectedUsers] = useState([]);
+    const [userQuery, setUserQuery] = useState('');
+    const [usersCursor, setUsersCursor] = useState(null);
     const [isConnected, setIsConnected] = useState(false);
     
     const userId = getCookie('user_id');
@@ -52,9 +54,10 @@ const Chat = () => {
         }
     }, [messages, isLoading, currentChatId]);
 
-    // Función para obtener nombre de usuario
-    const getUserName = useCallback((userId) => {
-        const user = users.find(u => String(u.id || u.user_id) === String(userId));
+    // Función para obtener nombre de usuario (los mensajes ya traen su remitente;
+    // el directorio solo tiene las páginas cargadas en el selector)
+    const getUserName = useCallback((userId, sender = null) => {
+        const user = sender || users.find(u => String(u.id || u.user_id) === String(userId));
         return user ? `${user.first_name} ${user.last_name}` : `Usuario ${userId}`;
     }, [users]);
 
@@ -129,6 +132,12 @@ const Chat = () => {
                     return;
                 }
 
+                // Otros frames de control (subscribed, error, presence...) no son mensajes
+                if (messageData.type) {
+                    console.log('Frame de control recibido:', messageData.type);
+                    return;
+                }
+
                 // AGREGAR MENSAJE SIEMPRE si es para el chat actual
                 if (currentChatIdRef.current && String(messageData.chat_id) === String(currentChatIdRef.current)) {
                     console.log('✅ Agregando mensaje para chat actual:', messageData);
@@ -183,40 +192,11 @@ const Chat = () => {
         };
     }, [userId, loadChats]);
 
-    // Inicializar WebSocket y cargar usuarios
+    // Inicializar WebSocket
     useEffect(() => {
         if (!userId) return;
         
         isManualDisconnectRef.current = false;
-        
-        const fetchUsers = async () => {
-            try {
-                console.log('Cargando usuarios...');
-                const res = await fetch('https://users-service-production-6ca2.up.railway.app/users');
-                if (res.ok) {
-                    const data = await res.json();
-                    console.log('Users API response:', data);
-                    
-                    if (Array.isArray(data)) {
-                        setUsers(data);
-                    } else if (data.users && Array.isArray(data.users)) {
-                        setUsers(data.users);
-                    } else if (data.data && Array.isArray(data.data)) {
-                        setUsers(data.data);
-                    } else {
-                        console.error('Unexpected users API response format:', data);
-                        setUsers([]);
-                    }
-                } else {
-                    console.error('Failed to fetch users:', res.status);
-                    setUsers([]);
-                }
-            } catch (err) {
-                console.error("Error loading users:", err);
-                setUsers([]);
-            }
-        };
-        fetchUsers();
 
         connectWebSocket();
 
@@ -231,6 +211,38 @@ const Chat = () => {
         };
     }, [userId, connectWebSocket]);
 
+    // Suscribirse a los chats cargados (el servidor solo acepta aquellos a los que
+    // el usuario pertenece y ya suscribe los existentes al conectar)
+    useEffect(() => {
+        const socket = socketRef.current;
+        if (isConnected && socket && socket.readyState === WebSocket.OPEN && chats.length > 0) {
+            socket.send(JSON.stringify({ type: 'subscribe', chat_ids: chats.map(chat => chat.chat_id) }));
+        }
+    }, [chats, isConnected]);
+
+    // Directorio de usuarios paginado: búsqueda por prefijo y "cargar más" con el cursor
+    const fetchUsers = useCallback(async (query, cursor = null) => {
+        try {
+            const params = new URLSearchParams({ q: query, limit: '20' });
+            if (cursor) params.set('cursor', cursor);
+            const res = await fetch(`https://users-service-production-6ca2.up.railway.app/users?${params}`);
+            if (res.ok) {
+                const data = await res.json();
+                setUsers(prev => cursor ? [...prev, ...data.users] : data.users);
+                setUsersCursor(data.next_cursor);
+            }
+        } catch (err) {
+            console.error("Error loading users:", err);
+        }
+    }, []);
+
+    // Recargar el directorio al abrir el modal o al cambiar la búsqueda
+    useEffect(() => {
+        if (!isModalOpen) return;
+        const timeout = setTimeout(() => fetchUsers(userQuery.trim()), 300);
+        return () => clearTimeout(timeout);
+    }, [isModalOpen, userQuery, fetchUsers]);
+
     const selectChat = async (chat) => {
         console.log('🔄 Cambiando a chat:', chat.chat_id);
         setCurrentChatId(chat.chat_id);
@@ -348,6 +360,7 @@ const Chat = () => {
     const closeCreateChatModal = () => {
         setIsModalOpen(false);
         setSelectedUsers([]);
+        setUserQuery('');
     };
 
     const toggleUserSelection = (userId) => {
@@ -385,7 +398,8 @@ const Chat = () => {
             } else {
                 closeCreateChatModal();
                 loadChats();
-                alert("¡Chat creado exitosamente!");
+                // Con un solo participante el servicio devuelve el chat directo existente (created: false)
+                alert(result.created === false ? "Ya tienes un chat con este usuario" : "¡Chat creado exitosamente!");
             }
         } catch (err) {
             console.error("❌ Error creating chat:", err);
@@ -459,8 +473,8 @@ const Chat = () => {
     }, [userId, loadChats]);
 
     // Obtener inicial del nombre del remitente
-    const getInitial = (userId) => {
-        const name = getUserName(userId);
+    const getInitial = (userId, sender = null) => {
+        const name = getUserName(userId, sender);
         return name.charAt(0).toUpperCase();
     };
 
@@ -583,9 +597,9 @@ const Chat = () => {
                                             {!isOwnMessage && (
                                                 <div 
                                                     className={styles.messageAvatar}
-                                                    title={getUserName(msg.sender_id)}
+                                                    title={getUserName(msg.sender_id, msg.sender)}
                                                 >
-                                                    {getInitial(msg.sender_id)}
+                                                    {getInitial(msg.sender_id, msg.sender)}
                                                 </div>
                                             )}
                                             <div className={styles.bubble}>{msg.content}</div>
@@ -679,6 +693,12 @@ const Chat = () => {
                         </div>
                         <div className={styles.formGroup}>
                             <label>Seleccionar participantes:</label>
+                            <input 
+                                type="text" 
+                                placeholder="Buscar por nombre o usuario" 
+                                value={userQuery}
+                                onChange={(e) => setUserQuery(e.target.value)}
+                            />
                             <div className={styles.userList}>
                                 {Array.isArray(users) && users.length > 0 ? (
                                     users
@@ -708,6 +728,14 @@ const Chat = () => {
                                     </div>
                                 )}
                             </div>
+                            {usersCursor && (
+                                <button 
+                                    className={styles.createFirstChatBtn}
+                                    onClick={() => fetchUsers(userQuery.trim(), usersCursor)}
+                                >
+                                    Cargar más
+                                </button>
+                            )}
                         </div>
                         <button 
                             className={styles.createChatModalBtn}
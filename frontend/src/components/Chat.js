@@ -18,6 +18,8 @@ const Chat = () => {
     const [isLoading, setIsLoading] = useState(true);
     const [users, setUsers] = useState([]);
     const [selectedUsers, setSelectedUsers] = useState([]);
+    const [userQuery, setUserQuery] = useState('');
+    const [usersCursor, setUsersCursor] = useState(null);
     const userId = getCookie('user_id');
     const socketRef = useRef(null);
     const chatMessagesRef = useRef(null);
@@ -43,23 +45,9 @@ const Chat = () => {
         }
     }, [messages]);
 
-    // Inicializar WebSocket y cargar usuarios
+    // Inicializar WebSocket
     useEffect(() => {
         if (!userId) return;
-        
-        // Cargar lista de usuarios
-        const fetchUsers = async () => {
-            try {
-                const res = await fetch('http://localhost:5005/users');
-                if (res.ok) {
-                    const data = await res.json();
-                    setUsers(data);
-                }
-            } catch (err) {
-                console.error("Error loading users:", err);
-            }
-        };
-        fetchUsers();
 
         // Configurar WebSocket
         socketRef.current = new WebSocket(`ws://localhost:5004/ws?user_id=${userId}`);
@@ -70,6 +58,15 @@ const Chat = () => {
         
         socketRef.current.onmessage = (event) => {
             const messageData = JSON.parse(event.data);
+
+            // Responder a los heartbeats del servidor para no ser desconectado
+            if (messageData.type === 'ping') {
+                socketRef.current.send(JSON.stringify({ type: 'pong' }));
+                return;
+            }
+
+            // Otros frames de control (subscribed, error, presence...) no son mensajes
+            if (messageData.type) return;
             
             // Si el mensaje es para el chat actual
             if (String(messageData.chat_id) === String(currentChatId)) {
@@ -99,6 +96,29 @@ const Chat = () => {
         };
     }, [userId, currentChatId]);
 
+    // Directorio de usuarios paginado: búsqueda por prefijo y "cargar más" con el cursor
+    const fetchUsers = useCallback(async (query, cursor = null) => {
+        try {
+            const params = new URLSearchParams({ q: query, limit: '20' });
+            if (cursor) params.set('cursor', cursor);
+            const res = await fetch(`http://localhost:5005/users?${params}`);
+            if (res.ok) {
+                const data = await res.json();
+                setUsers(prev => cursor ? [...prev, ...data.users] : data.users);
+                setUsersCursor(data.next_cursor);
+            }
+        } catch (err) {
+            console.error("Error loading users:", err);
+        }
+    }, []);
+
+    // Recargar el directorio al abrir el modal o al cambiar la búsqueda
+    useEffect(() => {
+        if (!isModalOpen) return;
+        const timeout = setTimeout(() => fetchUsers(userQuery.trim()), 300);
+        return () => clearTimeout(timeout);
+    }, [isModalOpen, userQuery, fetchUsers]);
+
     const loadChats = useCallback(async () => {
         try {
             setIsLoading(true);
@@ -113,6 +133,15 @@ const Chat = () => {
         }
     }, [userId]);
 
+    // Suscribirse a los chats cargados (el servidor solo acepta aquellos a los que
+    // el usuario pertenece y ya suscribe los existentes al conectar)
+    useEffect(() => {
+        const socket = socketRef.current;
+        if (socket && socket.readyState === WebSocket.OPEN && Array.isArray(chats) && chats.length > 0) {
+            socket.send(JSON.stringify({ type: 'subscribe', chat_ids: chats.map(chat => chat.chat_id) }));
+        }
+    }, [chats]);
+
     const selectChat = async (chat) => {
         setCurrentChatId(chat.chat_id);
         try {
@@ -170,6 +199,7 @@ const Chat = () => {
     const closeCreateChatModal = () => {
         setIsModalOpen(false);
         setSelectedUsers([]);
+        setUserQuery('');
     };
 
     const toggleUserSelection = (userId) => {
@@ -204,7 +234,8 @@ const Chat = () => {
             } else {
                 closeCreateChatModal();
                 loadChats();
-                alert("¡Chat creado exitosamente!");
+                // Con un solo participante el servicio devuelve el chat directo existente (created: false)
+                alert(result.created === false ? "Ya tienes un chat con este usuario" : "¡Chat creado exitosamente!");
             }
         } catch (err) {
             console.error("Error creating chat:", err);
@@ -372,12 +403,18 @@ const Chat = () => {
                         </div>
                         <div className={styles.formGroup}>
                             <label>Seleccionar participantes:</label>
+                            <input 
+                                type="text" 
+                                placeholder="Buscar por nombre o usuario" 
+                                value={userQuery}
+                                onChange={(e) => setUserQuery(e.target.value)}
+                            />
                             <div className={styles.userList}>
-                                {users.filter(user => user.user_id !== userId).map(user => (
+                                {users.filter(user => String(user.id) !== String(userId)).map(user => (
                                     <div 
-                                        key={user.user_id} 
-                                        className={`${styles.userItem} ${selectedUsers.includes(user.user_id) ? styles.selected : ''}`}
-                                        onClick={() => toggleUserSelection(user.user_id)}
+                                        key={user.id} 
+                                        className={`${styles.userItem} ${selectedUsers.includes(user.id) ? styles.selected : ''}`}
+                                        onClick={() => toggleUserSelection(user.id)}
                                     >
                                         <div className={styles.userAvatar}>
                                             {user.first_name.charAt(0)}
@@ -393,6 +430,14 @@ const Chat = () => {
                                     </div>
                                 ))}
                             </div>
+                            {usersCursor && (
+                                <button 
+                                    className={styles.createFirstChatBtn}
+                                    onClick={() => fetchUsers(userQuery.trim(), usersCursor)}
+                                >
+                                    Cargar más
+                                </button>
+                            )}
                         </div>
                         <button 
                             className={styles.createChatModalBtn}
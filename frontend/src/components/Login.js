@@ -23,7 +23,7 @@ const Login = () => {
       if (response.ok) {
         const userId = data.id || data.user_id;
         document.cookie = `user_id=${encodeURIComponent(userId)}; path=/; max-age=86400`;
-        document.cookie = "auth_token=valid; path=/; max-age=86400";
+        document.cookie = `auth_token=${encodeURIComponent(data.token)}; path=/; max-age=86400`;
         window.location.href = '/chat';
       } else {
         setError('Error al iniciar sesión: ' + (data.error || 'Desconocido'));
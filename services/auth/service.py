@@ -0,0 +1,241 @@
+from flask import Flask, request, jsonify
+from flask_cors import CORS
+import os
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from psycopg2 import pool
+import bcrypt
+from datetime import datetime
+import logging
+import multiprocessing
+from dotenv import load_dotenv
+
+from common.activity import ActivityBuffer
+from common.passwords import PasswordPool, PasswordPoolBusy, check_password_worker
+from common.tokens import create_token, verify_token
+
+load_dotenv()
+
+app = Flask(__name__)
+CORS(app)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_PORT = os.environ.get("DB_PORT", "5432")
+DB_USER = os.environ.get("DB_USER", "admin")
+DB_PASSWORD = os.environ.get("DB_PASSWORD")
+DB_NAME = os.environ.get("DB_NAME", "message-app-db")
+
+# Secreto compartido con los servicios que verifican los tokens y vigencia de cada token
+AUTH_SECRET = os.environ.get("AUTH_SECRET")
+AUTH_TOKEN_TTL_SECONDS = int(os.environ.get("AUTH_TOKEN_TTL_SECONDS", 86400))
+
+# Pool de procesos para bcrypt (common.passwords)
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", os.cpu_count() or 2))
+PASSWORD_QUEUE_SIZE = int(os.environ.get("PASSWORD_QUEUE_SIZE", PASSWORD_WORKERS * 4))
+
+# Los procesos del pool (forkserver) vuelven a importar este archivo para encontrar
+# las funciones de trabajo: en ellos no se abre la DB, no se toca el esquema ni se
+# arrancan hilos ni pools
+PASSWORD_WORKER_PROCESS = __name__ == '__mp_main__' or multiprocessing.parent_process() is not None
+
+# Última actividad (last_login) con escritura diferida: se acumula en memoria y
+# se vuelca con un solo UPDATE cada ACTIVITY_FLUSH_INTERVAL segundos
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", 5))
+ACTIVITY_MAX_PENDING = int(os.environ.get("ACTIVITY_MAX_PENDING", 10000))
+
+if not DB_PASSWORD:
+    raise ValueError("DB_PASSWORD debe estar configurada en las variables de entorno")
+
+if not AUTH_SECRET:
+    raise ValueError("AUTH_SECRET debe estar configurada en las variables de entorno")
+
+db_pool = None
+if not PASSWORD_WORKER_PROCESS:
+    try:
+        db_pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn=1,
+            maxconn=10,
+            host=DB_HOST,
+            port=DB_PORT,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            dbname=DB_NAME
+        )
+        logger.info("Pool de conexiones a DB creado correctamente")
+    except Exception as e:
+        logger.error(f"Error creando pool de conexiones: {e}")
+        raise
+
+def get_db_connection():
+    try:
+        return db_pool.getconn()
+    except Exception as e:
+        logger.error(f"Error obteniendo conexión del pool: {e}")
+        raise
+
+def return_db_connection(conn):
+    try:
+        db_pool.putconn(conn)
+    except Exception as e:
+        logger.error(f"Error devolviendo conexión al pool: {e}")
+
+activity_buffer = ActivityBuffer(db_pool, ACTIVITY_MAX_PENDING, ACTIVITY_FLUSH_INTERVAL)
+if not PASSWORD_WORKER_PROCESS:
+    activity_buffer.start()
+
+password_pool = None if PASSWORD_WORKER_PROCESS else PasswordPool(PASSWORD_WORKERS, PASSWORD_QUEUE_SIZE)
+
+# Hash de referencia para que un usuario inexistente tarde lo mismo que una
+# contraseña incorrecta y no se pueda distinguir por tiempo de respuesta
+DUMMY_PASSWORD_HASH = None if PASSWORD_WORKER_PROCESS else bcrypt.hashpw(
+    b"dummy-password", bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+).decode('utf-8')
+
+def verify_password(password, password_hash):
+    matches, elapsed_ms, waited_ms = password_pool.run(
+        check_password_worker, password, password_hash or DUMMY_PASSWORD_HASH
+    )
+    logger.info(f"Verificación bcrypt: {elapsed_ms:.1f} ms de cálculo, {waited_ms:.1f} ms en cola")
+    return matches and bool(password_hash)
+
+def get_user_by_username(username):
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT id, username, password_hash, first_name, last_name,
+                   email, is_active
+            FROM users
+            WHERE username = %s
+        """, (username,))
+        row = cur.fetchone()
+        cur.close()
+        return row
+    except Exception as e:
+        logger.error(f"Error en get_user_by_username: {e}")
+        raise
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+@app.route('/', methods=['GET'])
+def index():
+    return jsonify({
+        "message": "Auth API - Servicio de autenticación",
+        "version": "1.0.0",
+        "endpoints": [
+            "POST /login - Iniciar sesión y obtener token",
+            "GET /verify - Verificar token (Authorization: Bearer <token>)",
+            "GET /health - Health check"
+        ]
+    })
+
+@app.route('/login', methods=['POST'])
+def login():
+    try:
+        data = request.json or {}
+        username = str(data.get("username", "")).strip()
+        password = str(data.get("password", ""))
+
+        if not username or not password:
+            return jsonify({"error": "username y password son requeridos"}), 400
+
+        user = get_user_by_username(username)
+        # Se verifica siempre (con un hash de referencia si el usuario no existe)
+        if not verify_password(password, user["password_hash"] if user else None):
+            return jsonify({"error": "Usuario o contraseña incorrectos"}), 401
+
+        if not user["is_active"]:
+            return jsonify({"error": "Usuario inactivo"}), 403
+
+        token, claims = create_token(AUTH_SECRET, user["id"], AUTH_TOKEN_TTL_SECONDS)
+        activity_buffer.record(user["id"])
+        logger.info(f"Inicio de sesión: {username} (ID: {user['id']})")
+
+        return jsonify({
+            "message": "Inicio de sesión exitoso",
+            "token": token,
+            "token_type": "Bearer",
+            "expires_at": datetime.utcfromtimestamp(claims["exp"]).isoformat(),
+            "user_id": user["id"],
+            "user": {
+                "id": user["id"],
+                "username": user["username"],
+                "first_name": user["first_name"],
+                "last_name": user["last_name"],
+                "email": user["email"]
+            }
+        }), 200
+
+    except PasswordPoolBusy:
+        logger.warning("Inicio de sesión rechazado: pool de contraseñas lleno")
+        return jsonify({"error": "Servicio ocupado, intente de nuevo en unos segundos"}), 503, {"Retry-After": "1"}
+    except Exception as e:
+        logger.error(f"Error en inicio de sesión: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
+
+@app.route('/verify', methods=['GET'])
+def verify():
+    header = request.headers.get("Authorization", "")
+    token = header[len("Bearer "):].strip() if header.startswith("Bearer ") else None
+    claims = verify_token(AUTH_SECRET, token)
+    if not claims:
+        return jsonify({"valid": False, "error": "Token inválido o expirado"}), 401
+    return jsonify({
+        "valid": True,
+        "user_id": claims["sub"],
+        "expires_at": datetime.utcfromtimestamp(claims["exp"]).isoformat()
+    }), 200
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        cur.close()
+        return_db_connection(conn)
+
+        return jsonify({
+            "status": "healthy",
+            "timestamp": datetime.utcnow().isoformat(),
+            "database": "connected",
+            "activity_buffer": activity_buffer.stats(),
+            "service": "auth-api"
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error en health check: {e}")
+        return jsonify({
+            "status": "unhealthy",
+            "timestamp": datetime.utcnow().isoformat(),
+            "error": str(e),
+            "service": "auth-api"
+        }), 500
+
+@app.errorhandler(404)
+def not_found(error):
+    return jsonify({"error": "Endpoint no encontrado"}), 404
+
+@app.errorhandler(405)
+def method_not_allowed(error):
+    return jsonify({"error": "Método no permitido"}), 405
+
+@app.errorhandler(500)
+def internal_error(error):
+    logger.error(f"Error interno del servidor: {error}")
+    return jsonify({"error": "Error interno del servidor"}), 500
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+    debug = os.environ.get('FLASK_ENV') == 'development'
+    app.run(host='0.0.0.0', port=port, debug=debug)
@@ -1,14 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
 from flask_cors import CORS
 import os
+import sys
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2 import pool
 from datetime import datetime
 import logging
 import uuid
 from dotenv import load_dotenv
 
+from common.flask_auth import install_token_auth, identity_mismatch
+from common.migrations import check_migrations, run_migrations
+from common.ttl_cache import TTLCache
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -26,6 +31,19 @@ DB_USER = os.environ.get("DB_USER", "admin")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
 DB_NAME = os.environ.get("DB_NAME", "message-app-db")
 
+# Participantes incluidos en el resumen de cada chat del inbox (al menos 3, para
+# distinguir los chats de dos personas)
+PARTICIPANT_PREVIEW_SIZE = max(3, int(os.environ.get("PARTICIPANT_PREVIEW_SIZE", 5)))
+
+# Máximo de usuarios por llamada en los endpoints de participantes en bloque
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 500))
+
+# Caché en memoria de usuarios, chats y membresías. Los cambios hechos en este
+# servicio la invalidan explícitamente; los hechos por otros servicios (p. ej.
+# desactivar un usuario) se reflejan al expirar el TTL
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", 10))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 10000))
+
 if not DB_PASSWORD:
     raise ValueError("DB_PASSWORD debe estar configurada en las variables de entorno")
 
@@ -57,45 +75,224 @@ def return_db_connection(conn):
     except Exception as e:
         logger.error(f"Error devolviendo conexión al pool: {e}")
 
+# Migraciones (common/migrations.py), aplicadas con `python service.py migrate`
+MIGRATIONS = [
+    # Participantes de un chat (la clave primaria empieza por user_id)
+    ("chats_user_chat_chat_id_index", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_chat_chat_id
+        ON user_chat (chat_id, user_id)
+        """,
+    ]),
+    # Resumen del último mensaje, mantenido por el servicio de mensajes al escribir (la
+    # misma migración la declara el servicio de mensajes; se aplica una sola vez)
+    ("chats_last_message_columns", [
+        """
+        ALTER TABLE chats
+            ADD COLUMN IF NOT EXISTS last_message_id INTEGER,
+            ADD COLUMN IF NOT EXISTS last_message_preview TEXT,
+            ADD COLUMN IF NOT EXISTS last_message_sender_id INTEGER,
+            ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP
+        """,
+    ]),
+    # Clave canónica "menor:mayor" de los chats directos entre dos usuarios. El
+    # índice único garantiza un solo chat directo activo por pareja
+    ("chats_direct_key", [
+        """
+        ALTER TABLE chats ADD COLUMN IF NOT EXISTS direct_key TEXT
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_chats_direct_key
+        ON chats (direct_key) WHERE direct_key IS NOT NULL
+        """,
+    ]),
+    # Los chats activos de dos miembros creados antes de la clave pasan a ser el chat
+    # directo de su pareja. Las parejas con más de uno se dejan sin clave: no hay un
+    # chat canónico que elegir sin fusionar historiales
+    ("chats_direct_key_backfill", [
+        """
+        WITH pairs AS (
+            SELECT c.id, min(uc.user_id) || ':' || max(uc.user_id) AS direct_key
+            FROM chats c
+            JOIN user_chat uc ON uc.chat_id = c.id
+            WHERE c.is_active = true AND c.direct_key IS NULL
+            GROUP BY c.id
+            HAVING count(*) = 2
+        ), unique_pairs AS (
+            SELECT direct_key, min(id) AS id
+            FROM pairs
+            GROUP BY direct_key
+            HAVING count(*) = 1
+        )
+        UPDATE chats c
+        SET direct_key = p.direct_key
+        FROM unique_pairs p
+        WHERE c.id = p.id
+          AND NOT EXISTS (SELECT 1 FROM chats k WHERE k.direct_key = p.direct_key)
+        """,
+    ]),
+]
+
+RUNNING_MIGRATIONS = __name__ == '__main__' and sys.argv[1:2] == ['migrate']
+check_migrations(db_pool, MIGRATIONS, RUNNING_MIGRATIONS)
+
+# Solo se guardan resultados positivos, así un alta hecha en otro servicio se ve
+# de inmediato y solo las bajas dependen del TTL
+user_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+chat_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+membership_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+
+def invalidate_chat(chat_id):
+    chat_cache.delete(("chat", chat_id))
+    chat_cache.delete(("active", chat_id))
+
+# Tokens emitidos por el servicio de auth (common/tokens.py). Con AUTH_REQUIRED
+# desactivado las solicitudes sin token se siguen aceptando
+AUTH_SECRET = os.environ.get("AUTH_SECRET", "")
+AUTH_REQUIRED = os.environ.get("AUTH_REQUIRED", "false").lower() == "true"
+PUBLIC_ENDPOINTS = {"index", "health_check", "cache_stats"}
+
+install_token_auth(app, AUTH_SECRET, AUTH_REQUIRED, PUBLIC_ENDPOINTS)
+
+def get_users_by_ids(user_ids):
+    # Resuelve muchos usuarios activos con una sola consulta; devuelve {id: fila}.
+    # Dentro de una solicitud los resultados (incluidos los no encontrados) se
+    # guardan en flask.g, así que las búsquedas repetidas no vuelven a la DB
+    if not user_ids:
+        return {}
+    # Los IDs pueden llegar como texto desde el JSON ("3"): se normalizan a int para la
+    # consulta y las cachés, y el resultado se indexa con el ID tal como llegó
+    keys = {}
+    for user_id in user_ids:
+        try:
+            keys[user_id] = int(user_id)
+        except (TypeError, ValueError):
+            keys[user_id] = None
+    resolved = g.setdefault("users_by_id", {}) if has_request_context() else {}
+    missing = []
+    for user_id in dict.fromkeys(key for key in keys.values() if key is not None):
+        if user_id in resolved:
+            continue
+        cached = user_cache.get(user_id)
+        if cached is not None:
+            resolved[user_id] = cached
+        else:
+            missing.append(user_id)
+    if missing:
+        conn = None
+        try:
+            conn = get_db_connection()
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("""
+                SELECT id, username, first_name, last_name, 
+                       is_active, created_at
+                FROM users 
+                WHERE id = ANY(%s::integer[]) AND is_active = true
+            """, (missing,))
+            rows = {row["id"]: row for row in cur.fetchall()}
+            cur.close()
+            for user_id in missing:
+                resolved[user_id] = rows.get(user_id)
+                if user_id in rows:
+                    user_cache.set(user_id, rows[user_id])
+        except Exception as e:
+            logger.error(f"Error en get_users_by_ids: {e}")
+            return {}
+        finally:
+            if conn:
+                return_db_connection(conn)
+    return {user_id: resolved[key] for user_id, key in keys.items() if key is not None and resolved.get(key)}
+
 def get_user_by_id(user_id):
+    return get_users_by_ids([user_id]).get(user_id)
+
+def create_chat_in_db(name, participants):
+    # participants: lista de (user_id, is_admin). El chat y todas sus filas de
+    # user_chat se insertan en la misma transacción
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
+        chat_id = str(uuid.uuid4())
+        now = datetime.utcnow()
         cur.execute("""
-            SELECT id, username, first_name, last_name, 
-                   is_active, created_at
-            FROM users 
-            WHERE id = %s AND is_active = true
-        """, (user_id,))
-        row = cur.fetchone()
+            INSERT INTO chats (id, name, created_at, updated_at, is_active)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id, name, created_at, updated_at, is_active
+        """, (chat_id, name, now, now, True))
+        chat_data = cur.fetchone()
+        execute_values(cur, """
+            INSERT INTO user_chat (user_id, chat_id, is_admin)
+            VALUES %s
+            ON CONFLICT (user_id, chat_id) DO NOTHING
+        """, [(user_id, chat_id, is_admin) for user_id, is_admin in participants],
+            page_size=len(participants))
+        conn.commit()
         cur.close()
-        return row
+        logger.info(f"Chat creado exitosamente: {name} (ID: {chat_id}, participantes: {len(participants)})")
+        return chat_data
     except Exception as e:
-        logger.error(f"Error en get_user_by_id: {e}")
-        return None
+        logger.error(f"Error en create_chat_in_db: {e}")
+        if conn:
+            conn.rollback()
+        raise
     finally:
         if conn:
             return_db_connection(conn)
 
-def create_chat_in_db(name):
+def get_direct_key(user_id, other_user_id):
+    return f"{min(user_id, other_user_id)}:{max(user_id, other_user_id)}"
+
+def get_or_create_direct_chat_in_db(user_id, other_user_id, name):
+    # Devuelve (chat, creado). Si dos solicitudes crean el mismo chat a la vez, el
+    # índice único deja pasar solo una inserción y la otra lee el chat ganador
+    direct_key = get_direct_key(user_id, other_user_id)
+    select_query = """
+        SELECT c.id, c.name, c.created_at, c.updated_at, c.is_active,
+               ARRAY(
+                   SELECT uc.user_id FROM user_chat uc
+                   WHERE uc.chat_id = c.id AND uc.is_admin = true
+               ) AS admin_ids
+        FROM chats c
+        WHERE c.direct_key = %s
+    """
     conn = None
     try:
         conn = get_db_connection()
-        cur = conn.cursor()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(select_query, (direct_key,))
+        chat_data = cur.fetchone()
+        if chat_data:
+            conn.commit()
+            cur.close()
+            return chat_data, False
         chat_id = str(uuid.uuid4())
+        now = datetime.utcnow()
         cur.execute("""
-            INSERT INTO chats (id, name, created_at, updated_at, is_active)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id
-        """, (chat_id, name, datetime.utcnow(), datetime.utcnow(), True))
-        created_chat_id = cur.fetchone()[0]
+            INSERT INTO chats (id, name, created_at, updated_at, is_active, direct_key)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (direct_key) WHERE direct_key IS NOT NULL DO NOTHING
+            RETURNING id, name, created_at, updated_at, is_active,
+                      ARRAY[%s]::integer[] AS admin_ids
+        """, (chat_id, name, now, now, True, direct_key, user_id))
+        chat_data = cur.fetchone()
+        if not chat_data:
+            conn.rollback()
+            cur.execute(select_query, (direct_key,))
+            chat_data = cur.fetchone()
+            conn.commit()
+            cur.close()
+            return chat_data, False
+        execute_values(cur, """
+            INSERT INTO user_chat (user_id, chat_id, is_admin)
+            VALUES %s
+        """, [(user_id, chat_id, True), (other_user_id, chat_id, False)])
         conn.commit()
         cur.close()
-        logger.info(f"Chat creado exitosamente: {name} (ID: {created_chat_id})")
-        return created_chat_id
+        logger.info(f"Chat directo creado: {direct_key} (ID: {chat_id})")
+        return chat_data, True
     except Exception as e:
-        logger.error(f"Error en create_chat_in_db: {e}")
+        logger.error(f"Error en get_or_create_direct_chat_in_db: {e}")
         if conn:
             conn.rollback()
         raise
@@ -120,8 +317,16 @@ def add_user_to_chat_in_db(user_id, chat_id, is_admin=False):
             VALUES (%s, %s, %s)
             ON CONFLICT (user_id, chat_id) DO NOTHING
         """, (user_id, chat_id, is_admin))
+        if cur.rowcount:
+            # Un chat directo deja de serlo al cambiar sus participantes; updated_at
+            # cambia para invalidar los ETag del inbox
+            cur.execute("""
+                UPDATE chats SET direct_key = NULL, updated_at = %s
+                WHERE id = %s
+            """, (datetime.utcnow(), chat_id))
         conn.commit()
         cur.close()
+        invalidate_chat(chat_id)
         logger.info(f"Usuario {user_id} agregado al chat {chat_id} (admin: {is_admin})")
     except Exception as e:
         logger.error(f"Error en add_user_to_chat_in_db: {e}")
@@ -133,6 +338,9 @@ def add_user_to_chat_in_db(user_id, chat_id, is_admin=False):
             return_db_connection(conn)
 
 def get_chat_by_id(chat_id):
+    cached = chat_cache.get(("chat", chat_id))
+    if cached is not None:
+        return cached
     conn = None
     try:
         conn = get_db_connection()
@@ -155,10 +363,12 @@ def get_chat_by_id(chat_id):
         """, (chat_id,))
         participants = cur.fetchall()
         cur.close()
-        return {
+        chat_info = {
             "chat": chat_data,
             "participants": participants
         }
+        chat_cache.set(("chat", chat_id), chat_info)
+        return chat_info
     except Exception as e:
         logger.error(f"Error en get_chat_by_id: {e}")
         return None
@@ -166,19 +376,73 @@ def get_chat_by_id(chat_id):
         if conn:
             return_db_connection(conn)
 
+def get_user_chats_version(user_id):
+    # Huella de los chats del usuario: cambia con cada mensaje (last_message_id),
+    # cambio de participantes o desactivación (updated_at) y alta o baja del usuario.
+    # Solo lee user_chat y las filas de chats, no arma el inbox. Las columnas que
+    # admiten NULL van con COALESCE: un NULL anularía el término y el chat no contaría
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT md5(COALESCE(string_agg(
+                       c.id || ':' || COALESCE(c.updated_at::text, '') || ':' || COALESCE(c.last_message_id, 0)
+                       || ':' || COALESCE(uc.is_admin::text, ''),
+                       ',' ORDER BY c.id), ''))
+            FROM user_chat uc
+            JOIN chats c ON c.id = uc.chat_id AND c.is_active = true
+            WHERE uc.user_id = %s
+        """, (user_id,))
+        version = cur.fetchone()[0]
+        cur.close()
+        return version
+    except Exception as e:
+        logger.error(f"Error en get_user_chats_version: {e}")
+        raise
+    finally:
+        if conn:
+            return_db_connection(conn)
+
 def get_user_chats(user_id):
+    # Inbox completo en una sola consulta: cada chat con su número de participantes,
+    # un resumen de los primeros participantes y el resumen de su último mensaje,
+    # que ya está en la fila del chat (no se consulta la tabla de mensajes)
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute("""
             SELECT c.id, c.name, c.created_at, c.updated_at, c.is_active,
-                   uc.is_admin
+                   uc.is_admin,
+                   p.participant_count, p.participants,
+                   c.last_message_id, c.last_message_preview,
+                   c.last_message_sender_id, c.last_message_at
             FROM chats c
             JOIN user_chat uc ON c.id = uc.chat_id
+            LEFT JOIN LATERAL (
+                SELECT count(*) AS participant_count,
+                       COALESCE(
+                           json_agg(json_build_object(
+                               'id', pu.id,
+                               'username', pu.username,
+                               'first_name', pu.first_name,
+                               'last_name', pu.last_name,
+                               'is_admin', pu.is_admin
+                           ) ORDER BY pu.position) FILTER (WHERE pu.position <= %s),
+                           '[]'
+                       ) AS participants
+                FROM (
+                    SELECT u.id, u.username, u.first_name, u.last_name, puc.is_admin,
+                           row_number() OVER (ORDER BY puc.is_admin DESC, u.first_name) AS position
+                    FROM user_chat puc
+                    JOIN users u ON u.id = puc.user_id
+                    WHERE puc.chat_id = c.id AND u.is_active = true
+                ) pu
+            ) p ON true
             WHERE uc.user_id = %s AND c.is_active = true
             ORDER BY c.updated_at DESC
-        """, (user_id,))
+        """, (PARTICIPANT_PREVIEW_SIZE, user_id))
         chats = cur.fetchall()
         cur.close()
         return chats
@@ -189,25 +453,138 @@ def get_user_chats(user_id):
         if conn:
             return_db_connection(conn)
 
-def get_chat_participants(chat_id):
+def chat_is_active(chat_id):
+    # Comprobación ligera de existencia, sin cargar participantes
+    if chat_cache.get(("active", chat_id)):
+        return True
     conn = None
     try:
         conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur = conn.cursor()
         cur.execute("""
-            SELECT u.id, u.username, u.first_name, u.last_name, 
-                   u.is_active, uc.is_admin
-            FROM users u
-            JOIN user_chat uc ON u.id = uc.user_id
-            WHERE uc.chat_id = %s AND u.is_active = true
-            ORDER BY uc.is_admin DESC, u.first_name
+            SELECT 1 FROM chats 
+            WHERE id = %s AND is_active = true
         """, (chat_id,))
-        participants = cur.fetchall()
+        result = cur.fetchone()
         cur.close()
-        return participants
+        if result is not None:
+            chat_cache.set(("active", chat_id), True)
+        return result is not None
     except Exception as e:
-        logger.error(f"Error en get_chat_participants: {e}")
-        return []
+        logger.error(f"Error en chat_is_active: {e}")
+        return False
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+def user_is_in_chat(user_id, chat_id):
+    if membership_cache.get((user_id, chat_id)):
+        return True
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT 1 FROM user_chat 
+            WHERE user_id = %s AND chat_id = %s
+        """, (user_id, chat_id))
+        result = cur.fetchone()
+        cur.close()
+        if result is not None:
+            membership_cache.set((user_id, chat_id), True)
+        return result is not None
+    except Exception as e:
+        logger.error(f"Error en user_is_in_chat: {e}")
+        return False
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+def add_users_to_chat_in_db(chat_id, user_ids, is_admin=False):
+    # Valida e inserta todos los usuarios en una sola sentencia y transacción.
+    # Devuelve {user_id: "added" | "already_member" | "not_found"}
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            WITH requested AS (
+                SELECT DISTINCT unnest(%(user_ids)s::integer[]) AS user_id
+            ), valid AS (
+                SELECT r.user_id
+                FROM requested r
+                JOIN users u ON u.id = r.user_id AND u.is_active = true
+            ), inserted AS (
+                INSERT INTO user_chat (user_id, chat_id, is_admin)
+                SELECT user_id, %(chat_id)s, %(is_admin)s FROM valid
+                ON CONFLICT (user_id, chat_id) DO NOTHING
+                RETURNING user_id
+            )
+            SELECT r.user_id,
+                   v.user_id IS NOT NULL AS user_exists,
+                   i.user_id IS NOT NULL AS added
+            FROM requested r
+            LEFT JOIN valid v ON v.user_id = r.user_id
+            LEFT JOIN inserted i ON i.user_id = r.user_id
+        """, {"user_ids": list(user_ids), "chat_id": chat_id, "is_admin": is_admin})
+        rows = cur.fetchall()
+        if any(row["added"] for row in rows):
+            cur.execute("""
+                UPDATE chats SET direct_key = NULL, updated_at = %s
+                WHERE id = %s
+            """, (datetime.utcnow(), chat_id))
+        conn.commit()
+        cur.close()
+        invalidate_chat(chat_id)
+        results = {}
+        for row in rows:
+            if row["added"]:
+                results[row["user_id"]] = "added"
+            elif row["user_exists"]:
+                results[row["user_id"]] = "already_member"
+            else:
+                results[row["user_id"]] = "not_found"
+        added = sum(1 for status in results.values() if status == "added")
+        logger.info(f"{added} usuarios agregados al chat {chat_id} (admin: {is_admin})")
+        return results
+    except Exception as e:
+        logger.error(f"Error en add_users_to_chat_in_db: {e}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+def remove_users_from_chat_in_db(chat_id, user_ids):
+    # Devuelve el conjunto de user_ids que realmente eran miembros y se removieron
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("""
+            DELETE FROM user_chat 
+            WHERE chat_id = %s AND user_id = ANY(%s::integer[])
+            RETURNING user_id
+        """, (chat_id, list(user_ids)))
+        removed = {row[0] for row in cur.fetchall()}
+        if removed:
+            cur.execute("""
+                UPDATE chats SET direct_key = NULL, updated_at = %s
+                WHERE id = %s
+            """, (datetime.utcnow(), chat_id))
+        conn.commit()
+        cur.close()
+        invalidate_chat(chat_id)
+        for user_id in removed:
+            membership_cache.delete((user_id, chat_id))
+        logger.info(f"{len(removed)} usuarios removidos del chat {chat_id}")
+        return removed
+    except Exception as e:
+        logger.error(f"Error en remove_users_from_chat_in_db: {e}")
+        if conn:
+            conn.rollback()
+        raise
     finally:
         if conn:
             return_db_connection(conn)
@@ -221,8 +598,15 @@ def remove_user_from_chat_in_db(user_id, chat_id):
             DELETE FROM user_chat 
             WHERE user_id = %s AND chat_id = %s
         """, (user_id, chat_id))
+        if cur.rowcount:
+            cur.execute("""
+                UPDATE chats SET direct_key = NULL, updated_at = %s
+                WHERE id = %s
+            """, (datetime.utcnow(), chat_id))
         conn.commit()
         cur.close()
+        invalidate_chat(chat_id)
+        membership_cache.delete((user_id, chat_id))
         logger.info(f"Usuario {user_id} removido del chat {chat_id}")
     except Exception as e:
         logger.error(f"Error en remove_user_from_chat_in_db: {e}")
@@ -240,11 +624,12 @@ def deactivate_chat_in_db(chat_id):
         cur = conn.cursor()
         cur.execute("""
             UPDATE chats 
-            SET is_active = false, updated_at = %s
+            SET is_active = false, updated_at = %s, direct_key = NULL
             WHERE id = %s
         """, (datetime.utcnow(), chat_id))
         conn.commit()
         cur.close()
+        invalidate_chat(chat_id)
         logger.info(f"Chat {chat_id} desactivado")
     except Exception as e:
         logger.error(f"Error en deactivate_chat_in_db: {e}")
@@ -255,6 +640,40 @@ def deactivate_chat_in_db(chat_id):
         if conn:
             return_db_connection(conn)
 
+def direct_chat_response(users, user_id, other_user_id, name=None):
+    # Respuesta de POST /chats/direct y de POST /chats con dos participantes. users
+    # trae a ambos usuarios ya validados
+    name = name or f"{users[user_id]['first_name']} y {users[other_user_id]['first_name']}"
+    chat_data, created = get_or_create_direct_chat_in_db(user_id, other_user_id, name)
+    admin_ids = set(chat_data["admin_ids"])
+    participants = sorted(
+        (dict(users[pid], is_admin=(pid in admin_ids)) for pid in (user_id, other_user_id)),
+        key=lambda p: (not p["is_admin"], p["first_name"] or "")
+    )
+    response_data = {
+        "chat_id": chat_data["id"],
+        "name": get_personalized_chat_name(chat_data, participants, user_id),
+        "created_at": chat_data["created_at"].isoformat(),
+        "updated_at": chat_data["updated_at"].isoformat(),
+        "is_active": chat_data["is_active"],
+        "is_direct": True,
+        "participants": [
+            {
+                "user_id": participant["id"],
+                "username": participant["username"],
+                "first_name": participant["first_name"],
+                "last_name": participant["last_name"],
+                "is_admin": participant["is_admin"]
+            }
+            for participant in participants
+        ]
+    }
+    return jsonify({
+        "message": "Chat directo creado exitosamente" if created else "Chat directo existente",
+        "created": created,
+        "chat": response_data
+    }), 201 if created else 200
+
 @app.route('/', methods=['GET'])
 def index():
     return jsonify({
@@ -262,11 +681,15 @@ def index():
         "version": "1.0.0",
         "endpoints": [
             "POST /chats - Crear nuevo chat",
+            "POST /chats/direct - Obtener o crear chat directo entre dos usuarios",
             "GET /chats/<chat_id> - Obtener chat por ID",
             "GET /users/<user_id>/chats - Obtener chats de un usuario",
             "POST /chats/<chat_id>/participants - Agregar participante a chat",
+            "POST /chats/<chat_id>/participants/batch - Agregar muchos participantes",
+            "DELETE /chats/<chat_id>/participants - Remover muchos participantes",
             "DELETE /chats/<chat_id>/participants/<user_id> - Remover participante",
             "DELETE /chats/<chat_id> - Desactivar chat",
+            "GET /cache/stats - Estadísticas de la caché en memoria",
             "GET /health - Health check"
         ]
     })
@@ -275,43 +698,51 @@ def index():
 def create_chat():
    try:
        data = request.json
-       creator_id = data.get("creator_id")
+       creator_id = data.get("creator_id") or g.auth_user_id
        participant_ids = data.get("participant_ids", [])
        name = data.get("name", "")
        if not creator_id:
            return jsonify({"error": "creator_id es requerido"}), 400
-       creator = get_user_by_id(creator_id)
+       if identity_mismatch(creator_id):
+           return jsonify({"error": "creator_id no coincide con el usuario autenticado"}), 403
+       try:
+           creator_id = int(creator_id)
+           participant_ids = [int(pid) for pid in participant_ids]
+       except (TypeError, ValueError):
+           return jsonify({"error": "Los IDs de usuario deben ser enteros"}), 400
+       # Todos los participantes se validan con una sola consulta
+       valid_participants = list(dict.fromkeys([creator_id] + participant_ids))
+       users = get_users_by_ids(valid_participants)
+       creator = users.get(creator_id)
        if not creator:
            return jsonify({"error": "Usuario creador no encontrado"}), 404
-       valid_participants = [creator_id]
-       for pid in participant_ids:
-           if pid != creator_id:
-               user = get_user_by_id(pid)
-               if user:
-                   valid_participants.append(pid)
-               else:
-                   return jsonify({"error": f"Participante con ID {pid} no encontrado"}), 404
+       for pid in valid_participants:
+           if pid not in users:
+               return jsonify({"error": f"Participante con ID {pid} no encontrado"}), 404
+       # Un chat entre dos usuarios es su chat directo: se reutiliza si ya existe
+       if len(valid_participants) == 2:
+           return direct_chat_response(users, creator_id, valid_participants[1], name)
        if not name:
            name = f"Chat de {creator['first_name']}"
-       chat_id = create_chat_in_db(name)
-       for user_id in valid_participants:
-           is_admin = (user_id == creator_id)
-           add_user_to_chat_in_db(user_id, chat_id, is_admin)
-       chat_info = get_chat_by_id(chat_id)
-       chat_name = get_personalized_chat_name(
-           chat_info["chat"], 
-           chat_info["participants"], 
-           creator_id
+       chat_data = create_chat_in_db(
+           name,
+           [(user_id, user_id == creator_id) for user_id in valid_participants]
+       )
+       # La respuesta se arma con lo ya validado, sin volver a leer el chat
+       participants = sorted(
+           (dict(users[user_id], is_admin=(user_id == creator_id)) for user_id in valid_participants),
+           key=lambda p: (not p["is_admin"], p["first_name"] or "")
        )
+       chat_name = get_personalized_chat_name(chat_data, participants, creator_id)
        response_data = {
-           "chat_id": chat_info["chat"]["id"],
+           "chat_id": chat_data["id"],
            "name": chat_name,
-           "created_at": chat_info["chat"]["created_at"].isoformat(),
-           "updated_at": chat_info["chat"]["updated_at"].isoformat(),
-           "is_active": chat_info["chat"]["is_active"],
+           "created_at": chat_data["created_at"].isoformat(),
+           "updated_at": chat_data["updated_at"].isoformat(),
+           "is_active": chat_data["is_active"],
            "participants": []
        }
-       for participant in chat_info["participants"]:
+       for participant in participants:
            response_data["participants"].append({
                "user_id": participant["id"],
                "username": participant["username"],
@@ -327,32 +758,34 @@ def create_chat():
        logger.error(f"Error creando chat: {e}")
        return jsonify({"error": "Error interno del servidor"}), 500
        
-def get_last_message_for_chat(chat_id):
-    conn = None
+@app.route('/chats/direct', methods=['POST'])
+def get_or_create_direct_chat():
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT content, timestamp
-            FROM messages
-            WHERE chat_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """, (chat_id,))
-        last_msg = cur.fetchone()
-        cur.close()
-        return last_msg
+        data = request.json or {}
+        try:
+            user_id = int(data.get("user_id") or g.auth_user_id)
+            other_user_id = int(data.get("other_user_id"))
+        except (TypeError, ValueError):
+            return jsonify({"error": "user_id y other_user_id son requeridos y deben ser enteros"}), 400
+        if identity_mismatch(user_id):
+            return jsonify({"error": "user_id no coincide con el usuario autenticado"}), 403
+        if user_id == other_user_id:
+            return jsonify({"error": "Un chat directo requiere dos usuarios distintos"}), 400
+        users = get_users_by_ids([user_id, other_user_id])
+        for pid in (user_id, other_user_id):
+            if pid not in users:
+                return jsonify({"error": f"Usuario con ID {pid} no encontrado"}), 404
+        return direct_chat_response(users, user_id, other_user_id, data.get("name"))
     except Exception as e:
-        logger.error(f"Error en get_last_message_for_chat: {e}")
-        return None
-    finally:
-        if conn:
-            return_db_connection(conn)
+        logger.error(f"Error obteniendo chat directo: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
 
 @app.route('/chats/<chat_id>', methods=['GET'])
 def get_chat(chat_id):
     try:
-        user_id = request.args.get('user_id', type=int)
+        user_id = request.args.get('user_id', type=int) or g.auth_user_id
+        if identity_mismatch(user_id):
+            return jsonify({"error": "user_id no coincide con el usuario autenticado"}), 403
         chat_info = get_chat_by_id(chat_id)
         if not chat_info:
             return jsonify({"error": "Chat no encontrado"}), 404
@@ -387,15 +820,23 @@ def get_chat(chat_id):
 @app.route('/users/<int:user_id>/chats', methods=['GET'])
 def get_user_chats_endpoint(user_id):
     try:
+        if identity_mismatch(user_id):
+            return jsonify({"error": "No autorizado para ver los chats de otro usuario"}), 403
         user = get_user_by_id(user_id)
         if not user:
             return jsonify({"error": "Usuario no encontrado"}), 404
+        etag = get_user_chats_version(user_id)
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
         user_chats = get_user_chats(user_id)
         chats = []
         for chat in user_chats:
-            participants = get_chat_participants(chat["id"])
+            # El resumen trae al menos 3 participantes: solo tiene 2 si el chat tiene 2
+            participants = chat["participants"]
             chat_name = get_personalized_chat_name(chat, participants, user_id)
-            last_msg = get_last_message_for_chat(chat["id"])
+            last_message_time = chat["last_message_at"]
             chats.append({
                 "chat_id": chat["id"],
                 "name": chat_name,
@@ -403,14 +844,30 @@ def get_user_chats_endpoint(user_id):
                 "updated_at": chat["updated_at"].isoformat(),
                 "is_active": chat["is_active"],
                 "is_admin": chat["is_admin"],
-                "last_message": last_msg["content"] if last_msg else None,
-                "last_message_time": last_msg["timestamp"].isoformat() if last_msg else None
+                "participant_count": chat["participant_count"],
+                "participants": [
+                    {
+                        "user_id": participant["id"],
+                        "username": participant["username"],
+                        "first_name": participant["first_name"],
+                        "last_name": participant["last_name"],
+                        "is_admin": participant["is_admin"]
+                    }
+                    for participant in participants
+                ],
+                "last_message": chat["last_message_preview"],
+                "last_message_id": chat["last_message_id"],
+                "last_message_sender_id": chat["last_message_sender_id"],
+                "last_message_time": last_message_time.isoformat() if last_message_time else None
             })
-        return jsonify({
+        response = jsonify({
             "user_id": user_id,
             "chats": chats,
             "total": len(chats)
-        }), 200
+        })
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response, 200
     except Exception as e:
         logger.error(f"Error obteniendo chats del usuario: {e}")
         return jsonify({"error": "Error interno del servidor"}), 500
@@ -423,8 +880,7 @@ def add_participant_to_chat(chat_id):
         is_admin = data.get("is_admin", False)
         if not user_id:
             return jsonify({"error": "user_id es requerido"}), 400
-        chat_info = get_chat_by_id(chat_id)
-        if not chat_info:
+        if not chat_is_active(chat_id):
             return jsonify({"error": "Chat no encontrado"}), 404
         user = get_user_by_id(user_id)
         if not user:
@@ -440,15 +896,75 @@ def add_participant_to_chat(chat_id):
         logger.error(f"Error agregando participante al chat: {e}")
         return jsonify({"error": "Error interno del servidor"}), 500
 
+def parse_user_ids(raw):
+    # Acepta una lista JSON o un texto "1,2,3"; lanza ValueError si algún ID no es entero
+    if isinstance(raw, str):
+        raw = [part for part in raw.split(",") if part.strip()]
+    if not isinstance(raw, list):
+        raise ValueError("user_ids debe ser una lista")
+    return list(dict.fromkeys(int(user_id) for user_id in raw))
+
+@app.route('/chats/<chat_id>/participants/batch', methods=['POST'])
+def add_participants_to_chat(chat_id):
+    try:
+        data = request.json or {}
+        is_admin = bool(data.get("is_admin", False))
+        try:
+            user_ids = parse_user_ids(data.get("user_ids"))
+        except (TypeError, ValueError):
+            return jsonify({"error": "user_ids debe ser una lista de enteros"}), 400
+        if not user_ids:
+            return jsonify({"error": "user_ids es requerido"}), 400
+        if len(user_ids) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"Máximo {MAX_BATCH_SIZE} usuarios por llamada"}), 400
+        if not chat_is_active(chat_id):
+            return jsonify({"error": "Chat no encontrado"}), 404
+        results = add_users_to_chat_in_db(chat_id, user_ids, is_admin)
+        return jsonify({
+            "message": "Participantes procesados",
+            "chat_id": chat_id,
+            "is_admin": is_admin,
+            "added": sum(1 for status in results.values() if status == "added"),
+            "results": [{"user_id": user_id, "status": results[user_id]} for user_id in user_ids]
+        }), 200
+    except Exception as e:
+        logger.error(f"Error agregando participantes al chat: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
+
+@app.route('/chats/<chat_id>/participants', methods=['DELETE'])
+def remove_participants_from_chat(chat_id):
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            user_ids = parse_user_ids(data.get("user_ids", request.args.get("user_ids", "")))
+        except (TypeError, ValueError):
+            return jsonify({"error": "user_ids debe ser una lista de enteros"}), 400
+        if not user_ids:
+            return jsonify({"error": "user_ids es requerido"}), 400
+        if len(user_ids) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"Máximo {MAX_BATCH_SIZE} usuarios por llamada"}), 400
+        if not chat_is_active(chat_id):
+            return jsonify({"error": "Chat no encontrado"}), 404
+        removed = remove_users_from_chat_in_db(chat_id, user_ids)
+        return jsonify({
+            "message": "Participantes procesados",
+            "chat_id": chat_id,
+            "removed": len(removed),
+            "results": [
+                {"user_id": user_id, "status": "removed" if user_id in removed else "not_member"}
+                for user_id in user_ids
+            ]
+        }), 200
+    except Exception as e:
+        logger.error(f"Error removiendo participantes del chat: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
+
 @app.route('/chats/<chat_id>/participants/<int:user_id>', methods=['DELETE'])
 def remove_participant_from_chat(chat_id, user_id):
     try:
-        chat_info = get_chat_by_id(chat_id)
-        if not chat_info:
+        if not chat_is_active(chat_id):
             return jsonify({"error": "Chat no encontrado"}), 404
-        participants = get_chat_participants(chat_id)
-        user_in_chat = any(p["id"] == user_id for p in participants)
-        if not user_in_chat:
+        if not user_is_in_chat(user_id, chat_id):
             return jsonify({"error": "Usuario no está en el chat"}), 404
         remove_user_from_chat_in_db(user_id, chat_id)
         return jsonify({
@@ -475,6 +991,14 @@ def delete_chat(chat_id):
         logger.error(f"Error desactivando chat: {e}")
         return jsonify({"error": "Error interno del servidor"}), 500
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "users": user_cache.stats(),
+        "chats": chat_cache.stats(),
+        "memberships": membership_cache.stats()
+    }), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     try:
@@ -513,6 +1037,9 @@ def internal_error(error):
     return jsonify({"error": "Error interno del servidor"}), 500
 
 if __name__ == '__main__':
+    if RUNNING_MIGRATIONS:
+        run_migrations(db_pool, MIGRATIONS)
+        sys.exit(0)
     port = int(os.environ.get('PORT', 5001))
     debug = os.environ.get('FLASK_ENV') == 'development'
     app.run(host='0.0.0.0', port=port, debug=debug)
@@ -0,0 +1,3 @@
+# Código compartido por los servicios. Cada Dockerfile copia esta carpeta junto a
+# service.py/app.py (contexto de build: ./services); fuera de Docker se ejecuta con
+# PYTHONPATH=services
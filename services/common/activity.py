@@ -0,0 +1,120 @@
+import atexit
+import logging
+import signal
+import threading
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+class ActivityBuffer:
+    """Acumula la última actividad (last_login) de cada usuario y la escribe en bloque"""
+
+    def __init__(self, db_pool, max_pending, flush_interval):
+        self.db_pool = db_pool
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="activity-flush", daemon=True)
+        self._thread.start()
+        # Lo pendiente se vuelca al salir del intérprete, también tras SIGTERM (docker stop)
+        # o SIGINT, que sin manejador terminan el proceso sin pasar por atexit
+        atexit.register(self.stop)
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                self._exit_on_signal(signum)
+
+    def _exit_on_signal(self, signum):
+        # El manejador no toca la DB ni el lock (puede interrumpir al hilo que lo tiene):
+        # detiene el hilo de volcado y deja que el proceso salga por la vía normal
+        previous = signal.getsignal(signum)
+
+        def handler(received, frame):
+            self._stop.set()
+            if callable(previous):
+                previous(received, frame)
+            elif previous != signal.SIG_IGN:
+                raise SystemExit(128 + received)
+
+        signal.signal(signum, handler)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def record(self, user_id, seen_at=None):
+        seen_at = seen_at or datetime.utcnow()
+        with self._lock:
+            previous = self._pending.get(user_id)
+            if previous is None or seen_at > previous:
+                self._pending[user_id] = seen_at
+            full = len(self._pending) >= self.max_pending
+        # Memoria acotada: si el buffer se llena se vacía en este hilo sin esperar al intervalo
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        conn = None
+        try:
+            conn = self.db_pool.getconn()
+            cur = conn.cursor()
+            # Filas ordenadas por id para que dos réplicas no se bloqueen entre sí
+            execute_values(cur, """
+                UPDATE users AS u
+                SET last_login = GREATEST(u.last_login, v.seen_at)
+                FROM (VALUES %s) AS v(id, seen_at)
+                WHERE u.id = v.id
+            """, sorted(batch.items()), template="(%s::integer, %s::timestamp)", page_size=len(batch))
+            conn.commit()
+            cur.close()
+            self.flushed += len(batch)
+            self.flushes += 1
+            return len(batch)
+        except Exception as e:
+            logger.error(f"Error escribiendo actividad de {len(batch)} usuarios: {e}")
+            self.failures += 1
+            if conn:
+                conn.rollback()
+            # Se reencola lo no escrito sin superar el límite ni pisar marcas más recientes
+            with self._lock:
+                for user_id, seen_at in batch.items():
+                    if len(self._pending) >= self.max_pending:
+                        break
+                    if user_id not in self._pending or seen_at > self._pending[user_id]:
+                        self._pending[user_id] = seen_at
+            return 0
+        finally:
+            if conn:
+                self.db_pool.putconn(conn)
+
+    def stop(self):
+        # Espera a un volcado en curso del hilo y escribe lo que quede
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "max_pending": self.max_pending,
+            "flush_interval_seconds": self.flush_interval,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "failures": self.failures
+        }
@@ -0,0 +1,31 @@
+from flask import g, jsonify, request
+
+from common.tokens import token_user_id
+
+def install_token_auth(app, secret, required, public_endpoints):
+    # Deja en g.auth_user_id el usuario del token "Authorization: Bearer ...". Un token
+    # inválido se rechaza siempre; sin token la solicitud solo se rechaza con required
+    @app.before_request
+    def authenticate_request():
+        g.auth_user_id = None
+        if request.method == "OPTIONS" or request.endpoint in public_endpoints:
+            return None
+        header = request.headers.get("Authorization", "")
+        if header.startswith("Bearer "):
+            g.auth_user_id = token_user_id(secret, header[len("Bearer "):].strip())
+            if g.auth_user_id is None:
+                return jsonify({"error": "Token inválido o expirado"}), 401
+        elif required:
+            return jsonify({"error": "Token de autenticación requerido"}), 401
+        return None
+
+    return authenticate_request
+
+def identity_mismatch(user_id):
+    # Con token, el usuario indicado en la solicitud debe ser el del token
+    if g.get("auth_user_id") is None or user_id is None:
+        return False
+    try:
+        return int(user_id) != g.auth_user_id
+    except (TypeError, ValueError):
+        return True
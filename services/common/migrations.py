@@ -0,0 +1,89 @@
+import logging
+import time
+
+# Cambios de esquema de todos los servicios. Cada servicio declara su lista ordenada de
+# (nombre, sentencias) y `python service.py migrate` (paso de despliegue, antes de
+# arrancar) aplica las pendientes, cada una en su propia transacción, y las registra en
+# schema_migrations. La tabla es común a todos los servicios: los nombres llevan el
+# prefijo de la tabla que cambian. Al importar, el servicio solo comprueba que no queden
+# pendientes y no toma bloqueos sobre las tablas
+
+logger = logging.getLogger(__name__)
+
+# Serializa las migraciones de réplicas o servicios que despliegan a la vez
+SCHEMA_LOCK_ID = 72105
+
+def pending_migrations(conn, migrations):
+    # Nombres de las migraciones de la lista que aún no se han aplicado
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        applied = set()
+        if cur.fetchone()[0]:
+            cur.execute("SELECT name FROM schema_migrations")
+            applied = {row[0] for row in cur.fetchall()}
+        conn.commit()
+        return [name for name, _ in migrations if name not in applied]
+    finally:
+        cur.close()
+
+def apply_migrations(conn, migrations):
+    # Aplica las pendientes en orden; si una falla se revierte entera y se relanza el error
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_ID,))
+    try:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """)
+        conn.commit()
+        applied = []
+        for name, statements in migrations:
+            cur.execute("SELECT 1 FROM schema_migrations WHERE name = %s", (name,))
+            if cur.fetchone():
+                conn.commit()
+                continue
+            started = time.perf_counter()
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+            conn.commit()
+            applied.append(name)
+            logger.info(f"Migración {name} aplicada en {time.perf_counter() - started:.1f} s")
+        return applied
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_ID,))
+        conn.commit()
+        cur.close()
+
+def run_migrations(db_pool, migrations):
+    conn = db_pool.getconn()
+    try:
+        return apply_migrations(conn, migrations)
+    except Exception as e:
+        logger.error(f"Error aplicando migraciones: {e}")
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+def check_migrations(db_pool, migrations, migrating=False):
+    # El servicio no arranca con migraciones pendientes ni si no puede comprobarlas;
+    # al ejecutar `migrate` solo se informa de ellas
+    conn = db_pool.getconn()
+    try:
+        pending = pending_migrations(conn, migrations)
+    except Exception as e:
+        logger.error(f"Error comprobando migraciones: {e}")
+        raise
+    finally:
+        db_pool.putconn(conn)
+    if pending and not migrating:
+        raise RuntimeError(
+            f"Migraciones pendientes ({', '.join(pending)}): ejecute `python service.py migrate`"
+        )
+    return pending
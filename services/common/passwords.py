@@ -0,0 +1,60 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+class PasswordPoolBusy(Exception):
+    pass
+
+def hash_password_worker(password, rounds):
+    started = time.perf_counter()
+    salt = bcrypt.gensalt(rounds=rounds)
+    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
+    return hashed.decode('utf-8'), (time.perf_counter() - started) * 1000
+
+def check_password_worker(password, password_hash):
+    started = time.perf_counter()
+    matches = bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    return matches, (time.perf_counter() - started) * 1000
+
+class PasswordPool:
+    """Ejecuta bcrypt en procesos aparte para no bloquear los hilos que atienden
+    lecturas. Si hay más de queue_size tareas en espera se rechaza de inmediato
+    con PasswordPoolBusy en lugar de encolar sin límite"""
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        # forkserver: los procesos no se clonan desde este, que ya tiene hilos en marcha
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def run(self, task, *args):
+        # Devuelve (resultado, ms de CPU, ms en cola); lanza PasswordPoolBusy si el pool está lleno
+        if not self._slots.acquire(blocking=False):
+            raise PasswordPoolBusy("Pool de contraseñas lleno")
+        with self._lock:
+            self.in_flight += 1
+        submitted = time.perf_counter()
+        try:
+            result, elapsed_ms = self._executor.submit(task, *args).result()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+        waited_ms = max(0.0, (time.perf_counter() - submitted) * 1000 - elapsed_ms)
+        return result, elapsed_ms, waited_ms
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight
+        }
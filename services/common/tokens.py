@@ -0,0 +1,50 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+# Token "payload.firma": payload es JSON {"sub", "iat", "exp"} en base64url y la firma
+# es HMAC-SHA256 del payload con AUTH_SECRET. El servicio de auth los emite y el resto
+# los verifica localmente, sin consultar la DB ni otro servicio
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode('ascii')
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _sign(secret, payload):
+    return hmac.new(secret.encode('utf-8'), payload.encode('ascii'), hashlib.sha256).digest()
+
+def create_token(secret, user_id, ttl_seconds, now=None):
+    # Devuelve (token, claims)
+    issued_at = int(now or time.time())
+    claims = {"sub": user_id, "iat": issued_at, "exp": issued_at + ttl_seconds}
+    payload = b64encode(json.dumps(claims, separators=(",", ":")).encode('utf-8'))
+    return f"{payload}.{b64encode(_sign(secret, payload))}", claims
+
+def verify_token(secret, token):
+    # Devuelve los claims si la firma es válida y el token no ha expirado
+    if not token or not secret:
+        return None
+    try:
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(b64decode(signature), _sign(secret, payload)):
+            return None
+        claims = json.loads(b64decode(payload))
+        if claims["exp"] < time.time():
+            return None
+        return claims
+    except Exception:
+        return None
+
+def token_user_id(secret, token):
+    # Devuelve el user_id del token o None si no es válido
+    claims = verify_token(secret, token)
+    if claims is None:
+        return None
+    try:
+        return int(claims["sub"])
+    except (KeyError, TypeError, ValueError):
+        return None
@@ -1,14 +1,23 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, stream_with_context
 from flask_cors import CORS
 import os
+import sys
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2 import pool
 from datetime import datetime
 import logging
 import uuid
+import base64
+import hashlib
+import json
+import threading
 from dotenv import load_dotenv
 
+from common.flask_auth import install_token_auth, identity_mismatch
+from common.migrations import check_migrations, run_migrations
+from common.ttl_cache import TTLCache
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -26,6 +35,37 @@ DB_USER = os.environ.get("DB_USER", "admin")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
 DB_NAME = os.environ.get("DB_NAME", "message-app-db")
 
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 500))
+
+# Caracteres del último mensaje que se guardan en el resumen del chat
+LAST_MESSAGE_PREVIEW_LENGTH = 200
+
+# Mensajes por chat en cada respuesta de /sync
+SYNC_PER_CHAT_LIMIT = 100
+SYNC_MAX_PER_CHAT_LIMIT = 500
+
+# Mensajes por chat en la precarga de /messages/recent
+RECENT_PER_CHAT_LIMIT = 20
+RECENT_MAX_PER_CHAT_LIMIT = 100
+
+# Búsqueda de texto completo: configuración de Postgres usada por la columna
+# content_tsv (cambiarla exige recrear la columna) y tamaño de página
+SEARCH_CONFIG = "spanish"
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# Exportación: filas que el cursor de servidor trae por viaje a la base de datos y
+# exportaciones simultáneas. Cada una retiene una conexión del pool (maxconn=10)
+# mientras dura la descarga, así que el límite deja conexiones libres para el resto
+EXPORT_FETCH_SIZE = int(os.environ.get("EXPORT_FETCH_SIZE", 1000))
+MAX_CONCURRENT_EXPORTS = int(os.environ.get("MAX_CONCURRENT_EXPORTS", 3))
+EXPORT_RETRY_AFTER_SECONDS = 5
+
+# Caché en memoria de membresías. Los participantes los modifica el servicio de
+# chats, así que los cambios se reflejan aquí al expirar el TTL
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", 10))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 10000))
+
 if not DB_PASSWORD:
     raise ValueError("DB_PASSWORD debe estar configurada en las variables de entorno")
 
@@ -57,48 +97,207 @@ def return_db_connection(conn):
     except Exception as e:
         logger.error(f"Error devolviendo conexión al pool: {e}")
 
-def get_user_by_id(user_id):
-    conn = None
+# Numera por (timestamp, id) los mensajes sin seq, a continuación de la secuencia que ya
+# tenga su chat
+SEQ_BACKFILL = """
+    WITH numbered AS (
+        SELECT id, chat_id,
+               row_number() OVER (PARTITION BY chat_id ORDER BY timestamp, id) AS position
+        FROM messages
+        WHERE seq IS NULL
+    ), base AS (
+        SELECT m.chat_id, max(m.seq) AS max_seq
+        FROM messages m
+        WHERE m.seq IS NOT NULL
+          AND m.chat_id IN (SELECT chat_id FROM numbered)
+        GROUP BY m.chat_id
+    )
+    UPDATE messages m
+    SET seq = COALESCE(b.max_seq, 0) + n.position
+    FROM numbered n
+    LEFT JOIN base b ON b.chat_id = n.chat_id
+    WHERE m.id = n.id
+"""
+
+# Migraciones (common/migrations.py). Las de numeración por chat van en pasos cortos para
+# no ordenar mal los mensajes durante un despliegue gradual, en el que instancias
+# anteriores siguen insertando filas sin seq hasta que se retiran
+MIGRATIONS = [
+    # Resumen del último mensaje en la fila del chat, mantenido al escribir (la misma
+    # migración la declara el servicio de chats; se aplica una sola vez)
+    ("chats_last_message_columns", [
+        """
+        ALTER TABLE chats
+            ADD COLUMN IF NOT EXISTS last_message_id INTEGER,
+            ADD COLUMN IF NOT EXISTS last_message_preview TEXT,
+            ADD COLUMN IF NOT EXISTS last_message_sender_id INTEGER,
+            ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP
+        """,
+    ]),
+    # El historial pagina por seq y el inbox lee el resumen de la fila del chat: el
+    # índice por (chat_id, timestamp) ya no se consulta y solo encarecía cada envío
+    ("messages_drop_timestamp_index", [
+        """
+        DROP INDEX IF EXISTS idx_messages_chat_timestamp_id
+        """,
+    ]),
+    # Número de secuencia por chat, asignado al insertar bajo el bloqueo de la fila
+    # del chat (chats.last_seq guarda el último asignado)
+    ("messages_seq_columns", [
+        """
+        ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_seq BIGINT NOT NULL DEFAULT 0
+        """,
+        """
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS seq BIGINT
+        """,
+    ]),
+    # Relleno de los mensajes existentes sin bloquear la tabla: las instancias
+    # anteriores pueden seguir insertando mientras tanto
+    ("messages_seq_backfill", [SEQ_BACKFILL]),
+    ("messages_seq_index", [
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_seq
+        ON messages (chat_id, seq)
+        """,
+    ]),
+    # Paso corto con las inserciones bloqueadas: se numeran las filas que llegaron durante
+    # el relleno, se sincroniza last_seq y desde ese momento un trigger da seq, del mismo
+    # contador, a las filas que inserten las instancias anteriores. Así ninguna fila
+    # anterior queda numerada después de una escrita por este código
+    ("messages_seq_trigger", [
+        """
+        LOCK TABLE messages IN SHARE ROW EXCLUSIVE MODE
+        """,
+        SEQ_BACKFILL,
+        """
+        UPDATE chats c
+        SET last_seq = s.max_seq
+        FROM (
+            SELECT chat_id, max(seq) AS max_seq
+            FROM messages
+            GROUP BY chat_id
+        ) s
+        WHERE c.id = s.chat_id AND s.max_seq > c.last_seq
+        """,
+        """
+        CREATE OR REPLACE FUNCTION messages_assign_seq() RETURNS trigger AS $$
+        BEGIN
+            UPDATE chats SET last_seq = last_seq + 1
+            WHERE id = NEW.chat_id
+            RETURNING last_seq INTO NEW.seq;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DROP TRIGGER IF EXISTS trg_messages_assign_seq ON messages
+        """,
+        """
+        CREATE TRIGGER trg_messages_assign_seq
+        BEFORE INSERT ON messages
+        FOR EACH ROW WHEN (NEW.seq IS NULL)
+        EXECUTE FUNCTION messages_assign_seq()
+        """,
+    ]),
+    ("messages_last_message_summary", [
+        f"""
+        UPDATE chats c
+        SET (last_message_id, last_message_preview, last_message_sender_id, last_message_at) = (
+            SELECT m.id, LEFT(m.content, {LAST_MESSAGE_PREVIEW_LENGTH}), m.sender_id, m.timestamp
+            FROM messages m
+            WHERE m.chat_id = c.id
+            ORDER BY m.seq DESC
+            LIMIT 1
+        )
+        WHERE c.last_message_id IS NULL
+          AND EXISTS (SELECT 1 FROM messages m WHERE m.chat_id = c.id)
+        """,
+    ]),
+    # Índice invertido para la búsqueda: Postgres mantiene la columna generada en cada
+    # INSERT/UPDATE y el GIN (con fastupdate) acumula las altas en su lista pendiente,
+    # así que el envío de mensajes no hace trabajo extra en la aplicación
+    ("messages_search", [
+        f"""
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', COALESCE(content, ''))) STORED
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_content_tsv
+        ON messages USING GIN (content_tsv)
+        """,
+    ]),
+]
+
+RUNNING_MIGRATIONS = __name__ == '__main__' and sys.argv[1:2] == ['migrate']
+check_migrations(db_pool, MIGRATIONS, RUNNING_MIGRATIONS)
+
+membership_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+
+# Tokens emitidos por el servicio de auth (common/tokens.py). Con AUTH_REQUIRED
+# desactivado las solicitudes sin token se siguen aceptando
+AUTH_SECRET = os.environ.get("AUTH_SECRET", "")
+AUTH_REQUIRED = os.environ.get("AUTH_REQUIRED", "false").lower() == "true"
+PUBLIC_ENDPOINTS = {"index", "health_check", "cache_stats"}
+
+install_token_auth(app, AUTH_SECRET, AUTH_REQUIRED, PUBLIC_ENDPOINTS)
+
+def encode_cursor(seq):
+    raw = f"seq|{seq}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT id, username, first_name, last_name, 
-                   is_active, created_at
-            FROM users 
-            WHERE id = %s AND is_active = true
-        """, (user_id,))
-        row = cur.fetchone()
-        cur.close()
-        return row
-    except Exception as e:
-        logger.error(f"Error en get_user_by_id: {e}")
-        return None
-    finally:
-        if conn:
-            return_db_connection(conn)
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        prefix, seq = raw.split("|", 1)
+        if prefix != "seq":
+            raise ValueError(raw)
+        return int(seq)
+    except Exception:
+        raise ValueError("Cursor inválido")
 
-def get_chat_by_id(chat_id):
-    conn = None
+def encode_sync_cursor(positions):
+    raw = json.dumps(positions, separators=(",", ":"), sort_keys=True)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_sync_cursor(cursor):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT id, name, created_at, updated_at, is_active
-            FROM chats 
-            WHERE id = %s AND is_active = true
-        """, (chat_id,))
-        chat_data = cur.fetchone()
-        cur.close()
-        return chat_data
-    except Exception as e:
-        logger.error(f"Error en get_chat_by_id: {e}")
-        return None
-    finally:
-        if conn:
-            return_db_connection(conn)
+        positions = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return {str(chat_id): int(seq) for chat_id, seq in positions.items()}
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+def encode_search_cursor(rank, message_id):
+    raw = f"{rank!r}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_search_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        rank, message_id = raw.split("|", 1)
+        return float(rank), int(message_id)
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+def serialize_message(message_data):
+    return {
+        "message_id": message_data["id"],
+        "sender_id": message_data["sender_id"],
+        "chat_id": message_data["chat_id"],
+        "content": message_data["content"],
+        "timestamp": message_data["timestamp"].isoformat(),
+        "seq": message_data["seq"],
+        # sender es None si el usuario fue eliminado
+        "sender": {
+            "user_id": message_data["sender_id"],
+            "username": message_data["username"],
+            "first_name": message_data["first_name"],
+            "last_name": message_data["last_name"]
+        } if message_data["username"] else None
+    }
 
 def user_is_in_chat(user_id, chat_id):
+    if membership_cache.get((user_id, chat_id)):
+        return True
     conn = None
     try:
         conn = get_db_connection()
@@ -109,6 +308,8 @@ def user_is_in_chat(user_id, chat_id):
         """, (user_id, chat_id))
         result = cur.fetchone()
         cur.close()
+        if result is not None:
+            membership_cache.set((user_id, chat_id), True)
         return result is not None
     except Exception as e:
         logger.error(f"Error en user_is_in_chat: {e}")
@@ -123,26 +324,68 @@ def create_message_in_db(sender_id, chat_id, content):
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Insertar mensaje
+        # Validar remitente, chat y membresía, insertar el mensaje y actualizar el
+        # timestamp del chat en una sola sentencia (un único viaje a la base de datos).
+        # Si alguna validación falla no se inserta nada y las banderas indican cuál
         cur.execute("""
-            INSERT INTO messages (sender_id, chat_id, content, timestamp)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id, sender_id, chat_id, content, timestamp
-        """, (sender_id, chat_id, content, datetime.utcnow()))
+            WITH sender AS (
+                SELECT id, username, first_name, last_name
+                FROM users
+                WHERE id = %(sender_id)s AND is_active = true
+            ), chat AS (
+                SELECT id
+                FROM chats
+                WHERE id = %(chat_id)s AND is_active = true
+            ), membership AS (
+                SELECT 1
+                FROM user_chat
+                WHERE user_id = %(sender_id)s AND chat_id = %(chat_id)s
+            ), new_message AS (
+                -- El id se reserva antes para que un solo UPDATE del chat asigne el
+                -- siguiente seq y actualice el resumen del último mensaje
+                SELECT nextval(pg_get_serial_sequence('messages', 'id')) AS id
+                WHERE EXISTS (SELECT 1 FROM sender)
+                  AND EXISTS (SELECT 1 FROM chat)
+                  AND EXISTS (SELECT 1 FROM membership)
+            ), touched AS (
+                UPDATE chats c
+                SET last_seq = c.last_seq + 1,
+                    updated_at = %(now)s,
+                    last_message_id = n.id,
+                    last_message_preview = LEFT(%(content)s, %(preview_length)s),
+                    last_message_sender_id = %(sender_id)s,
+                    last_message_at = %(now)s
+                FROM new_message n
+                WHERE c.id = %(chat_id)s
+                RETURNING n.id, c.last_seq
+            ), inserted AS (
+                INSERT INTO messages (id, sender_id, chat_id, content, timestamp, seq)
+                SELECT t.id, %(sender_id)s, %(chat_id)s, %(content)s, %(now)s, t.last_seq
+                FROM touched t
+                RETURNING id, sender_id, chat_id, content, timestamp, seq
+            )
+            SELECT EXISTS (SELECT 1 FROM sender) AS sender_exists,
+                   EXISTS (SELECT 1 FROM chat) AS chat_exists,
+                   EXISTS (SELECT 1 FROM membership) AS is_member,
+                   i.id, i.sender_id, i.chat_id, i.content, i.timestamp, i.seq,
+                   s.username, s.first_name, s.last_name
+            FROM (SELECT 1) AS single_row
+            LEFT JOIN inserted i ON true
+            LEFT JOIN sender s ON true
+        """, {
+            "sender_id": sender_id,
+            "chat_id": chat_id,
+            "content": content,
+            "now": datetime.utcnow(),
+            "preview_length": LAST_MESSAGE_PREVIEW_LENGTH
+        })
         
         message_data = cur.fetchone()
-        
-        # Actualizar timestamp del chat
-        cur.execute("""
-            UPDATE chats 
-            SET updated_at = %s 
-            WHERE id = %s
-        """, (datetime.utcnow(), chat_id))
-        
         conn.commit()
         cur.close()
         
-        logger.info(f"Mensaje creado exitosamente: Usuario {sender_id} en chat {chat_id}")
+        if message_data["id"] is not None:
+            logger.info(f"Mensaje creado exitosamente: Usuario {sender_id} en chat {chat_id}")
         return message_data
         
     except Exception as e:
@@ -154,30 +397,363 @@ def create_message_in_db(sender_id, chat_id, content):
         if conn:
             return_db_connection(conn)
 
-def get_messages_for_chat(chat_id, limit=50, offset=0):
+def create_messages_batch_in_db(items):
+    # items: lista de dicts con sender_id, chat_id y content. Valida todas las parejas
+    # (remitente, chat) con una consulta, inserta los válidos con un INSERT multi-fila,
+    # actualiza updated_at y el resumen del último mensaje una vez por chat y
+    # confirma una sola vez.
+    # Devuelve una lista paralela a items con la fila creada o el código de error
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT m.id, m.sender_id, m.chat_id, m.content, m.timestamp,
-                   u.username, u.first_name, u.last_name
-            FROM messages m
-            LEFT JOIN users u ON m.sender_id = u.id
-            WHERE m.chat_id = %s
-            ORDER BY m.timestamp DESC
-            LIMIT %s OFFSET %s
-        """, (chat_id, limit, offset))
+        
+        pairs = list({(item["sender_id"], item["chat_id"]) for item in items})
+        checks = execute_values(cur, """
+            SELECT p.user_id, p.chat_id,
+                   u.id IS NOT NULL AS sender_exists,
+                   c.id IS NOT NULL AS chat_exists,
+                   uc.user_id IS NOT NULL AS is_member
+            FROM (VALUES %s) AS p(user_id, chat_id)
+            LEFT JOIN users u ON u.id = p.user_id AND u.is_active = true
+            LEFT JOIN chats c ON c.id = p.chat_id AND c.is_active = true
+            LEFT JOIN user_chat uc ON uc.user_id = p.user_id AND uc.chat_id = p.chat_id
+        """, pairs, template="(%s::integer, %s)", page_size=len(pairs), fetch=True)
+        checks = {(row["user_id"], row["chat_id"]): row for row in checks}
+        
+        results = []
+        valid = []
+        for item in items:
+            check = checks[(item["sender_id"], item["chat_id"])]
+            if not check["sender_exists"]:
+                results.append({"error": "sender_not_found"})
+            elif not check["chat_exists"]:
+                results.append({"error": "chat_not_found"})
+            elif not check["is_member"]:
+                results.append({"error": "not_member"})
+            else:
+                results.append(None)
+                valid.append(len(results) - 1)
+        
+        if valid:
+            now = datetime.utcnow()
+            # Reserva un rango de seq por chat con un solo UPDATE y numera los mensajes de
+            # cada chat en el orden del lote. Las filas de los chats se bloquean antes, en
+            # orden de id, para que dos lotes concurrentes no se bloqueen mutuamente: el
+            # UPDATE ... FROM (VALUES ...) no garantiza en qué orden las toma
+            counts = {}
+            for i in valid:
+                counts[items[i]["chat_id"]] = counts.get(items[i]["chat_id"], 0) + 1
+            cur.execute("SELECT id FROM chats WHERE id = ANY(%s) ORDER BY id FOR UPDATE",
+                        (sorted(counts),))
+            reserved = execute_values(cur, """
+                UPDATE chats c
+                SET last_seq = c.last_seq + v.count
+                FROM (VALUES %s) AS v(chat_id, count)
+                WHERE c.id = v.chat_id
+                RETURNING c.id, c.last_seq
+            """, sorted(counts.items()), template="(%s, %s::integer)", page_size=len(counts), fetch=True)
+            next_seq = {row["id"]: row["last_seq"] - counts[row["id"]] + 1 for row in reserved}
+            rows = []
+            # RETURNING no garantiza el orden de VALUES: cada fila creada vuelve a su
+            # posición en el lote por (chat_id, seq), que es único
+            positions = {}
+            for i in valid:
+                chat_id = items[i]["chat_id"]
+                rows.append((items[i]["sender_id"], chat_id, items[i]["content"], now, next_seq[chat_id]))
+                positions[(chat_id, next_seq[chat_id])] = i
+                next_seq[chat_id] += 1
+            created = execute_values(cur, """
+                INSERT INTO messages (sender_id, chat_id, content, timestamp, seq)
+                VALUES %s
+                RETURNING id, sender_id, chat_id, content, timestamp, seq
+            """, rows, page_size=len(valid), fetch=True)
+            last_by_chat = {}
+            for row in created:
+                results[positions[(row["chat_id"], row["seq"])]] = row
+                last = last_by_chat.get(row["chat_id"])
+                if last is None or row["seq"] > last["seq"]:
+                    last_by_chat[row["chat_id"]] = row
+            
+            execute_values(cur, """
+                UPDATE chats c
+                SET updated_at = v.timestamp,
+                    last_message_id = v.id,
+                    last_message_preview = LEFT(v.content, %s),
+                    last_message_sender_id = v.sender_id,
+                    last_message_at = v.timestamp
+                FROM (VALUES %%s) AS v(chat_id, id, content, sender_id, timestamp)
+                WHERE c.id = v.chat_id
+            """ % LAST_MESSAGE_PREVIEW_LENGTH,
+                [(row["chat_id"], row["id"], row["content"], row["sender_id"], row["timestamp"])
+                 for row in last_by_chat.values()],
+                template="(%s, %s::integer, %s, %s::integer, %s::timestamp)",
+                page_size=len(last_by_chat))
+        
+        conn.commit()
+        cur.close()
+        
+        logger.info(f"Lote de mensajes procesado: {len(valid)} de {len(items)} creados")
+        return results
+        
+    except Exception as e:
+        logger.error(f"Error en create_messages_batch_in_db: {e}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+def get_messages_for_chat(chat_id, limit=50, offset=0, before_seq=None, after_seq=None):
+    # Historial en orden de seq (no de timestamp, que depende del reloj de cada
+    # réplica). before_seq pagina hacia atrás y after_seq hacia adelante; se pide
+    # una fila extra para saber si hay más
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        if after_seq is not None:
+            cur.execute("""
+                SELECT m.id, m.sender_id, m.chat_id, m.content, m.timestamp, m.seq,
+                       u.username, u.first_name, u.last_name
+                FROM messages m
+                LEFT JOIN users u ON m.sender_id = u.id
+                WHERE m.chat_id = %s AND m.seq > %s
+                ORDER BY m.seq ASC
+                LIMIT %s
+            """, (chat_id, after_seq, limit + 1))
+            messages = cur.fetchall()
+            cur.close()
+            return messages[:limit], len(messages) > limit
+
+        if before_seq is not None:
+            cur.execute("""
+                SELECT m.id, m.sender_id, m.chat_id, m.content, m.timestamp, m.seq,
+                       u.username, u.first_name, u.last_name
+                FROM messages m
+                LEFT JOIN users u ON m.sender_id = u.id
+                WHERE m.chat_id = %s AND m.seq < %s
+                ORDER BY m.seq DESC
+                LIMIT %s
+            """, (chat_id, before_seq, limit + 1))
+        else:
+            cur.execute("""
+                SELECT m.id, m.sender_id, m.chat_id, m.content, m.timestamp, m.seq,
+                       u.username, u.first_name, u.last_name
+                FROM messages m
+                LEFT JOIN users u ON m.sender_id = u.id
+                WHERE m.chat_id = %s
+                ORDER BY m.seq DESC
+                LIMIT %s OFFSET %s
+            """, (chat_id, limit + 1, offset))
         
         messages = cur.fetchall()
         cur.close()
         
         # Revertir orden para tener los más antiguos primero
-        return list(reversed(messages))
+        return list(reversed(messages[:limit])), len(messages) > limit
         
     except Exception as e:
         logger.error(f"Error en get_messages_for_chat: {e}")
-        return []
+        return [], False
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+export_slots = threading.BoundedSemaphore(MAX_CONCURRENT_EXPORTS)
+
+def iter_chat_export(chat_id, after_seq=0):
+    # Recorre el historial con un cursor con nombre (del lado del servidor): Postgres
+    # envía EXPORT_FETCH_SIZE filas por viaje, así que la memoria no depende del tamaño
+    # del chat. La conexión queda tomada hasta que el generador termina o se cierra
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(name=f"export_{uuid.uuid4().hex}", cursor_factory=RealDictCursor)
+        cur.itersize = EXPORT_FETCH_SIZE
+        cur.execute("""
+            SELECT m.id, m.sender_id, m.chat_id, m.content, m.timestamp, m.seq,
+                   u.username, u.first_name, u.last_name
+            FROM messages m
+            LEFT JOIN users u ON m.sender_id = u.id
+            WHERE m.chat_id = %s AND m.seq > %s
+            ORDER BY m.seq ASC
+        """, (chat_id, after_seq))
+        for row in cur:
+            yield row
+    except Exception as e:
+        logger.error(f"Error en iter_chat_export: {e}")
+        raise
+    finally:
+        if cur is not None:
+            try:
+                cur.close()
+            except Exception:
+                pass
+        if conn:
+            # Cierra la transacción del cursor antes de devolver la conexión al pool
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            return_db_connection(conn)
+
+def get_chat_version(chat_id):
+    # Lectura fresca (sin caché) de lo que cambia con cada escritura en el chat; es
+    # la base del ETag del historial
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT id, last_seq, last_message_id, updated_at
+            FROM chats 
+            WHERE id = %s AND is_active = true
+        """, (chat_id,))
+        row = cur.fetchone()
+        cur.close()
+        return row
+    except Exception as e:
+        logger.error(f"Error en get_chat_version: {e}")
+        raise
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+def get_user_chat_positions(user_id):
+    # {chat_id: last_seq} de los chats activos del usuario, sin tocar la tabla de mensajes
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT c.id, c.last_seq
+            FROM user_chat uc
+            JOIN chats c ON c.id = uc.chat_id AND c.is_active = true
+            WHERE uc.user_id = %s
+        """, (user_id,))
+        positions = dict(cur.fetchall())
+        cur.close()
+        return positions
+    except Exception as e:
+        logger.error(f"Error en get_user_chat_positions: {e}")
+        raise
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+def get_messages_since(known_seqs, limit):
+    # known_seqs: {chat_id: seq}. Devuelve hasta limit + 1 mensajes por chat con seq
+    # mayor al conocido, en una sola consulta (un range scan de (chat_id, seq) por chat)
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        rows = execute_values(cur, f"""
+            SELECT m.id, m.sender_id, m.chat_id, m.content, m.timestamp, m.seq,
+                   u.username, u.first_name, u.last_name
+            FROM (VALUES %s) AS k(chat_id, known_seq)
+            CROSS JOIN LATERAL (
+                SELECT id, sender_id, chat_id, content, timestamp, seq
+                FROM messages
+                WHERE chat_id = k.chat_id AND seq > k.known_seq
+                ORDER BY seq ASC
+                LIMIT {int(limit) + 1}
+            ) m
+            LEFT JOIN users u ON m.sender_id = u.id
+            ORDER BY m.chat_id, m.seq
+        """, list(known_seqs.items()), template="(%s, %s::bigint)", page_size=len(known_seqs), fetch=True)
+        cur.close()
+        return rows
+    except Exception as e:
+        logger.error(f"Error en get_messages_since: {e}")
+        raise
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+def get_recent_messages(user_id, chat_ids, limit):
+    # Últimos limit mensajes de cada chat en una sola consulta. La membresía de todo
+    # el conjunto se comprueba con el mismo JOIN; chat_ids None significa todos los
+    # chats activos del usuario. Devuelve (filas, chats accesibles)
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            WITH allowed AS (
+                SELECT c.id AS chat_id, c.last_seq
+                FROM user_chat uc
+                JOIN chats c ON c.id = uc.chat_id AND c.is_active = true
+                WHERE uc.user_id = %(user_id)s
+                  AND (%(chat_ids)s::text[] IS NULL OR uc.chat_id = ANY(%(chat_ids)s::text[]))
+            )
+            SELECT a.chat_id AS allowed_chat_id, a.last_seq,
+                   m.id, m.sender_id, m.chat_id, m.content, m.timestamp, m.seq,
+                   u.username, u.first_name, u.last_name
+            FROM allowed a
+            LEFT JOIN LATERAL (
+                SELECT id, sender_id, chat_id, content, timestamp, seq
+                FROM messages
+                WHERE chat_id = a.chat_id
+                ORDER BY seq DESC
+                LIMIT %(limit)s
+            ) m ON true
+            LEFT JOIN users u ON m.sender_id = u.id
+            ORDER BY a.chat_id, m.seq
+        """, {"user_id": user_id, "chat_ids": chat_ids, "limit": limit})
+        rows = cur.fetchall()
+        cur.close()
+        allowed = {row["allowed_chat_id"]: row["last_seq"] for row in rows}
+        return [row for row in rows if row["id"] is not None], allowed
+    except Exception as e:
+        logger.error(f"Error en get_recent_messages: {e}")
+        raise
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+def search_messages(user_id, query, limit, chat_id=None, after=None):
+    # Coincidencias en los chats activos del usuario ordenadas por relevancia (rank, id
+    # descendentes). after es el cursor (rank, id) de la última fila de la página anterior
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(f"""
+            WITH query AS (
+                SELECT websearch_to_tsquery('{SEARCH_CONFIG}', %(query)s) AS q
+            ), matches AS (
+                SELECT m.id, m.sender_id, m.chat_id, m.content, m.timestamp, m.seq,
+                       ts_rank(m.content_tsv, query.q) AS rank
+                FROM query, messages m
+                JOIN user_chat uc ON uc.chat_id = m.chat_id AND uc.user_id = %(user_id)s
+                JOIN chats c ON c.id = m.chat_id AND c.is_active = true
+                WHERE m.content_tsv @@ query.q
+                  AND (%(chat_id)s::text IS NULL OR m.chat_id = %(chat_id)s)
+            )
+            SELECT mt.*, u.username, u.first_name, u.last_name
+            FROM matches mt
+            LEFT JOIN users u ON mt.sender_id = u.id
+            WHERE %(after_rank)s::real IS NULL OR (mt.rank, mt.id) < (%(after_rank)s::real, %(after_id)s)
+            ORDER BY mt.rank DESC, mt.id DESC
+            LIMIT %(limit)s
+        """, {
+            "query": query,
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "after_rank": after[0] if after else None,
+            "after_id": after[1] if after else None,
+            "limit": limit + 1
+        })
+        rows = cur.fetchall()
+        cur.close()
+        return rows[:limit], len(rows) > limit
+    except Exception as e:
+        logger.error(f"Error en search_messages: {e}")
+        raise
     finally:
         if conn:
             return_db_connection(conn)
@@ -188,7 +764,7 @@ def get_message_by_id(message_id):
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute("""
-            SELECT m.id, m.sender_id, m.chat_id, m.content, m.timestamp,
+            SELECT m.id, m.sender_id, m.chat_id, m.content, m.timestamp, m.seq,
                    u.username, u.first_name, u.last_name
             FROM messages m
             LEFT JOIN users u ON m.sender_id = u.id
@@ -211,11 +787,33 @@ def delete_message_in_db(message_id):
     try:
         conn = get_db_connection()
         cur = conn.cursor()
+        # Si era el último mensaje del chat, el resumen pasa al anterior en la misma sentencia
         cur.execute("""
-            DELETE FROM messages 
-            WHERE id = %s
-            RETURNING id
-        """, (message_id,))
+            WITH deleted AS (
+                DELETE FROM messages 
+                WHERE id = %(message_id)s
+                RETURNING id, chat_id
+            ), refreshed AS (
+                UPDATE chats c
+                SET updated_at = %(now)s,
+                    (last_message_id, last_message_preview, last_message_sender_id, last_message_at) = (
+                    SELECT m.id, LEFT(m.content, %(preview_length)s), m.sender_id, m.timestamp
+                    FROM messages m
+                    WHERE m.chat_id = c.id AND m.id <> d.id
+                    ORDER BY m.seq DESC
+                    LIMIT 1
+                )
+                FROM deleted d
+                WHERE c.id = d.chat_id AND c.last_message_id = d.id
+            ), touched AS (
+                -- Si no era el último solo cambia updated_at (invalida los ETag del chat)
+                UPDATE chats c
+                SET updated_at = %(now)s
+                FROM deleted d
+                WHERE c.id = d.chat_id AND c.last_message_id IS DISTINCT FROM d.id
+            )
+            SELECT id FROM deleted
+        """, {"message_id": message_id, "preview_length": LAST_MESSAGE_PREVIEW_LENGTH, "now": datetime.utcnow()})
         
         deleted_id = cur.fetchone()
         conn.commit()
@@ -242,9 +840,15 @@ def index():
         "version": "1.0.0",
         "endpoints": [
             "POST /messages - Enviar nuevo mensaje",
-            "GET /chats/<chat_id>/messages - Obtener mensajes de un chat",
+            "POST /messages/batch - Enviar muchos mensajes en un solo commit",
+            "GET /chats/<chat_id>/messages - Obtener mensajes de un chat (cursores before/after o after_seq)",
+            "GET|POST /sync - Mensajes nuevos en todos los chats del usuario desde un cursor",
+            "GET|POST /messages/recent - Últimos mensajes de varios chats en una solicitud",
+            "GET /messages/search?q=&user_id= - Buscar en los mensajes de los chats del usuario",
+            "GET /chats/<chat_id>/export?user_id=&after_seq= - Exportar el historial completo (NDJSON en streaming)",
             "GET /messages/<message_id> - Obtener mensaje por ID",
             "DELETE /messages/<message_id> - Eliminar mensaje",
+            "GET /cache/stats - Estadísticas de la caché en memoria",
             "GET /health - Health check"
         ]
     })
@@ -253,41 +857,40 @@ def index():
 def send_message():
     try:
         data = request.json
-        sender_id = data.get("sender_id")
+        sender_id = data.get("sender_id") or g.auth_user_id
         chat_id = data.get("chat_id")
         content = data.get("content", "").strip()
         
         if not sender_id or not chat_id or not content:
             return jsonify({"error": "sender_id, chat_id y content son requeridos"}), 400
         
-        # Verificar que el usuario existe
-        sender = get_user_by_id(sender_id)
-        if not sender:
+        if identity_mismatch(sender_id):
+            return jsonify({"error": "sender_id no coincide con el usuario autenticado"}), 403
+        
+        # Crear mensaje validando remitente, chat y membresía en la misma sentencia
+        message_data = create_message_in_db(sender_id, chat_id, content)
+        
+        if not message_data["sender_exists"]:
             return jsonify({"error": "Usuario remitente no encontrado"}), 404
         
-        # Verificar que el chat existe
-        chat = get_chat_by_id(chat_id)
-        if not chat:
+        if not message_data["chat_exists"]:
             return jsonify({"error": "Chat no encontrado"}), 404
         
-        # Verificar que el usuario está en el chat
-        if not user_is_in_chat(sender_id, chat_id):
+        if not message_data["is_member"]:
             return jsonify({"error": "Usuario no pertenece al chat"}), 403
         
-        # Crear mensaje
-        message_data = create_message_in_db(sender_id, chat_id, content)
-        
         response_data = {
             "message_id": message_data["id"],
             "sender_id": message_data["sender_id"],
             "chat_id": message_data["chat_id"],
             "content": message_data["content"],
             "timestamp": message_data["timestamp"].isoformat(),
+            "seq": message_data["seq"],
             "sender": {
-                "user_id": sender["id"],
-                "username": sender["username"],
-                "first_name": sender["first_name"],
-                "last_name": sender["last_name"]
+                "user_id": message_data["sender_id"],
+                "username": message_data["username"],
+                "first_name": message_data["first_name"],
+                "last_name": message_data["last_name"]
             }
         }
         
@@ -300,59 +903,373 @@ def send_message():
         logger.error(f"Error enviando mensaje: {e}")
         return jsonify({"error": "Error interno del servidor"}), 500
 
+@app.route('/messages/batch', methods=['POST'])
+def send_messages_batch():
+    try:
+        data = request.json or {}
+        raw_items = data.get("messages")
+        
+        if not isinstance(raw_items, list) or not raw_items:
+            return jsonify({"error": "messages debe ser una lista no vacía"}), 400
+        
+        if len(raw_items) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"Máximo {MAX_BATCH_SIZE} mensajes por lote"}), 400
+        
+        # Validación de forma por elemento; solo los bien formados llegan a la base de datos
+        results = [None] * len(raw_items)
+        items = []
+        positions = []
+        for index, raw in enumerate(raw_items):
+            raw = raw if isinstance(raw, dict) else {}
+            content = str(raw.get("content") or "").strip()
+            try:
+                sender_id = int(raw.get("sender_id") or g.auth_user_id)
+            except (TypeError, ValueError):
+                sender_id = None
+            chat_id = raw.get("chat_id")
+            if not sender_id or not chat_id or not content:
+                results[index] = {"index": index, "status": "error", "error": "invalid_message"}
+                continue
+            if identity_mismatch(sender_id):
+                results[index] = {"index": index, "status": "error", "error": "forbidden"}
+                continue
+            items.append({"sender_id": sender_id, "chat_id": str(chat_id), "content": content})
+            positions.append(index)
+        
+        if items:
+            for index, outcome in zip(positions, create_messages_batch_in_db(items)):
+                if "error" in outcome:
+                    results[index] = {"index": index, "status": "error", "error": outcome["error"]}
+                else:
+                    results[index] = {
+                        "index": index,
+                        "status": "created",
+                        "message_id": outcome["id"],
+                        "chat_id": outcome["chat_id"],
+                        "timestamp": outcome["timestamp"].isoformat(),
+                        "seq": outcome["seq"]
+                    }
+        
+        created = sum(1 for result in results if result["status"] == "created")
+        return jsonify({
+            "message": "Lote procesado",
+            "created": created,
+            "failed": len(results) - created,
+            "results": results
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error enviando lote de mensajes: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
+
 @app.route('/chats/<chat_id>/messages', methods=['GET'])
 def get_chat_messages(chat_id):
     try:
-        # Parámetros de paginación
+        # Parámetros de paginación: before/after (cursores) u offset por compatibilidad
         limit = request.args.get('limit', 50, type=int)
         offset = request.args.get('offset', 0, type=int)
-        user_id = request.args.get('user_id', type=int)
+        user_id = request.args.get('user_id', type=int) or g.auth_user_id
+        before = request.args.get('before')
+        after = request.args.get('after')
+        after_seq = request.args.get('after_seq', type=int)
+        
+        if sum(1 for param in (before, after, after_seq) if param is not None) > 1:
+            return jsonify({"error": "Use solo uno de before, after o after_seq"}), 400
+        try:
+            before_seq = decode_cursor(before) if before else None
+            if after:
+                after_seq = decode_cursor(after)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        if identity_mismatch(user_id):
+            return jsonify({"error": "user_id no coincide con el usuario autenticado"}), 403
         
-        # Verificar que el chat existe
-        chat = get_chat_by_id(chat_id)
-        if not chat:
+        # Verificar que el chat existe (lectura fresca: también da la versión para el ETag)
+        version = get_chat_version(chat_id)
+        if not version:
             return jsonify({"error": "Chat no encontrado"}), 404
         
         # Si se proporciona user_id, verificar que está en el chat
         if user_id and not user_is_in_chat(user_id, chat_id):
             return jsonify({"error": "Usuario no pertenece al chat"}), 403
         
+        # La página solo cambia si el chat recibió escrituras (seq, último mensaje,
+        # updated_at) o si cambian los parámetros; en ese caso no se consulta nada más
+        updated_at = version['updated_at'].isoformat() if version['updated_at'] else ''
+        etag = hashlib.md5(
+            f"{version['last_seq']}|{version['last_message_id']}|{updated_at}|"
+            f"{request.query_string.decode('utf-8')}".encode('utf-8')
+        ).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+        
         # Obtener mensajes
-        messages_data = get_messages_for_chat(chat_id, limit, offset)
+        messages_data, has_more = get_messages_for_chat(chat_id, limit, offset, before_seq, after_seq)
         
-        messages = []
-        for message_data in messages_data:
-            message_dict = {
-                "message_id": message_data["id"],
-                "sender_id": message_data["sender_id"],
-                "chat_id": message_data["chat_id"],
-                "content": message_data["content"],
-                "timestamp": message_data["timestamp"].isoformat()
-            }
-            
-            # Agregar información del remitente si está disponible
-            if message_data["username"]:
-                message_dict["sender"] = {
-                    "user_id": message_data["sender_id"],
-                    "username": message_data["username"],
-                    "first_name": message_data["first_name"],
-                    "last_name": message_data["last_name"]
-                }
+        messages = [serialize_message(message_data) for message_data in messages_data]
+        
+        # next_cursor continúa en la misma dirección: hacia atrás salvo que se pidiera after/after_seq
+        next_cursor = None
+        if has_more and messages_data:
+            edge = messages_data[-1] if after_seq is not None else messages_data[0]
+            next_cursor = encode_cursor(edge["seq"])
+        
+        response = jsonify({
+            "chat_id": chat_id,
+            "messages": messages,
+            "total": len(messages),
+            "limit": limit,
+            "offset": offset,
+            "next_cursor": next_cursor,
+            "last_seq": messages_data[-1]["seq"] if messages_data else after_seq,
+            "has_more": has_more
+        })
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response, 200
+        
+    except Exception as e:
+        logger.error(f"Error obteniendo mensajes del chat: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
+
+@app.route('/sync', methods=['GET', 'POST'])
+def sync_messages():
+    try:
+        # El cursor es el mapa {chat_id: seq} de lo que el cliente ya tiene; con POST
+        # va en el cuerpo para usuarios con muchos chats
+        params = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+        try:
+            user_id = int(params.get("user_id") or g.auth_user_id)
+            limit = int(params.get("limit") or SYNC_PER_CHAT_LIMIT)
+        except (TypeError, ValueError):
+            return jsonify({"error": "user_id es requerido y debe ser entero"}), 400
+        limit = max(1, min(limit, SYNC_MAX_PER_CHAT_LIMIT))
+        cursor = params.get("cursor")
+        try:
+            known = decode_sync_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        if identity_mismatch(user_id):
+            return jsonify({"error": "user_id no coincide con el usuario autenticado"}), 403
+        
+        positions = get_user_chat_positions(user_id)
+        
+        # Sin cursor solo se entrega la posición actual; el historial previo se pide
+        # con GET /chats/<chat_id>/messages
+        if known is None:
+            return jsonify({
+                "user_id": user_id,
+                "cursor": encode_sync_cursor(positions),
+                "chats": [],
+                "removed_chat_ids": [],
+                "has_more": False
+            }), 200
+        
+        # chats.last_seq descarta sin leer mensajes los chats que no cambiaron
+        changed = {
+            chat_id: known.get(chat_id, 0)
+            for chat_id, last_seq in positions.items()
+            if last_seq > known.get(chat_id, 0)
+        }
+        rows_by_chat = {}
+        if changed:
+            for row in get_messages_since(changed, limit):
+                rows_by_chat.setdefault(row["chat_id"], []).append(row)
+        
+        chats = []
+        new_positions = {}
+        for chat_id, last_seq in positions.items():
+            if chat_id not in changed:
+                new_positions[chat_id] = max(last_seq, known.get(chat_id, 0))
+                continue
+            rows = rows_by_chat.get(chat_id, [])
+            chat_has_more = len(rows) > limit
+            rows = rows[:limit]
+            # Si quedan mensajes se avanza hasta el último entregado; si no, hasta
+            # last_seq (los huecos de mensajes eliminados no se vuelven a pedir)
+            if chat_has_more:
+                new_positions[chat_id] = rows[-1]["seq"]
             else:
-                message_dict["sender"] = None  # Usuario eliminado
-            
+                new_positions[chat_id] = max([last_seq] + [row["seq"] for row in rows])
+            chats.append({
+                "chat_id": chat_id,
+                "last_seq": new_positions[chat_id],
+                "messages": [serialize_message(row) for row in rows],
+                "has_more": chat_has_more
+            })
+        
+        return jsonify({
+            "user_id": user_id,
+            "cursor": encode_sync_cursor(new_positions),
+            "chats": chats,
+            "removed_chat_ids": sorted(chat_id for chat_id in known if chat_id not in positions),
+            "has_more": any(chat["has_more"] for chat in chats)
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error sincronizando mensajes: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
+
+@app.route('/messages/recent', methods=['GET', 'POST'])
+def get_recent_messages_endpoint():
+    try:
+        # Precarga de arranque: últimos mensajes de muchos chats en una solicitud.
+        # chat_ids es una lista JSON (POST) o "a,b,c" (GET); sin chat_ids se usan
+        # todos los chats del usuario
+        params = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+        try:
+            user_id = int(params.get("user_id") or g.auth_user_id)
+            limit = int(params.get("limit") or RECENT_PER_CHAT_LIMIT)
+        except (TypeError, ValueError):
+            return jsonify({"error": "user_id es requerido y debe ser entero"}), 400
+        limit = max(1, min(limit, RECENT_MAX_PER_CHAT_LIMIT))
+        
+        raw_chat_ids = params.get("chat_ids")
+        chat_ids = None
+        if raw_chat_ids:
+            if isinstance(raw_chat_ids, str):
+                raw_chat_ids = raw_chat_ids.split(",")
+            if not isinstance(raw_chat_ids, list):
+                return jsonify({"error": "chat_ids debe ser una lista"}), 400
+            chat_ids = list(dict.fromkeys(str(chat_id).strip() for chat_id in raw_chat_ids if str(chat_id).strip()))
+            if len(chat_ids) > MAX_BATCH_SIZE:
+                return jsonify({"error": f"Máximo {MAX_BATCH_SIZE} chats por solicitud"}), 400
+        
+        if identity_mismatch(user_id):
+            return jsonify({"error": "user_id no coincide con el usuario autenticado"}), 403
+        
+        rows, allowed = get_recent_messages(user_id, chat_ids, limit)
+        
+        messages_by_chat = {chat_id: [] for chat_id in allowed}
+        for row in rows:
+            messages_by_chat[row["chat_id"]].append(serialize_message(row))
+        
+        return jsonify({
+            "user_id": user_id,
+            "limit": limit,
+            "chats": [
+                {
+                    "chat_id": chat_id,
+                    "last_seq": allowed[chat_id],
+                    "messages": messages
+                }
+                for chat_id, messages in messages_by_chat.items()
+            ],
+            # Chats inexistentes, inactivos o a los que el usuario no pertenece
+            "unavailable_chat_ids": [chat_id for chat_id in (chat_ids or []) if chat_id not in allowed]
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error obteniendo mensajes recientes: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
+
+@app.route('/chats/<chat_id>/export', methods=['GET'])
+def export_chat_messages(chat_id):
+    try:
+        user_id = request.args.get('user_id', type=int) or g.auth_user_id
+        after_seq = request.args.get('after_seq', 0, type=int)
+        cursor = request.args.get('cursor')
+        
+        if not user_id:
+            return jsonify({"error": "user_id es requerido"}), 400
+        try:
+            if cursor:
+                after_seq = decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        if identity_mismatch(user_id):
+            return jsonify({"error": "user_id no coincide con el usuario autenticado"}), 403
+        
+        if not get_chat_version(chat_id):
+            return jsonify({"error": "Chat no encontrado"}), 404
+        if not user_is_in_chat(user_id, chat_id):
+            return jsonify({"error": "Usuario no pertenece al chat"}), 403
+        
+        # Sin hueco libre se responde enseguida en lugar de esperar por una conexión
+        if not export_slots.acquire(blocking=False):
+            response = jsonify({"error": "Demasiadas exportaciones en curso, reintente más tarde"})
+            response.headers["Retry-After"] = str(EXPORT_RETRY_AFTER_SECONDS)
+            return response, 503
+        
+        # NDJSON: una línea por mensaje en orden de seq y una línea final con el total.
+        # Si el stream se corta, el cliente reanuda con after_seq = último seq recibido
+        def generate():
+            count = 0
+            last_seq = after_seq
+            try:
+                for row in iter_chat_export(chat_id, after_seq):
+                    count += 1
+                    last_seq = row["seq"]
+                    yield json.dumps(serialize_message(row), ensure_ascii=False) + "\n"
+            except Exception:
+                yield json.dumps({"error": "Exportación interrumpida", "count": count,
+                                  "last_seq": last_seq, "next_cursor": encode_cursor(last_seq)}) + "\n"
+                return
+            yield json.dumps({"export_complete": True, "chat_id": chat_id, "count": count,
+                              "last_seq": last_seq}) + "\n"
+        
+        try:
+            response = app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+            # El servidor cierra la respuesta al terminar, al fallar o si el cliente se
+            # desconecta, incluso antes de empezar a iterar el generador
+            response.call_on_close(export_slots.release)
+        except Exception:
+            export_slots.release()
+            raise
+        response.headers["Cache-Control"] = "no-store"
+        response.headers["Content-Disposition"] = f'attachment; filename="chat-{chat_id}.ndjson"'
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error exportando chat: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
+
+@app.route('/messages/search', methods=['GET'])
+def search_messages_endpoint():
+    try:
+        query = request.args.get('q', '').strip()
+        user_id = request.args.get('user_id', type=int) or g.auth_user_id
+        chat_id = request.args.get('chat_id')
+        limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        
+        if not query:
+            return jsonify({"error": "q es requerido"}), 400
+        if not user_id:
+            return jsonify({"error": "user_id es requerido"}), 400
+        try:
+            after = decode_search_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        if identity_mismatch(user_id):
+            return jsonify({"error": "user_id no coincide con el usuario autenticado"}), 403
+        
+        rows, has_more = search_messages(user_id, query, limit, chat_id, after)
+        
+        messages = []
+        for row in rows:
+            message_dict = serialize_message(row)
+            message_dict["rank"] = row["rank"]
             messages.append(message_dict)
         
         return jsonify({
-            "chat_id": chat_id,
+            "query": query,
+            "user_id": user_id,
             "messages": messages,
             "total": len(messages),
-            "limit": limit,
-            "offset": offset
+            "next_cursor": encode_search_cursor(rows[-1]["rank"], rows[-1]["id"]) if has_more else None,
+            "has_more": has_more
         }), 200
         
     except Exception as e:
-        logger.error(f"Error obteniendo mensajes del chat: {e}")
+        logger.error(f"Error buscando mensajes: {e}")
         return jsonify({"error": "Error interno del servidor"}), 500
 
 @app.route('/messages/<int:message_id>', methods=['GET'])
@@ -368,7 +1285,8 @@ def get_message(message_id):
             "sender_id": message_data["sender_id"],
             "chat_id": message_data["chat_id"],
             "content": message_data["content"],
-            "timestamp": message_data["timestamp"].isoformat()
+            "timestamp": message_data["timestamp"].isoformat(),
+            "seq": message_data["seq"]
         }
         
         # Agregar información del remitente si está disponible
@@ -396,6 +1314,10 @@ def delete_message(message_id):
         if not message_data:
             return jsonify({"error": "Mensaje no encontrado"}), 404
         
+        # Con token, solo el remitente puede eliminar su mensaje
+        if identity_mismatch(message_data["sender_id"]):
+            return jsonify({"error": "No autorizado para eliminar este mensaje"}), 403
+        
         # Eliminar mensaje
         deleted = delete_message_in_db(message_id)
         
@@ -411,6 +1333,12 @@ def delete_message(message_id):
         logger.error(f"Error eliminando mensaje: {e}")
         return jsonify({"error": "Error interno del servidor"}), 500
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "memberships": membership_cache.stats()
+    }), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     try:
@@ -451,6 +1379,9 @@ def internal_error(error):
     return jsonify({"error": "Error interno del servidor"}), 500
 
 if __name__ == '__main__':
+    if RUNNING_MIGRATIONS:
+        run_migrations(db_pool, MIGRATIONS)
+        sys.exit(0)
     port = int(os.environ.get('PORT', 5002))
     debug = os.environ.get('FLASK_ENV') == 'development'
     app.run(host='0.0.0.0', port=port, debug=debug)
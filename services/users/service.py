@@ -1,15 +1,22 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 import os
+import sys
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from psycopg2 import pool
-import bcrypt
 import re
 from datetime import datetime
 import logging
+import base64
+import multiprocessing
 from dotenv import load_dotenv
 
+from common.activity import ActivityBuffer
+from common.flask_auth import install_token_auth, identity_mismatch
+from common.migrations import check_migrations, run_migrations
+from common.passwords import PasswordPool, PasswordPoolBusy, hash_password_worker
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -27,23 +34,48 @@ DB_USER = os.environ.get("DB_USER", "admin")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
 DB_NAME = os.environ.get("DB_NAME", "message-app-db")
 
+# Máximo de IDs por consulta en la búsqueda de usuarios en bloque
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 500))
+
+# bcrypt se ejecuta en un pool de procesos aparte (common.passwords); con más de
+# PASSWORD_QUEUE_SIZE tareas en espera se responde 503
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", os.cpu_count() or 2))
+PASSWORD_QUEUE_SIZE = int(os.environ.get("PASSWORD_QUEUE_SIZE", PASSWORD_WORKERS * 4))
+
+# Los procesos del pool (forkserver) vuelven a importar este archivo para encontrar
+# las funciones de trabajo: en ellos no se abre la DB, no se toca el esquema ni se
+# arrancan hilos ni pools
+PASSWORD_WORKER_PROCESS = __name__ == '__mp_main__' or multiprocessing.parent_process() is not None
+
+# Tamaño de página del directorio de usuarios
+DIRECTORY_PAGE_SIZE = 20
+DIRECTORY_MAX_PAGE_SIZE = 100
+
+# Última actividad (last_login) con escritura diferida: se acumula en memoria y
+# se vuelca con un solo UPDATE cada ACTIVITY_FLUSH_INTERVAL segundos
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", 5))
+ACTIVITY_MAX_PENDING = int(os.environ.get("ACTIVITY_MAX_PENDING", 10000))
+
 if not DB_PASSWORD:
     raise ValueError("DB_PASSWORD debe estar configurada en las variables de entorno")
 
-try:
-    db_pool = psycopg2.pool.ThreadedConnectionPool(
-        minconn=1,
-        maxconn=10,
-        host=DB_HOST,
-        port=DB_PORT,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        dbname=DB_NAME
-    )
-    logger.info("Pool de conexiones a DB creado correctamente")
-except Exception as e:
-    logger.error(f"Error creando pool de conexiones: {e}")
-    raise
+db_pool = None
+if not PASSWORD_WORKER_PROCESS:
+    try:
+        db_pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn=1,
+            maxconn=10,
+            host=DB_HOST,
+            port=DB_PORT,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            dbname=DB_NAME
+        )
+        logger.info("Pool de conexiones a DB creado correctamente")
+    except Exception as e:
+        logger.error(f"Error creando pool de conexiones: {e}")
+        raise
 
 def get_db_connection():
     try:
@@ -58,6 +90,55 @@ def return_db_connection(conn):
     except Exception as e:
         logger.error(f"Error devolviendo conexión al pool: {e}")
 
+# Migraciones (common/migrations.py), aplicadas con `python service.py migrate`
+MIGRATIONS = [
+    # Búsqueda por prefijo (sin distinguir mayúsculas) en el directorio de usuarios.
+    # El índice del nombre completo también cubre las búsquedas por nombre. El último
+    # da el orden y el cursor del directorio
+    ("users_directory_indexes", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_username_prefix
+        ON users (lower(username) text_pattern_ops)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_full_name_prefix
+        ON users (lower(first_name || ' ' || last_name) text_pattern_ops)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_last_name_prefix
+        ON users (lower(last_name) text_pattern_ops)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_username_id
+        ON users (username, id)
+        """,
+    ]),
+]
+
+RUNNING_MIGRATIONS = __name__ == '__main__' and sys.argv[1:2] == ['migrate']
+if not PASSWORD_WORKER_PROCESS:
+    check_migrations(db_pool, MIGRATIONS, RUNNING_MIGRATIONS)
+
+def encode_cursor(username, user_id):
+    raw = f"{username}|{user_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        username, user_id = raw.rsplit("|", 1)
+        return username, int(user_id)
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+# Tokens emitidos por el servicio de auth (common/tokens.py). Con AUTH_REQUIRED
+# desactivado las solicitudes sin token se siguen aceptando
+AUTH_SECRET = os.environ.get("AUTH_SECRET", "")
+AUTH_REQUIRED = os.environ.get("AUTH_REQUIRED", "false").lower() == "true"
+PUBLIC_ENDPOINTS = {"index", "health_check", "register"}
+
+install_token_auth(app, AUTH_SECRET, AUTH_REQUIRED, PUBLIC_ENDPOINTS)
+
 def validate_password_strength(password):
     if len(password) < 8:
         return False, "La contraseña debe tener al menos 8 caracteres"
@@ -76,13 +157,14 @@ def validate_password_strength(password):
     
     return True, "Contraseña válida"
 
+password_pool = None if PASSWORD_WORKER_PROCESS else PasswordPool(PASSWORD_WORKERS, PASSWORD_QUEUE_SIZE)
+
 def hash_password(password):
     if isinstance(password, bytes):
         password = password.decode('utf-8')
-    salt = bcrypt.gensalt()
-    password_bytes = password.encode('utf-8')
-    hashed = bcrypt.hashpw(password_bytes, salt)
-    return hashed.decode('utf-8')
+    hashed, elapsed_ms, waited_ms = password_pool.run(hash_password_worker, password, BCRYPT_ROUNDS)
+    logger.info(f"Hash bcrypt ({BCRYPT_ROUNDS} rondas): {elapsed_ms:.1f} ms de cálculo, {waited_ms:.1f} ms en cola")
+    return hashed
 
 def get_user_by_username(username):
     conn = None
@@ -126,7 +208,10 @@ def get_user_by_id(user_id):
         if conn:
             return_db_connection(conn)
 
-def get_all_users():
+def get_users_by_ids(user_ids):
+    # Resuelve muchos usuarios con una sola consulta sobre la clave primaria
+    if not user_ids:
+        return []
     conn = None
     try:
         conn = get_db_connection()
@@ -135,26 +220,64 @@ def get_all_users():
             SELECT id, username, first_name, last_name, 
                    email, is_active, created_at, last_login
             FROM users 
-            ORDER BY created_at DESC
-        """)
+            WHERE id = ANY(%s)
+        """, (list(user_ids),))
         rows = cur.fetchall()
         cur.close()
         return rows
     except Exception as e:
-        logger.error(f"Error en get_all_users: {e}")
-        return []
+        logger.error(f"Error en get_users_by_ids: {e}")
+        raise
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+def search_users_directory(query, limit, after=None):
+    # Página del directorio de usuarios activos ordenada por username. query filtra
+    # por prefijo de username, nombre completo o apellido; after es el cursor
+    # (username, id) de la última fila de la página anterior
+    conditions = ["is_active = true"]
+    params = []
+    if query:
+        pattern = query.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append("""(
+            lower(username) LIKE %s
+            OR lower(first_name || ' ' || last_name) LIKE %s
+            OR lower(last_name) LIKE %s
+        )""")
+        params.extend([pattern, pattern, pattern])
+    if after:
+        conditions.append("(username, id) > (%s, %s)")
+        params.extend(after)
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(f"""
+            SELECT id, username, first_name, last_name
+            FROM users
+            WHERE {" AND ".join(conditions)}
+            ORDER BY username, id
+            LIMIT %s
+        """, params + [limit + 1])
+        rows = cur.fetchall()
+        cur.close()
+        return rows[:limit], len(rows) > limit
+    except Exception as e:
+        logger.error(f"Error en search_users_directory: {e}")
+        raise
     finally:
         if conn:
             return_db_connection(conn)
 
 def create_user_in_db(username, password, first_name, last_name, email):
+    # El hash se calcula antes de tomar una conexión para no retenerla durante bcrypt
+    password_hash = hash_password(password)
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor()
         
-        password_hash = hash_password(password)
-        
         cur.execute("""
             INSERT INTO users (username, password_hash, first_name, last_name, email, is_active, created_at)
             VALUES (%s, %s, %s, %s, %s, %s, %s)
@@ -182,6 +305,10 @@ def create_user_in_db(username, password, first_name, last_name, email):
         if conn:
             return_db_connection(conn)
 
+activity_buffer = ActivityBuffer(db_pool, ACTIVITY_MAX_PENDING, ACTIVITY_FLUSH_INTERVAL)
+if not PASSWORD_WORKER_PROCESS:
+    activity_buffer.start()
+
 def activate_user_in_db(user_id):
     conn = None
     try:
@@ -194,6 +321,7 @@ def activate_user_in_db(user_id):
         """, (user_id,))
         conn.commit()
         cur.close()
+        activity_buffer.record(user_id)
         logger.info(f"Usuario activado: ID {user_id}")
     except Exception as e:
         logger.error(f"Error en activate_user_in_db: {e}")
@@ -210,7 +338,9 @@ def index():
         "message": "Users API - Servicio de gestión de usuarios",
         "version": "1.0.0",
         "endpoints": [
-            "GET /users - Listar todos los usuarios",
+            "GET /users?q=&limit=&cursor= - Directorio paginado con búsqueda por prefijo",
+            "GET /users?ids=1,2,3 - Obtener varios usuarios por ID",
+            "POST /users/batch - Obtener varios usuarios por ID (lista en el cuerpo)",
             "GET /users/<user_id> - Obtener usuario por ID",
             "POST /register - Registrar nuevo usuario",
             "POST /users/<user_id>/activate - Activar usuario",
@@ -265,6 +395,9 @@ def register():
 
     except ValueError as e:
         return jsonify({"error": str(e)}), 409
+    except PasswordPoolBusy:
+        logger.warning("Registro rechazado: pool de contraseñas lleno")
+        return jsonify({"error": "Servicio ocupado, intente de nuevo en unos segundos"}), 503, {"Retry-After": "1"}
     except Exception as e:
         logger.error(f"Error en registro: {e}")
         return jsonify({"error": "Error interno del servidor"}), 500
@@ -294,28 +427,84 @@ def get_user(user_id):
         logger.error(f"Error obteniendo usuario: {e}")
         return jsonify({"error": "Error interno del servidor"}), 500
 
+def serialize_user(user_data):
+    return {
+        "id": user_data["id"],
+        "username": user_data["username"],
+        "first_name": user_data["first_name"],
+        "last_name": user_data["last_name"],
+        "email": user_data["email"],
+        "is_active": user_data["is_active"],
+        "created_at": user_data["created_at"].isoformat() if user_data["created_at"] else None,
+        "last_login": user_data["last_login"].isoformat() if user_data["last_login"] else None
+    }
+
+def parse_user_ids(raw):
+    # Acepta una lista JSON o un texto "1,2,3"; lanza ValueError si algún ID no es entero
+    if isinstance(raw, str):
+        raw = [part for part in raw.split(",") if part.strip()]
+    if not isinstance(raw, list):
+        raise ValueError("ids debe ser una lista")
+    return list(dict.fromkeys(int(user_id) for user_id in raw))
+
+def users_batch_response(raw_ids):
+    try:
+        user_ids = parse_user_ids(raw_ids)
+    except (TypeError, ValueError):
+        return jsonify({"error": "ids debe ser una lista de enteros"}), 400
+    if not user_ids:
+        return jsonify({"error": "ids es requerido"}), 400
+    if len(user_ids) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Máximo {MAX_BATCH_SIZE} usuarios por consulta"}), 400
+    users_by_id = {row["id"]: row for row in get_users_by_ids(user_ids)}
+    return jsonify({
+        "users": [serialize_user(users_by_id[user_id]) for user_id in user_ids if user_id in users_by_id],
+        "not_found": [user_id for user_id in user_ids if user_id not in users_by_id],
+        "total": len(users_by_id)
+    }), 200
+
+def users_directory_response():
+    query = request.args.get("q", "").strip()
+    limit = request.args.get("limit", DIRECTORY_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, DIRECTORY_MAX_PAGE_SIZE))
+    cursor = request.args.get("cursor")
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    rows, has_more = search_users_directory(query, limit, after)
+    next_cursor = encode_cursor(rows[-1]["username"], rows[-1]["id"]) if has_more else None
+    return jsonify({
+        "users": [
+            {
+                "id": row["id"],
+                "username": row["username"],
+                "first_name": row["first_name"],
+                "last_name": row["last_name"]
+            }
+            for row in rows
+        ],
+        "next_cursor": next_cursor,
+        "has_more": has_more
+    }), 200
+
+@app.route('/users/batch', methods=['POST'])
+def get_users_batch():
+    try:
+        data = request.get_json(silent=True) or {}
+        return users_batch_response(data.get("ids"))
+    except Exception as e:
+        logger.error(f"Error obteniendo usuarios en bloque: {e}")
+        return jsonify({"error": "Error interno del servidor"}), 500
+
 @app.route('/users', methods=['GET'])
 def list_all_users():
     try:
-        users_data = get_all_users()
-        
-        users = []
-        for user_data in users_data:
-            users.append({
-                "id": user_data["id"],
-                "username": user_data["username"],
-                "first_name": user_data["first_name"],
-                "last_name": user_data["last_name"],
-                "email": user_data["email"],
-                "is_active": user_data["is_active"],
-                "created_at": user_data["created_at"].isoformat() if user_data["created_at"] else None,
-                "last_login": user_data["last_login"].isoformat() if user_data["last_login"] else None
-            })
-        
-        return jsonify({
-            "users": users,
-            "total": len(users)
-        }), 200
+        if "ids" in request.args:
+            return users_batch_response(request.args.get("ids"))
+        # Sin parámetros también se devuelve la primera página del directorio: la tabla
+        # completa nunca se lista en una sola respuesta
+        return users_directory_response()
         
     except Exception as e:
         logger.error(f"Error listando usuarios: {e}")
@@ -324,6 +513,8 @@ def list_all_users():
 @app.route('/users/<int:user_id>/activate', methods=['POST'])
 def activate(user_id):
     try:
+        if identity_mismatch(user_id):
+            return jsonify({"error": "No autorizado para activar a otro usuario"}), 403
         user_data = get_user_by_id(user_id)
         if not user_data:
             return jsonify({"error": "Usuario no encontrado"}), 404
@@ -353,6 +544,8 @@ def health_check():
             "status": "healthy",
             "timestamp": datetime.utcnow().isoformat(),
             "database": "connected",
+            "password_pool": password_pool.stats(),
+            "activity_buffer": activity_buffer.stats(),
             "service": "users-api"
         }), 200
         
@@ -379,6 +572,9 @@ def internal_error(error):
     return jsonify({"error": "Error interno del servidor"}), 500
 
 if __name__ == '__main__':
+    if RUNNING_MIGRATIONS:
+        run_migrations(db_pool, MIGRATIONS)
+        sys.exit(0)
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('FLASK_ENV') == 'development'
     app.run(host='0.0.0.0', port=port, debug=debug)
@@ -1,48 +1,978 @@
 # services/websocket/app.py
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from typing import List
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Union
+import asyncio
+import base64
+import itertools
+import threading
 import uvicorn
 import json
+import math
+import os
+import time
+import uuid
+
+from common.tokens import token_user_id
+
+try:
+    import msgpack
+except ImportError:  # Sin msgpack el servicio solo ofrece JSON
+    msgpack = None
 
 app = FastAPI()
 
+# Tamaño máximo de la cola de salida de cada conexión y política para clientes lentos:
+#   drop_oldest -> se descarta el frame más antiguo pendiente
+#   coalesce    -> los frames pendientes se agrupan en un único frame {"type": "batch"}
+#   disconnect  -> se cierra la conexión del cliente lento
+SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", 256))
+SLOW_CONSUMER_POLICY = os.environ.get("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+# Límites del lote pendiente con coalesce; al superarlos se descartan los frames más antiguos
+COALESCE_MAX_FRAMES = int(os.environ.get("WS_COALESCE_MAX_FRAMES", 1000))
+COALESCE_MAX_BYTES = int(os.environ.get("WS_COALESCE_MAX_BYTES", 1024 * 1024))
+
+if SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+    raise ValueError(f"WS_SLOW_CONSUMER_POLICY debe ser uno de {SLOW_CONSUMER_POLICIES}")
+
+# Backplane para repartir frames entre workers/contenedores:
+#   memory   -> solo este proceso (un único worker)
+#   postgres -> LISTEN/NOTIFY sobre la base de datos compartida, sin broker externo
+BACKPLANE = os.environ.get("WS_BACKPLANE", "memory")
+BACKPLANE_CHANNEL = os.environ.get("WS_BACKPLANE_CHANNEL", "ws_frames")
+
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_PORT = os.environ.get("DB_PORT", "5432")
+DB_USER = os.environ.get("DB_USER", "admin")
+DB_PASSWORD = os.environ.get("DB_PASSWORD")
+DB_NAME = os.environ.get("DB_NAME", "message-app-db")
+
+# Membresías (user_chat) consultadas para suscribir y publicar: caché por usuario
+MEMBERSHIP_TTL = float(os.environ.get("WS_MEMBERSHIP_TTL", 30))
+MEMBERSHIP_CACHE_MAX = int(os.environ.get("WS_MEMBERSHIP_CACHE_MAX", 10000))
+# Un chat que no está en la caché fuerza una recarga, como mucho una por usuario en
+# este intervalo: los frames a chats ajenos no generan una consulta cada uno
+MEMBERSHIP_REFRESH_INTERVAL = float(os.environ.get("WS_MEMBERSHIP_REFRESH_INTERVAL", 2))
+
+# Identifica a este proceso para no reentregar sus propios frames desde el backplane
+NODE_ID = uuid.uuid4().hex
+
+# Frames recientes por chat que se guardan en memoria para reenviar a clientes que reconectan
+REPLAY_BUFFER_SIZE = int(os.environ.get("WS_REPLAY_BUFFER_SIZE", 100))
+REPLAY_MAX_CHATS = int(os.environ.get("WS_REPLAY_MAX_CHATS", 1000))
+
+# Heartbeats: el servidor envía {"type": "ping"} cada intervalo y cierra los sockets
+# que no han enviado ningún frame (pong u otro) durante el timeout
+HEARTBEAT_INTERVAL = float(os.environ.get("WS_HEARTBEAT_INTERVAL", 25))
+HEARTBEAT_TIMEOUT = float(os.environ.get("WS_HEARTBEAT_TIMEOUT", 60))
+
+# Tokens firmados por el servicio de auth (?token=...). Con AUTH_REQUIRED las
+# conexiones sin token válido se rechazan
+AUTH_SECRET = os.environ.get("AUTH_SECRET", "")
+AUTH_REQUIRED = os.environ.get("AUTH_REQUIRED", "false").lower() == "true"
+
+# Codificaciones negociables por el cliente (?encoding=msgpack o subprotocolo "msgpack")
+ENCODINGS = ("json", "msgpack") if msgpack is not None else ("json",)
+
+Payload = Union[str, bytes]
+
+def encode_payload(data: Any, encoding: str) -> Payload:
+    if encoding == "msgpack":
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data)
+
+# Los frames de chat se reenvían tal cual a clientes JSON y MessagePack, así que su
+# contenido debe poder codificarse en ambos formatos: sin bin/ext de MessagePack, con
+# claves de texto, enteros de 64 bits, floats finitos y anidamiento acotado
+MAX_FRAME_DEPTH = 32
+INT_MIN, INT_MAX = -2 ** 63, 2 ** 64 - 1
+
+def is_portable(value: Any, depth: int = 0) -> bool:
+    if value is None or isinstance(value, (bool, str)):
+        return True
+    if isinstance(value, int):
+        return INT_MIN <= value <= INT_MAX
+    if isinstance(value, float):
+        return math.isfinite(value)
+    if depth >= MAX_FRAME_DEPTH:
+        return False
+    if isinstance(value, (list, tuple)):
+        return all(is_portable(item, depth + 1) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and is_portable(item, depth + 1) for key, item in value.items())
+    return False
+
+def decode_payload(payload: Payload) -> Any:
+    if isinstance(payload, bytes):
+        if msgpack is None:
+            raise ValueError("Frame binario recibido pero msgpack no está disponible")
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+class Frame:
+    """Frame de chat que conserva los bytes originales y se codifica como mucho una vez por formato."""
+
+    def __init__(self, chat_id: str, data: Optional[dict] = None,
+                 encoded: Optional[Dict[str, Payload]] = None, seq: Optional[int] = None):
+        self.chat_id = chat_id
+        self.seq = seq
+        self._data = data
+        self._encoded: Dict[str, Payload] = dict(encoded or {})
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = decode_payload(next(iter(self._encoded.values())))
+        return self._data
+
+    def encode(self, encoding: str) -> Payload:
+        payload = self._encoded.get(encoding)
+        if payload is None:
+            payload = encode_payload(self.data, encoding)
+            self._encoded[encoding] = payload
+        return payload
+
+    def with_seq(self, seq: int) -> "Frame":
+        # Antepone "seq" a las codificaciones existentes sin volver a serializar el frame
+        encoded = {}
+        for encoding, payload in self._encoded.items():
+            prefixed = prepend_seq(payload, seq)
+            if prefixed is not None:
+                encoded[encoding] = prefixed
+        data = dict(self._data, seq=seq) if self._data is not None else None
+        if data is None and not encoded:
+            data = dict(self.data, seq=seq)
+        return Frame(self.chat_id, data, encoded, seq)
+
+def prepend_seq(payload: Payload, seq: int) -> Optional[Payload]:
+    # Los frames de chat siempre son objetos no vacíos (llevan chat_id)
+    if isinstance(payload, str):
+        payload = payload.lstrip()
+        if not payload.startswith("{"):
+            return None
+        return '{"seq":%d,' % seq + payload[1:]
+    first = payload[0]
+    if 0x80 <= first <= 0x8f:
+        size, body = first & 0x0f, payload[1:]
+    elif first == 0xde:
+        size, body = int.from_bytes(payload[1:3], "big"), payload[3:]
+    elif first == 0xdf:
+        size, body = int.from_bytes(payload[1:5], "big"), payload[5:]
+    else:
+        return None
+    packer = msgpack.Packer(use_bin_type=True)
+    return packer.pack_map_header(size + 1) + packer.pack("seq") + packer.pack(seq) + body
+
+class ChatHistory:
+    """Buffer circular con los últimos frames de un chat, numerados de forma consecutiva."""
+
+    _generations = itertools.count(1)
+
+    def __init__(self, size: int = REPLAY_BUFFER_SIZE):
+        # La época cambia si el historial se descarta y se recrea (o en otro worker):
+        # las secuencias solo son comparables dentro de la misma época
+        self.epoch = f"{NODE_ID[:12]}-{next(ChatHistory._generations)}"
+        self.seq = 0
+        self.frames: Deque[Frame] = deque(maxlen=size)
+
+    def append(self, frame: Frame) -> Frame:
+        self.seq += 1
+        sequenced = frame.with_seq(self.seq)
+        self.frames.append(sequenced)
+        return sequenced
+
+    def since(self, seq: int) -> Optional[List[Frame]]:
+        # None cuando el hueco ya no está en memoria y el cliente debe resincronizar
+        if seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        oldest = self.frames[0].seq if self.frames else self.seq + 1
+        if seq + 1 < oldest:
+            return None
+        return list(itertools.islice(self.frames, seq + 1 - oldest, None))
+
+    def cursor(self) -> dict:
+        return {"epoch": self.epoch, "seq": self.seq}
+
+class ClientConnection:
+    """Socket con su propia cola de salida, vaciada por una tarea escritora."""
+
+    def __init__(self, websocket: WebSocket, user_id: Optional[str], encoding: str = "json",
+                 max_queue: int = SEND_QUEUE_SIZE, policy: str = SLOW_CONSUMER_POLICY):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.encoding = encoding
+        self.max_queue = max_queue
+        self.policy = policy
+        # Cada elemento es un frame serializado o un lote (lista de frames) pendiente de enviar
+        self.queue: Deque[Union[Payload, List[Payload]]] = deque()
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+        self.last_seen = asyncio.get_running_loop().time()
+        self._ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._closer: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        # Frames pendientes: un lote coalescido cuenta por cada frame que contiene
+        return sum(len(item) if isinstance(item, list) else 1 for item in self.queue)
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def send_frame(self, frame: Frame) -> bool:
+        # El frame se codifica una vez por formato y se comparte entre todos los destinatarios
+        return self.enqueue(frame.encode(self.encoding))
+
+    def send_control(self, data: dict) -> bool:
+        return self.enqueue(encode_payload(data, self.encoding))
+
+    def enqueue(self, message: Payload) -> bool:
+        if self.closed:
+            return False
+        if len(self.queue) >= self.max_queue:
+            if self.policy == "disconnect":
+                self.closed = True
+                self.queue.clear()
+                # Se guarda la tarea: el loop solo mantiene referencias débiles
+                self._closer = asyncio.create_task(self.close_socket(code=1013))  # Try Again Later
+                return False
+            if self.policy == "coalesce":
+                self._coalesce()
+            else:
+                self.queue.popleft()
+                self.dropped += 1
+        self.queue.append(message)
+        self._ready.set()
+        return True
+
+    def _coalesce(self):
+        # Los frames ya están serializados: se agrupan en un único lote plano (un lote
+        # anterior se aplana, no se anida) y se codifican como batch al enviarlos
+        frames: List[Payload] = []
+        merged = 0
+        for item in self.queue:
+            if isinstance(item, list):
+                frames.extend(item)
+            else:
+                frames.append(item)
+                merged += 1
+        self.queue.clear()
+        self.coalesced += merged
+        # El lote queda acotado en frames y bytes: se conservan los más recientes
+        keep = size = 0
+        for frame in reversed(frames):
+            if keep >= COALESCE_MAX_FRAMES or size + len(frame) > COALESCE_MAX_BYTES:
+                break
+            keep += 1
+            size += len(frame)
+        if keep < len(frames):
+            self.dropped += len(frames) - keep
+            frames = frames[len(frames) - keep:]
+        if frames:
+            self.queue.append(frames)
+
+    def _encode_batch(self, frames: List[Payload]) -> Payload:
+        if self.encoding == "msgpack":
+            # Mapa {"type": "batch", "frames": [...]} armado a mano con los frames ya empaquetados
+            packer = msgpack.Packer(use_bin_type=True)
+            batch = (packer.pack_map_header(2) + packer.pack("type") + packer.pack("batch")
+                     + packer.pack("frames") + packer.pack_array_header(len(frames)) + b"".join(frames))
+        else:
+            batch = '{"type":"batch","frames":[' + ",".join(frames) + "]}"
+        return batch
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self.queue:
+                    message = self.queue.popleft()
+                    if isinstance(message, list):
+                        message = self._encode_batch(message)
+                    if isinstance(message, bytes):
+                        await self.websocket.send_bytes(message)
+                    else:
+                        await self.websocket.send_text(message)
+                self._ready.clear()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # El socket ya no acepta envíos: la conexión se limpia desde el endpoint
+            self.closed = True
+
+    def touch(self):
+        self.last_seen = asyncio.get_running_loop().time()
+
+    async def close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stop(self):
+        self.closed = True
+        if self._writer:
+            self._writer.cancel()
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        # Índice chat_id -> conexiones suscritas, y su inverso para limpiar al desconectar
+        self.rooms: Dict[str, Set[ClientConnection]] = {}
+        self.subscriptions: Dict[ClientConnection, Set[str]] = {}
+        # Presencia: user_id -> conexiones abiertas (el inverso es ClientConnection.user_id)
+        self.user_connections: Dict[str, Set[ClientConnection]] = {}
+        # Historial reciente por chat, acotado en número de chats (LRU)
+        self.histories: "OrderedDict[str, ChatHistory]" = OrderedDict()
+        # Se llama con (user_id, online) al abrir su primera conexión o cerrar la última
+        self.on_presence: Optional[Callable[[str, bool], None]] = None
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+    async def connect(self, websocket: WebSocket, user_id: Optional[str] = None,
+                      encoding: str = "json", subprotocol: Optional[str] = None) -> ClientConnection:
+        await websocket.accept(subprotocol=subprotocol)
+        client = ClientConnection(websocket, user_id, encoding)
+        client.start()
+        self.active_connections[websocket] = client
+        self.subscriptions[client] = set()
+        if user_id is not None:
+            sockets = self.user_connections.setdefault(user_id, set())
+            sockets.add(client)
+            if len(sockets) == 1 and self.on_presence is not None:
+                self.on_presence(user_id, True)
+        return client
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.active_connections.pop(websocket, None)
+        if client is None:
+            return
+        client.stop()
+        for chat_id in self.subscriptions.pop(client, set()):
+            self._leave_room(client, chat_id)
+        sockets = self.user_connections.get(client.user_id)
+        if sockets is not None:
+            sockets.discard(client)
+            if not sockets:
+                del self.user_connections[client.user_id]
+                if self.on_presence is not None:
+                    self.on_presence(client.user_id, False)
+
+    def presence(self, user_ids: Iterable[str]) -> Dict[str, bool]:
+        # Solo las conexiones de este worker; la vista global la da el backplane
+        return {str(user_id): str(user_id) in self.user_connections for user_id in user_ids}
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            deadline = asyncio.get_running_loop().time() - HEARTBEAT_TIMEOUT
+            for websocket, client in list(self.active_connections.items()):
+                if client.closed or client.last_seen < deadline:
+                    # Socket zombi: se deja de enviarle frames y se cierra
+                    self.disconnect(websocket)
+                    await client.close_socket(code=1001)
+                else:
+                    client.send_control({"type": "ping"})
+
+    def subscribe(self, client: ClientConnection, chat_ids: Iterable[str]) -> List[str]:
+        joined = []
+        for chat_id in chat_ids:
+            chat_id = str(chat_id)
+            self.rooms.setdefault(chat_id, set()).add(client)
+            self.subscriptions[client].add(chat_id)
+            joined.append(chat_id)
+        return joined
+
+    def unsubscribe(self, client: ClientConnection, chat_ids: Iterable[str]) -> List[str]:
+        left = []
+        for chat_id in chat_ids:
+            chat_id = str(chat_id)
+            if chat_id in self.subscriptions[client]:
+                self.subscriptions[client].discard(chat_id)
+                self._leave_room(client, chat_id)
+                left.append(chat_id)
+        return left
+
+    def retain(self, user_id: str, chat_ids: Set[str]):
+        # Quita de las salas los chats a los que el usuario ya no pertenece
+        for client in list(self.user_connections.get(user_id, ())):
+            self.unsubscribe(client, self.subscriptions.get(client, set()) - chat_ids)
+
+    def _leave_room(self, client: ClientConnection, chat_id: str):
+        members = self.rooms.get(chat_id)
+        if members is None:
+            return
+        members.discard(client)
+        if not members:
+            del self.rooms[chat_id]
+
+    def history(self, chat_id: str) -> ChatHistory:
+        history = self.histories.get(chat_id)
+        if history is None:
+            history = self.histories[chat_id] = ChatHistory()
+            if len(self.histories) > REPLAY_MAX_CHATS:
+                self.histories.popitem(last=False)
+        else:
+            self.histories.move_to_end(chat_id)
+        return history
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            if connection.client_state.value == 1:  # WEBSOCKET_STATE.OPEN == 1
-                await connection.send_text(message)
+    def cursors(self, chat_ids: Iterable[str]) -> Dict[str, dict]:
+        return {chat_id: self.history(chat_id).cursor() for chat_id in chat_ids}
+
+    def send_to_chat(self, frame: Frame) -> int:
+        # Cada frame recibe el siguiente número de secuencia del chat y se guarda para replay.
+        # Solo se encola para los miembros del chat: O(miembros) en lugar de O(conexiones).
+        # Cada conexión envía desde su propia tarea, así un cliente lento no bloquea al resto.
+        frame = self.history(frame.chat_id).append(frame)
+        delivered = 0
+        for client in list(self.rooms.get(frame.chat_id, ())):
+            try:
+                if client.send_frame(frame):
+                    delivered += 1
+            except Exception as e:
+                # Un destinatario que no puede recibir el frame no corta el reparto al resto
+                print(f"Error enviando frame del chat {frame.chat_id} a {client.user_id}: {e}")
+        return delivered
+
+    def resume(self, client: ClientConnection, chat_id: str, epoch: Optional[str], seq: int):
+        # Reenvía desde memoria lo que el cliente no vio; si no es posible pide resincronizar
+        self.subscribe(client, [chat_id])
+        history = self.histories.get(chat_id)
+        missed = history.since(seq) if history is not None and history.epoch == epoch else None
+        history = self.history(chat_id)
+        if missed is None:
+            client.send_control({"type": "resync_required", "chat_id": chat_id, **history.cursor()})
+            return
+        for frame in missed:
+            client.send_frame(frame)
+        client.send_control({"type": "resumed", "chat_id": chat_id, "replayed": len(missed),
+                             **history.cursor()})
+
+    def stats(self) -> List[dict]:
+        return [
+            {
+                "user_id": client.user_id,
+                "encoding": client.encoding,
+                "idle_seconds": round(asyncio.get_running_loop().time() - client.last_seen, 1),
+                "queue_depth": client.queue_depth,
+                "dropped": client.dropped,
+                "coalesced": client.coalesced,
+                "subscriptions": len(self.subscriptions.get(client, ())),
+            }
+            for client in self.active_connections.values()
+        ]
+
+def db_connect():
+    import psycopg2
+    conn = psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        dbname=DB_NAME
+    )
+    conn.autocommit = True
+    return conn
+
+class MembershipDirectory:
+    """Chats activos de cada usuario según user_chat, con caché TTL por usuario."""
+
+    def __init__(self, ttl: float = MEMBERSHIP_TTL, on_refresh: Optional[Callable[[str, Set[str]], None]] = None):
+        self.ttl = ttl
+        self.on_refresh = on_refresh
+        # user_id -> (expira, consultado, chat_ids)
+        self.cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # Consultas en curso por usuario, compartidas por todas sus conexiones
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.local = threading.local()
+
+    def _query(self, user_id: str) -> Set[str]:
+        # Una conexión por hilo del executor, reutilizada entre consultas
+        conn = getattr(self.local, "conn", None)
+        try:
+            if conn is None or conn.closed:
+                conn = self.local.conn = db_connect()
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT uc.chat_id
+                FROM user_chat uc
+                JOIN chats c ON c.id = uc.chat_id AND c.is_active = true
+                WHERE uc.user_id = %s
+            """, (int(user_id),))
+            chat_ids = {str(row[0]) for row in cur.fetchall()}
+            cur.close()
+            return chat_ids
+        except Exception:
+            self.local.conn = None
+            raise
+
+    async def chats_for(self, user_id: Optional[str], refresh: bool = False) -> Set[str]:
+        # Sin user_id numérico no hay membresías; si la consulta falla no se autoriza nada
+        if user_id is None or not str(user_id).isdigit():
+            return set()
+        now = time.monotonic()
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            expires, fetched, chat_ids = cached
+            if expires > now and (not refresh or now - fetched < MEMBERSHIP_REFRESH_INTERVAL):
+                return chat_ids
+        pending = self.inflight.get(user_id)
+        if pending is None:
+            pending = self.inflight[user_id] = asyncio.ensure_future(self._load(user_id))
+        # shield: si se cancela quien espera, la consulta sigue para las demás conexiones
+        return await asyncio.shield(pending)
+
+    async def _load(self, user_id: str) -> Set[str]:
+        try:
+            chat_ids = await asyncio.get_running_loop().run_in_executor(self.executor, self._query, user_id)
+        except Exception as e:
+            print(f"Error consultando membresías del usuario {user_id}: {e}")
+            return set()
+        finally:
+            self.inflight.pop(user_id, None)
+        now = time.monotonic()
+        self.cache[user_id] = (now + self.ttl, now, chat_ids)
+        self.cache.move_to_end(user_id)
+        if len(self.cache) > MEMBERSHIP_CACHE_MAX:
+            self.cache.popitem(last=False)
+        if self.on_refresh is not None:
+            self.on_refresh(user_id, chat_ids)
+        return chat_ids
+
+    async def allowed(self, user_id: Optional[str], chat_ids: Iterable[str]) -> List[str]:
+        # Filtra chat_ids a los del usuario; si falta alguno se vuelve a consultar una vez
+        # (p. ej. un chat creado después de la última consulta), salvo que la última
+        # consulta sea de hace menos de MEMBERSHIP_REFRESH_INTERVAL
+        chat_ids = list(dict.fromkeys(chat_ids))
+        member = await self.chats_for(user_id)
+        if any(chat_id not in member for chat_id in chat_ids):
+            member = await self.chats_for(user_id, refresh=True)
+        return [chat_id for chat_id in chat_ids if chat_id in member]
+
+DeliverCallback = Callable[[Frame], None]
+
+class Backplane:
+    """Reparte cada frame de chat a los suscriptores de todos los workers, incluido este."""
+
+    async def start(self, deliver: DeliverCallback):
+        self.deliver = deliver
+
+    async def publish(self, frame: Frame):
+        raise NotImplementedError
+
+    def presence_changed(self, user_id: str, online: bool):
+        pass
+
+    async def presence(self, user_ids: List[str], local: Dict[str, bool]) -> Dict[str, bool]:
+        # Con un único worker la presencia local es la global
+        return local
+
+    async def stop(self):
+        pass
+
+class InProcessBackplane(Backplane):
+    async def publish(self, frame: Frame):
+        self.deliver(frame)
+
+class PostgresBackplane(Backplane):
+    # Límite de payload de NOTIFY en Postgres (8000 bytes por defecto). Los frames más
+    # grandes viajan en trozos de CHUNK_SIZE bytes (en base64) y se reensamblan al recibirlos
+    MAX_PAYLOAD = 7900
+    CHUNK_SIZE = 5000
+    MAX_PENDING_FRAMES = 1000
+    RECONNECT_DELAY = 2
+
+    def __init__(self, channel: str = BACKPLANE_CHANNEL):
+        self.channel = channel
+        self.listen_conn = None
+        self.publish_conn = None
+        # Un único hilo publica en orden sin bloquear el event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Trozos recibidos de frames grandes: (origen, frame_id) -> {parte: bytes}
+        self.pending: "OrderedDict[tuple, Dict[int, bytes]]" = OrderedDict()
+        self.presence_task: Optional[asyncio.Task] = None
+        self.reconnect_task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: DeliverCallback):
+        await super().start(deliver)
+        self.loop = asyncio.get_running_loop()
+        await self._listen()
+        await self.loop.run_in_executor(self.executor, self._register_node)
+        self.presence_task = asyncio.create_task(self._presence_heartbeat())
+
+    async def _listen(self):
+        self.listen_conn = await self.loop.run_in_executor(self.executor, db_connect)
+        cur = self.listen_conn.cursor()
+        cur.execute(f'LISTEN "{self.channel}"')
+        cur.close()
+        self.loop.add_reader(self.listen_conn.fileno(), self._on_notify)
+        print(f"Backplane Postgres escuchando en canal {self.channel} (nodo {NODE_ID})")
+
+    def _on_notify(self):
+        try:
+            self.listen_conn.poll()
+        except Exception as e:
+            print(f"Error en conexión LISTEN del backplane: {e}")
+            self.loop.remove_reader(self.listen_conn.fileno())
+            self.reconnect_task = asyncio.create_task(self._reconnect())
+            return
+        while self.listen_conn.notifies:
+            notify = self.listen_conn.notifies.pop(0)
+            try:
+                envelope = json.loads(notify.payload)
+            except ValueError:
+                continue
+            # Los frames propios ya se entregaron localmente al publicar
+            if envelope.get("origin") == NODE_ID:
+                continue
+            if "parts" in envelope:
+                data = self._reassemble(envelope)
+                if data is None:
+                    continue
+            else:
+                data = envelope["data"]
+            self.deliver(Frame(envelope["chat_id"], encoded={"json": data}))
+
+    def _reassemble(self, envelope: dict) -> Optional[str]:
+        # Devuelve el frame completo cuando llega su último trozo
+        key = (envelope["origin"], envelope["frame_id"])
+        parts = self.pending.get(key)
+        if parts is None:
+            parts = self.pending[key] = {}
+            if len(self.pending) > self.MAX_PENDING_FRAMES:
+                self.pending.popitem(last=False)
+        parts[envelope["part"]] = base64.b64decode(envelope["chunk"])
+        if len(parts) < envelope["parts"]:
+            return None
+        del self.pending[key]
+        return b"".join(parts[i] for i in range(envelope["parts"])).decode("utf-8")
+
+    async def _reconnect(self):
+        try:
+            self.listen_conn.close()
+        except Exception:
+            pass
+        while True:
+            await asyncio.sleep(self.RECONNECT_DELAY)
+            try:
+                await self._listen()
+                return
+            except Exception as e:
+                print(f"Reintentando conexión del backplane: {e}")
+
+    def _notify(self, payloads: List[str]):
+        try:
+            if self.publish_conn is None or self.publish_conn.closed:
+                self.publish_conn = db_connect()
+            cur = self.publish_conn.cursor()
+            # Todos los trozos de un frame se notifican en la misma sentencia (una transacción)
+            cur.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload",
+                        (self.channel, payloads))
+            cur.close()
+        except Exception as e:
+            print(f"Error publicando en el backplane: {e}")
+            self.publish_conn = None
+
+    # Presencia compartida: cada worker registra sus usuarios conectados en ws_presence y
+    # renueva su fila de ws_nodes en cada heartbeat. Las filas de un worker caído dejan de
+    # contar tras HEARTBEAT_TIMEOUT y se borran en cascada más tarde
+    PRESENCE_SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS ws_nodes (
+            node_id TEXT PRIMARY KEY,
+            last_seen TIMESTAMP NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ws_presence (
+            node_id TEXT NOT NULL REFERENCES ws_nodes(node_id) ON DELETE CASCADE,
+            user_id TEXT NOT NULL,
+            PRIMARY KEY (node_id, user_id)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_ws_presence_user_id ON ws_presence (user_id)
+        """,
+    ]
+
+    def _execute(self, query: str, params: tuple = (), fetch: bool = False):
+        # Corre en el hilo del executor, con la misma conexión que publica
+        try:
+            if self.publish_conn is None or self.publish_conn.closed:
+                self.publish_conn = db_connect()
+            cur = self.publish_conn.cursor()
+            cur.execute(query, params)
+            rows = cur.fetchall() if fetch else None
+            cur.close()
+            return rows
+        except Exception as e:
+            print(f"Error de presencia en el backplane: {e}")
+            self.publish_conn = None
+            return [] if fetch else None
+
+    def _register_node(self):
+        for statement in self.PRESENCE_SCHEMA:
+            self._execute(statement)
+        self._touch_node()
+
+    def _touch_node(self):
+        self._execute("""
+            INSERT INTO ws_nodes (node_id, last_seen) VALUES (%s, now())
+            ON CONFLICT (node_id) DO UPDATE SET last_seen = now()
+        """, (NODE_ID,))
+        self._execute("DELETE FROM ws_nodes WHERE last_seen < now() - make_interval(secs => %s)",
+                      (HEARTBEAT_TIMEOUT * 2,))
+
+    async def _presence_heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            await self.loop.run_in_executor(self.executor, self._touch_node)
+
+    def presence_changed(self, user_id: str, online: bool):
+        # Se encola en el hilo del executor: conexiones y desconexiones se aplican en orden
+        if online:
+            query = "INSERT INTO ws_presence (node_id, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING"
+        else:
+            query = "DELETE FROM ws_presence WHERE node_id = %s AND user_id = %s"
+        self.loop.run_in_executor(self.executor, self._execute, query, (NODE_ID, user_id))
+
+    async def presence(self, user_ids: List[str], local: Dict[str, bool]) -> Dict[str, bool]:
+        # Solo se consulta la tabla por los usuarios que no están conectados a este worker
+        remote = [user_id for user_id, online in local.items() if not online]
+        if not remote:
+            return local
+        rows = await self.loop.run_in_executor(self.executor, lambda: self._execute("""
+            SELECT DISTINCT p.user_id
+            FROM ws_presence p
+            JOIN ws_nodes n ON n.node_id = p.node_id
+            WHERE p.user_id = ANY(%s) AND n.last_seen > now() - make_interval(secs => %s)
+        """, (remote, HEARTBEAT_TIMEOUT), fetch=True))
+        online = {row[0] for row in rows}
+        return {user_id: is_local or user_id in online for user_id, is_local in local.items()}
+
+    async def publish(self, frame: Frame):
+        self.deliver(frame)
+        # Entre nodos el frame viaja como JSON; se reutiliza la codificación si ya existe
+        try:
+            data = frame.encode("json")
+        except Exception as e:
+            print(f"Frame del chat {frame.chat_id} no publicable en el backplane: {e}")
+            return
+        payload = json.dumps({"origin": NODE_ID, "chat_id": frame.chat_id, "data": data})
+        if len(payload.encode("utf-8")) <= self.MAX_PAYLOAD:
+            payloads = [payload]
+        else:
+            raw = data.encode("utf-8")
+            frame_id = uuid.uuid4().hex
+            chunks = [raw[i:i + self.CHUNK_SIZE] for i in range(0, len(raw), self.CHUNK_SIZE)]
+            payloads = [
+                json.dumps({"origin": NODE_ID, "chat_id": frame.chat_id, "frame_id": frame_id,
+                            "part": part, "parts": len(chunks),
+                            "chunk": base64.b64encode(chunk).decode("ascii")})
+                for part, chunk in enumerate(chunks)
+            ]
+        await self.loop.run_in_executor(self.executor, self._notify, payloads)
+
+    async def stop(self):
+        for task in (self.presence_task, self.reconnect_task):
+            if task is not None:
+                task.cancel()
+        await self.loop.run_in_executor(
+            self.executor, self._execute, "DELETE FROM ws_nodes WHERE node_id = %s", (NODE_ID,))
+        if self.listen_conn is not None and not self.listen_conn.closed:
+            self.loop.remove_reader(self.listen_conn.fileno())
+            self.listen_conn.close()
+        if self.publish_conn is not None and not self.publish_conn.closed:
+            self.publish_conn.close()
+        self.executor.shutdown(wait=False)
+
+def create_backplane(kind: str) -> Backplane:
+    if kind == "memory":
+        return InProcessBackplane()
+    if kind == "postgres":
+        if not DB_PASSWORD:
+            raise ValueError("DB_PASSWORD debe estar configurada para WS_BACKPLANE=postgres")
+        return PostgresBackplane()
+    raise ValueError("WS_BACKPLANE debe ser 'memory' o 'postgres'")
 
 manager = ConnectionManager()
+memberships = MembershipDirectory(on_refresh=manager.retain)
+backplane = create_backplane(BACKPLANE)
+
+heartbeat_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_backplane():
+    global heartbeat_task
+    await backplane.start(manager.send_to_chat)
+    manager.on_presence = backplane.presence_changed
+    heartbeat_task = asyncio.create_task(manager.heartbeat())
+
+@app.on_event("shutdown")
+async def stop_backplane():
+    if heartbeat_task is not None:
+        heartbeat_task.cancel()
+    await backplane.stop()
+
+def parse_ids(raw):
+    if not raw:
+        return []
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    return [str(chat_id).strip() for chat_id in raw if str(chat_id).strip()]
+
+@app.get("/connections")
+async def connections_stats():
+    # Profundidad de la cola de cada conexión para detectar quién se está quedando atrás
+    connections = sorted(manager.stats(), key=lambda c: c["queue_depth"], reverse=True)
+    return {
+        "total": len(connections),
+        "max_queue": SEND_QUEUE_SIZE,
+        "policy": SLOW_CONSUMER_POLICY,
+        "backplane": BACKPLANE,
+        "encodings": list(ENCODINGS),
+        "replay_chats": len(manager.histories),
+        "online_users": len(manager.user_connections),
+        "node_id": NODE_ID,
+        "connections": connections,
+    }
+
+@app.get("/presence")
+async def presence(user_ids: str = ""):
+    # Presencia de muchos usuarios en una sola llamada: /presence?user_ids=1,2,3
+    # (con WS_BACKPLANE=postgres incluye a los usuarios conectados a otros workers)
+    user_ids = parse_ids(user_ids)
+    return {"presence": await backplane.presence(user_ids, manager.presence(user_ids))}
+
+def negotiate_encoding(websocket: WebSocket):
+    # Devuelve (codificación, subprotocolo aceptado); JSON si no se pide otra cosa
+    requested = websocket.scope.get("subprotocols") or []
+    for protocol in requested:
+        if protocol in ENCODINGS:
+            return protocol, protocol
+    encoding = websocket.query_params.get("encoding", "json")
+    return (encoding if encoding in ENCODINGS else "json"), None
+
+async def receive_payload(websocket: WebSocket) -> Payload:
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        return message["bytes"]
+    return message.get("text") or ""
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    # Opcional: leer query params, ej. user_id
+    # Query params: user_id (o token), chat_ids=a,b,c para limitar la suscripción inicial
+    # (por defecto todos los chats del usuario) y encoding=msgpack para frames binarios
     user_id = websocket.query_params.get("user_id", None)
-    await manager.connect(websocket)
-    print(f"Usuario conectado: {user_id}")
+    token = websocket.query_params.get("token")
+    if token or AUTH_REQUIRED:
+        auth_user_id = token_user_id(AUTH_SECRET, token)
+        if auth_user_id is None or (user_id is not None and user_id != str(auth_user_id)):
+            # Se rechaza antes de aceptar el handshake (1008: violación de política)
+            await websocket.close(code=1008)
+            return
+        user_id = str(auth_user_id)
+    # Solo se entra a las salas de los chats a los que el usuario pertenece (user_chat).
+    # Se resuelven antes del handshake para no perder frames recién aceptado el socket
+    requested = parse_ids(websocket.query_params.get("chat_ids"))
+    if requested:
+        chat_ids = await memberships.allowed(user_id, requested)
+    else:
+        chat_ids = sorted(await memberships.chats_for(user_id))
+    encoding, subprotocol = negotiate_encoding(websocket)
+    client = await manager.connect(websocket, user_id, encoding, subprotocol)
+    print(f"Usuario conectado: {user_id} ({encoding})")
+    manager.subscribe(client, chat_ids)
 
     try:
         while True:
-            data = await websocket.receive_text()
-            # Se espera que el cliente envíe un JSON con campos de chat
-            message_data = json.loads(data)
+            payload = await receive_payload(websocket)
+            client.touch()
+            if payload == "ping":
+                # Keepalive en texto plano que envían algunos clientes
+                client.enqueue("pong")
+                continue
+            # Se espera un JSON (o MessagePack) con campos de chat; solo se valida el sobre
+            try:
+                message_data = decode_payload(payload)
+            except Exception:
+                continue
+            if not isinstance(message_data, dict):
+                continue
 
-            # Lógica para decidir a quién reenviar (ej: difundir a todos)
-            await manager.broadcast(json.dumps(message_data))
+            # Frames de control: {"type": "subscribe" | "unsubscribe", "chat_ids": [...]}
+            frame_type = message_data.get("type")
+            if frame_type == "pong":
+                continue
+            if frame_type == "ping":
+                client.send_control({"type": "pong"})
+                continue
+            if frame_type == "presence":
+                user_ids = parse_ids(message_data.get("user_ids"))
+                client.send_control({"type": "presence",
+                                     "users": await backplane.presence(user_ids, manager.presence(user_ids))})
+                continue
+            if frame_type == "subscribe":
+                allowed = await memberships.allowed(user_id, parse_ids(message_data.get("chat_ids")))
+                joined = manager.subscribe(client, allowed)
+                client.send_control({"type": "subscribed", "chat_ids": joined,
+                                     "cursors": manager.cursors(joined)})
+                continue
+            if frame_type == "unsubscribe":
+                left = manager.unsubscribe(client, parse_ids(message_data.get("chat_ids")))
+                client.send_control({"type": "unsubscribed", "chat_ids": left})
+                continue
+            if frame_type == "resume":
+                # {"type": "resume", "chats": {chat_id: {"epoch": ..., "seq": último visto}}}
+                chats = message_data.get("chats")
+                if isinstance(chats, dict):
+                    allowed = set(await memberships.allowed(user_id, [str(chat_id) for chat_id in chats]))
+                    for chat_id, cursor in chats.items():
+                        if str(chat_id) not in allowed:
+                            client.send_control({"type": "error", "error": "forbidden", "chat_id": str(chat_id)})
+                            continue
+                        cursor = cursor if isinstance(cursor, dict) else {}
+                        try:
+                            last_seq = int(cursor.get("seq", 0))
+                        except (TypeError, ValueError):
+                            last_seq = 0
+                        manager.resume(client, str(chat_id), cursor.get("epoch"), last_seq)
+                continue
+
+            # Mensajes de chat: se reenvían los bytes originales solo a los suscriptores
+            # de su chat_id, en este worker y en los demás a través del backplane
+            chat_id = message_data.get("chat_id")
+            if chat_id is None:
+                continue
+            # "type" queda reservado a los frames del servidor (ping, batch, resync_required...):
+            # un cliente no puede hacer pasar un frame de control a los demás miembros
+            if frame_type is not None or not is_portable(message_data):
+                client.send_control({"type": "error", "error": "invalid_frame", "chat_id": str(chat_id)})
+                continue
+            if not await memberships.allowed(user_id, [str(chat_id)]):
+                client.send_control({"type": "error", "error": "forbidden", "chat_id": str(chat_id)})
+                continue
+            original = "msgpack" if isinstance(payload, bytes) else "json"
+            encoded = {original: payload}
+            if "seq" in message_data:
+                # La secuencia la asigna el servidor; se descarta la del cliente y se recodifica
+                message_data = {k: v for k, v in message_data.items() if k != "seq"}
+                encoded = {}
+            frame = Frame(str(chat_id), data=message_data, encoded=encoded)
+            await backplane.publish(frame)
 
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
         print(f"Usuario desconectado: {user_id}")
+    finally:
+        manager.disconnect(websocket)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,139 @@
+import importlib.util
+import os
+import subprocess
+import sys
+import uuid
+
+import psycopg2
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = os.path.join(ROOT, "services")
+sys.path.insert(0, SERVICES)
+
+from common.tokens import create_token
+
+# Las pruebas borran y recrean las tablas: solo corren contra la base de datos
+# desechable indicada en TEST_DB_NAME (con TEST_DB_HOST, TEST_DB_PORT, TEST_DB_USER
+# y TEST_DB_PASSWORD), nunca contra la configurada en DB_* para los servicios
+TEST_DB = {
+    "host": os.environ.get("TEST_DB_HOST", "localhost"),
+    "port": os.environ.get("TEST_DB_PORT", "5432"),
+    "user": os.environ.get("TEST_DB_USER", "postgres"),
+    "password": os.environ.get("TEST_DB_PASSWORD", ""),
+    "dbname": os.environ.get("TEST_DB_NAME"),
+}
+AUTH_SECRET = "test-secret"
+
+def connect():
+    return psycopg2.connect(**TEST_DB)
+
+def service_env():
+    env = dict(os.environ)
+    env.update(
+        DB_HOST=TEST_DB["host"],
+        DB_PORT=TEST_DB["port"],
+        DB_USER=TEST_DB["user"],
+        DB_PASSWORD=TEST_DB["password"] or "postgres",
+        DB_NAME=TEST_DB["dbname"],
+        AUTH_SECRET=AUTH_SECRET,
+        AUTH_REQUIRED="false",
+        BCRYPT_ROUNDS="4",
+        PASSWORD_WORKERS="1",
+        WS_BACKPLANE="memory",
+        PYTHONPATH=SERVICES,
+    )
+    return env
+
+@pytest.fixture(scope="session")
+def database():
+    if not TEST_DB["dbname"]:
+        pytest.skip("TEST_DB_NAME no está configurada")
+    try:
+        conn = connect()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"Base de datos de pruebas no disponible: {e}")
+    with open(os.path.join(os.path.dirname(__file__), "schema.sql")) as f:
+        schema = f.read()
+    with conn, conn.cursor() as cur:
+        cur.execute(schema)
+    conn.close()
+    env = service_env()
+    os.environ.update(env)
+    # Mismo paso que en el despliegue: cada servicio aplica sus migraciones
+    for name in ("users", "chats", "messages"):
+        subprocess.run([sys.executable, "service.py", "migrate"], cwd=os.path.join(SERVICES, name),
+                       env=env, check=True, capture_output=True)
+    return TEST_DB
+
+@pytest.fixture
+def db(database):
+    conn = connect()
+    conn.autocommit = True
+    yield conn
+    conn.close()
+
+def load_module(name, filename):
+    module_name = f"{name}_under_test"
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(SERVICES, name, filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+@pytest.fixture(scope="session")
+def auth_service(database):
+    return load_module("auth", "service.py")
+
+@pytest.fixture(scope="session")
+def users_service(database):
+    return load_module("users", "service.py")
+
+@pytest.fixture(scope="session")
+def chats_service(database):
+    return load_module("chats", "service.py")
+
+@pytest.fixture(scope="session")
+def messages_service(database):
+    return load_module("messages", "service.py")
+
+@pytest.fixture(scope="session")
+def websocket_service(database):
+    return load_module("websocket", "app.py")
+
+@pytest.fixture
+def make_user(db):
+    # Cada prueba crea sus propios usuarios: las cachés de los servicios duran toda la sesión
+    def make_user(first_name="Test", last_name="User", is_active=True):
+        username = f"user_{uuid.uuid4().hex[:12]}"
+        with db.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (username, password_hash, first_name, last_name, email, is_active)
+                VALUES (%s, 'x', %s, %s, %s, %s)
+                RETURNING id
+            """, (username, first_name, last_name, f"{username}@example.com", is_active))
+            return cur.fetchone()[0]
+    return make_user
+
+@pytest.fixture
+def make_chat(db):
+    # El primer miembro queda como administrador
+    def make_chat(member_ids, name="Chat de prueba"):
+        chat_id = str(uuid.uuid4())
+        with db.cursor() as cur:
+            cur.execute("""
+                INSERT INTO chats (id, name, created_at, updated_at, is_active)
+                VALUES (%s, %s, now(), now(), true)
+            """, (chat_id, name))
+            for position, user_id in enumerate(member_ids):
+                cur.execute("INSERT INTO user_chat (user_id, chat_id, is_admin) VALUES (%s, %s, %s)",
+                            (user_id, chat_id, position == 0))
+        return chat_id
+    return make_chat
+
+@pytest.fixture
+def make_token(database):
+    def make_token(user_id, ttl_seconds=60, now=None):
+        return create_token(AUTH_SECRET, user_id, ttl_seconds, now)[0]
+    return make_token
@@ -0,0 +1,39 @@
+-- Esquema base (anterior a las migraciones de cada servicio) para las pruebas
+DROP TABLE IF EXISTS schema_migrations, ws_presence, ws_nodes;
+DROP FUNCTION IF EXISTS messages_assign_seq() CASCADE;
+DROP TABLE IF EXISTS messages, user_chat, chats, users CASCADE;
+
+CREATE TABLE users (
+    id SERIAL PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    first_name TEXT,
+    last_name TEXT,
+    email TEXT UNIQUE,
+    is_active BOOLEAN DEFAULT true,
+    created_at TIMESTAMP DEFAULT now(),
+    last_login TIMESTAMP
+);
+
+CREATE TABLE chats (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    is_active BOOLEAN DEFAULT true
+);
+
+CREATE TABLE user_chat (
+    user_id INTEGER REFERENCES users(id),
+    chat_id TEXT REFERENCES chats(id),
+    is_admin BOOLEAN DEFAULT false,
+    PRIMARY KEY (user_id, chat_id)
+);
+
+CREATE TABLE messages (
+    id SERIAL PRIMARY KEY,
+    sender_id INTEGER REFERENCES users(id),
+    chat_id TEXT REFERENCES chats(id),
+    content TEXT,
+    timestamp TIMESTAMP
+);
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+import textwrap
+from datetime import datetime, timedelta
+
+import pytest
+
+from common.activity import ActivityBuffer
+
+def last_login(db, user_id):
+    with db.cursor() as cur:
+        cur.execute("SELECT last_login FROM users WHERE id = %s", (user_id,))
+        return cur.fetchone()[0]
+
+@pytest.fixture
+def buffer(users_service):
+    # Intervalo largo: en las pruebas solo se vuelca al llamar flush/stop o al llenarse
+    return ActivityBuffer(users_service.db_pool, max_pending=3, flush_interval=3600)
+
+def test_flush_keeps_the_latest_activity_per_user(buffer, db, make_user):
+    alice, bob = make_user(), make_user()
+    seen = datetime(2030, 1, 1, 12, 0)
+
+    buffer.record(alice, seen)
+    buffer.record(alice, seen - timedelta(minutes=5))
+    buffer.record(bob, seen)
+    assert last_login(db, alice) is None
+    assert buffer.flush() == 2
+    assert (last_login(db, alice), last_login(db, bob)) == (seen, seen)
+
+    # Una marca más antigua que la guardada no la hace retroceder
+    buffer.record(alice, seen - timedelta(days=1))
+    buffer.flush()
+    assert last_login(db, alice) == seen
+    assert buffer.stats()["pending"] == 0
+
+def test_full_buffer_flushes_without_waiting(buffer, db, make_user):
+    users = [make_user() for _ in range(3)]
+    for user_id in users:
+        buffer.record(user_id)
+    assert buffer.stats()["pending"] == 0
+    assert all(last_login(db, user_id) is not None for user_id in users)
+
+def test_sigterm_flushes_pending_activity_on_exit(database, db, make_user):
+    user_id = make_user()
+    script = textwrap.dedent(f"""
+        import os, signal, time
+        from psycopg2.pool import ThreadedConnectionPool
+        from common.activity import ActivityBuffer
+
+        pool = ThreadedConnectionPool(1, 2, host=os.environ["DB_HOST"], port=os.environ["DB_PORT"],
+                                      user=os.environ["DB_USER"], password=os.environ["DB_PASSWORD"],
+                                      dbname=os.environ["DB_NAME"])
+        buffer = ActivityBuffer(pool, max_pending=100, flush_interval=3600)
+        buffer.start()
+        buffer.record({user_id})
+        os.kill(os.getpid(), signal.SIGTERM)
+        time.sleep(30)
+    """)
+    result = subprocess.run([sys.executable, "-c", script], env=dict(os.environ), timeout=20,
+                            capture_output=True, text=True)
+    assert result.returncode == 128 + 15, result.stderr
+    assert last_login(db, user_id) is not None
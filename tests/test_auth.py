@@ -0,0 +1,106 @@
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from flask import Flask, g, jsonify
+from starlette.websockets import WebSocketDisconnect
+
+from common.flask_auth import install_token_auth
+from common.tokens import create_token
+
+PASSWORD = "Secreta1!"
+
+@pytest.fixture
+def registered_user(users_service):
+    username = f"user_{uuid.uuid4().hex[:12]}"
+    response = users_service.app.test_client().post("/register", json={
+        "username": username, "password": PASSWORD, "first_name": "Ana",
+        "last_name": "Díaz", "email": f"{username}@example.com"
+    })
+    assert response.status_code == 201, response.get_json()
+    return username, response.get_json()["user"]["id"]
+
+@pytest.fixture
+def bearer(make_token):
+    def bearer(user_id):
+        return {"Authorization": f"Bearer {make_token(user_id)}"}
+    return bearer
+
+def test_login_issues_a_token_that_verify_accepts(auth_service, registered_user):
+    username, user_id = registered_user
+    client = auth_service.app.test_client()
+
+    response = client.post("/login", json={"username": username, "password": PASSWORD})
+    assert response.status_code == 200
+    token = response.get_json()["token"]
+
+    verified = client.get("/verify", headers={"Authorization": f"Bearer {token}"})
+    assert verified.status_code == 200
+    assert verified.get_json()["user_id"] == user_id
+
+    assert client.post("/login", json={"username": username, "password": "Otra1234!"}).status_code == 401
+    assert client.post("/login", json={"username": "no-existe", "password": PASSWORD}).status_code == 401
+    assert client.get("/verify", headers={"Authorization": f"Bearer {token}x"}).status_code == 401
+
+def test_expired_and_forged_tokens_are_rejected(messages_service, make_user, make_token):
+    alice = make_user()
+    client = messages_service.app.test_client()
+    expired = make_token(alice, now=1)
+    forged = create_token("otro-secreto", alice, 60)[0]
+
+    for token in (expired, forged, "basura"):
+        response = client.get(f"/sync?user_id={alice}", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 401
+
+def test_services_reject_requests_for_another_user(users_service, messages_service, make_user, make_chat, bearer):
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice, bob])
+    users = users_service.app.test_client()
+    messages = messages_service.app.test_client()
+
+    assert users.post(f"/users/{bob}/activate", headers=bearer(alice)).status_code == 403
+    assert users.post(f"/users/{alice}/activate", headers=bearer(alice)).status_code == 200
+
+    response = messages.post("/messages", headers=bearer(alice),
+                             json={"sender_id": bob, "chat_id": chat_id, "content": "suplantado"})
+    assert response.status_code == 403
+    # Sin sender_id el remitente es el usuario del token
+    response = messages.post("/messages", headers=bearer(alice), json={"chat_id": chat_id, "content": "hola"})
+    assert response.status_code == 201
+    assert response.get_json()["data"]["sender_id"] == alice
+
+def test_required_auth_rejects_requests_without_token():
+    secret = "secreto-local"
+    app = Flask(__name__)
+
+    @app.route("/privado")
+    def private():
+        return jsonify({"user_id": g.auth_user_id})
+
+    @app.route("/health")
+    def health():
+        return jsonify({"status": "healthy"})
+
+    install_token_auth(app, secret, True, {"health"})
+    client = app.test_client()
+
+    assert client.get("/privado").status_code == 401
+    assert client.get("/health").status_code == 200
+    token = create_token(secret, 7, 60)[0]
+    assert client.get("/privado", headers={"Authorization": f"Bearer {token}"}).get_json() == {"user_id": 7}
+
+def test_websocket_takes_the_user_from_the_token(websocket_service, make_user, make_chat, make_token):
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice])
+    token = make_token(alice)
+
+    with TestClient(websocket_service.app) as client:
+        with client.websocket_connect(f"/ws?token={token}") as socket:
+            socket.send_json({"chat_id": chat_id, "content": "hola"})
+            assert socket.receive_json()["content"] == "hola"
+
+        for url in (f"/ws?token={token}&user_id={bob}", "/ws?token=basura"):
+            with pytest.raises(WebSocketDisconnect) as closed:
+                with client.websocket_connect(url):
+                    pass
+            assert closed.value.code == 1008
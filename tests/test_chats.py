@@ -0,0 +1,132 @@
+import pytest
+
+from common.migrations import apply_migrations
+
+@pytest.fixture
+def client(chats_service):
+    return chats_service.app.test_client()
+
+def test_inbox_etag_answers_304_until_a_chat_changes(client, chats_service, db, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice, bob])
+    url = f"/users/{alice}/chats"
+
+    etag = client.get(url).headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    with db.cursor() as cur:
+        cur.execute("UPDATE chats SET updated_at = now() + interval '1 second' WHERE id = %s", (chat_id,))
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+def test_inbox_version_keeps_chats_with_null_columns(chats_service, db, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice])
+    with db.cursor() as cur:
+        cur.execute("UPDATE chats SET updated_at = NULL WHERE id = %s", (chat_id,))
+        cur.execute("UPDATE user_chat SET is_admin = NULL WHERE chat_id = %s", (chat_id,))
+    # Un chat con columnas NULL no puede dar la misma huella que no tener chats
+    assert chats_service.get_user_chats_version(alice) != chats_service.get_user_chats_version(bob)
+
+def test_inbox_lists_chats_with_participants_and_last_message(client, messages_service, make_user, make_chat):
+    alice = make_user("Ana", "Díaz")
+    bob = make_user("Beto", "Ruiz")
+    carol = make_user("Caro", "Paz")
+    group = make_chat([alice, bob, carol], name="Grupo")
+    direct = make_chat([bob, alice])
+    sent = messages_service.app.test_client().post(
+        "/messages", json={"sender_id": bob, "chat_id": group, "content": "hola grupo"}
+    ).get_json()["data"]
+
+    body = client.get(f"/users/{alice}/chats").get_json()
+    chats = {chat["chat_id"]: chat for chat in body["chats"]}
+    assert body["total"] == 2
+    assert chats[group]["name"] == "Grupo"
+    assert chats[group]["participant_count"] == 3
+    assert chats[group]["is_admin"] is True
+    assert (chats[group]["last_message"], chats[group]["last_message_id"],
+            chats[group]["last_message_sender_id"]) == ("hola grupo", sent["message_id"], bob)
+    # Un chat de dos personas se muestra con el nombre del otro participante
+    assert chats[direct]["name"] == "Beto Ruiz"
+    assert chats[direct]["last_message"] is None
+    assert {p["user_id"] for p in chats[direct]["participants"]} == {alice, bob}
+
+    assert client.get("/users/2147483647/chats").status_code == 404
+
+def test_create_chat_validates_all_participants(client, db, make_user):
+    alice, bob, carol = make_user("Ana", "Díaz"), make_user(), make_user()
+
+    response = client.post("/chats", json={"creator_id": alice, "participant_ids": [bob, 2147483647, carol]})
+    assert response.status_code == 404
+    assert "2147483647" in response.get_json()["error"]
+    assert client.post("/chats", json={"creator_id": alice, "participant_ids": ["x"]}).status_code == 400
+
+    response = client.post("/chats", json={"creator_id": alice, "participant_ids": [bob, carol, bob]})
+    assert response.status_code == 201
+    chat = response.get_json()["chat"]
+    assert chat["name"] == "Chat de Ana"
+    assert [(p["user_id"], p["is_admin"]) for p in chat["participants"]][0] == (alice, True)
+    with db.cursor() as cur:
+        cur.execute("SELECT user_id, is_admin FROM user_chat WHERE chat_id = %s ORDER BY user_id", (chat["chat_id"],))
+        assert cur.fetchall() == sorted([(alice, True), (bob, False), (carol, False)])
+
+def test_participants_are_added_and_removed_in_bulk(client, db, make_user, make_chat):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    chat_id = make_chat([alice, bob])
+
+    body = client.post(f"/chats/{chat_id}/participants/batch",
+                       json={"user_ids": [bob, carol, 2147483647]}).get_json()
+    assert body["added"] == 1
+    assert body["results"] == [
+        {"user_id": bob, "status": "already_member"},
+        {"user_id": carol, "status": "added"},
+        {"user_id": 2147483647, "status": "not_found"},
+    ]
+
+    body = client.delete(f"/chats/{chat_id}/participants", json={"user_ids": [carol, 2147483647]}).get_json()
+    assert body["results"] == [
+        {"user_id": carol, "status": "removed"},
+        {"user_id": 2147483647, "status": "not_member"},
+    ]
+    with db.cursor() as cur:
+        cur.execute("SELECT user_id FROM user_chat WHERE chat_id = %s ORDER BY user_id", (chat_id,))
+        assert [row[0] for row in cur.fetchall()] == sorted([alice, bob])
+
+    assert client.post("/chats/no-existe/participants/batch", json={"user_ids": [bob]}).status_code == 404
+    assert client.post(f"/chats/{chat_id}/participants/batch", json={"user_ids": "1,x"}).status_code == 400
+
+def test_direct_chats_are_reused_for_the_same_pair(client, make_user):
+    alice, bob = make_user(), make_user("Beto", "Ruiz")
+
+    created = client.post("/chats/direct", json={"user_id": alice, "other_user_id": bob})
+    assert created.status_code == 201
+    assert created.get_json()["created"] is True
+    chat_id = created.get_json()["chat"]["chat_id"]
+
+    # Mismo par en cualquier orden y también a través de POST /chats
+    again = client.post("/chats/direct", json={"user_id": bob, "other_user_id": alice})
+    assert (again.status_code, again.get_json()["created"]) == (200, False)
+    assert again.get_json()["chat"]["chat_id"] == chat_id
+    via_create = client.post("/chats", json={"creator_id": alice, "participant_ids": [bob]})
+    assert (via_create.status_code, via_create.get_json()["created"]) == (200, False)
+    assert via_create.get_json()["chat"]["chat_id"] == chat_id
+    assert via_create.get_json()["chat"]["name"] == "Beto Ruiz"
+
+    assert client.post("/chats/direct", json={"user_id": alice, "other_user_id": alice}).status_code == 400
+
+def test_direct_chat_backfill_keys_only_unambiguous_pairs(chats_service, db, make_user, make_chat):
+    alice, bob, carol, dave = make_user(), make_user(), make_user(), make_user()
+    single = make_chat([alice, bob])
+    twice = [make_chat([carol, dave]), make_chat([dave, carol])]
+    group = make_chat([alice, bob, carol])
+    backfill = [migration for migration in chats_service.MIGRATIONS if migration[0] == "chats_direct_key_backfill"]
+    with db.cursor() as cur:
+        cur.execute("DELETE FROM schema_migrations WHERE name = 'chats_direct_key_backfill'")
+    apply_migrations(db, backfill)
+
+    with db.cursor() as cur:
+        cur.execute("SELECT id, direct_key FROM chats WHERE id = ANY(%s)", ([single, group] + twice,))
+        keys = dict(cur.fetchall())
+    assert keys[single] == f"{min(alice, bob)}:{max(alice, bob)}"
+    # Un par con varios chats queda sin clave para no elegir uno al azar
+    assert keys[twice[0]] is None and keys[twice[1]] is None
+    assert keys[group] is None
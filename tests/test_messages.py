@@ -0,0 +1,281 @@
+import json
+
+import pytest
+
+@pytest.fixture
+def client(messages_service):
+    return messages_service.app.test_client()
+
+@pytest.fixture
+def send(client):
+    def send(sender_id, chat_id, content):
+        response = client.post("/messages", json={"sender_id": sender_id, "chat_id": chat_id, "content": content})
+        assert response.status_code == 201, response.get_json()
+        return response.get_json()["data"]
+    return send
+
+def contents(page):
+    return [message["content"] for message in page["messages"]]
+
+def test_history_pages_backwards_with_cursors(client, send, make_user, make_chat):
+    alice = make_user()
+    chat_id = make_chat([alice])
+    for n in range(1, 6):
+        send(alice, chat_id, f"m{n}")
+
+    first = client.get(f"/chats/{chat_id}/messages?user_id={alice}&limit=2").get_json()
+    assert contents(first) == ["m4", "m5"]
+    assert first["has_more"] is True
+
+    second = client.get(f"/chats/{chat_id}/messages?user_id={alice}&limit=2&before={first['next_cursor']}").get_json()
+    assert contents(second) == ["m2", "m3"]
+
+    last = client.get(f"/chats/{chat_id}/messages?user_id={alice}&limit=2&before={second['next_cursor']}").get_json()
+    assert contents(last) == ["m1"]
+    assert last["has_more"] is False
+    assert last["next_cursor"] is None
+
+def test_history_pages_forward_from_after_seq(client, send, make_user, make_chat):
+    alice = make_user()
+    chat_id = make_chat([alice])
+    for n in range(1, 6):
+        send(alice, chat_id, f"m{n}")
+
+    page = client.get(f"/chats/{chat_id}/messages?user_id={alice}&limit=2&after_seq=1").get_json()
+    assert contents(page) == ["m2", "m3"]
+    assert page["last_seq"] == 3
+
+    page = client.get(f"/chats/{chat_id}/messages?user_id={alice}&limit=2&after={page['next_cursor']}").get_json()
+    assert contents(page) == ["m4", "m5"]
+    assert page["has_more"] is False
+
+def test_history_rejects_mixed_and_invalid_cursors(client, make_user, make_chat):
+    alice = make_user()
+    chat_id = make_chat([alice])
+
+    assert client.get(f"/chats/{chat_id}/messages?user_id={alice}&before=x&after_seq=1").status_code == 400
+    assert client.get(f"/chats/{chat_id}/messages?user_id={alice}&before=no-es-un-cursor").status_code == 400
+
+def test_history_is_only_visible_to_members(client, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice])
+
+    assert client.get(f"/chats/{chat_id}/messages?user_id={bob}").status_code == 403
+    assert client.get(f"/chats/no-existe/messages?user_id={alice}").status_code == 404
+
+def test_send_assigns_consecutive_seq_per_chat(send, make_user, make_chat):
+    alice = make_user()
+    first_chat, second_chat = make_chat([alice]), make_chat([alice])
+
+    assert [send(alice, first_chat, "a")["seq"], send(alice, first_chat, "b")["seq"]] == [1, 2]
+    assert send(alice, second_chat, "c")["seq"] == 1
+
+def test_send_reports_which_check_failed(client, db, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice])
+
+    def status(sender_id, chat):
+        return client.post("/messages", json={"sender_id": sender_id, "chat_id": chat, "content": "hola"}).status_code
+
+    assert status(2 ** 31 - 1, chat_id) == 404
+    assert status(alice, "no-existe") == 404
+    assert status(bob, chat_id) == 403
+    assert client.post("/messages", json={"sender_id": alice, "chat_id": chat_id, "content": "  "}).status_code == 400
+    with db.cursor() as cur:
+        cur.execute("SELECT count(*) FROM messages WHERE chat_id = %s", (chat_id,))
+        assert cur.fetchone()[0] == 0
+
+def test_batch_reports_a_result_per_item(client, db, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    first_chat, second_chat = make_chat([alice, bob]), make_chat([alice])
+    foreign_chat = make_chat([bob])
+
+    response = client.post("/messages/batch", json={"messages": [
+        {"sender_id": alice, "chat_id": first_chat, "content": "uno"},
+        {"sender_id": alice, "chat_id": foreign_chat, "content": "ajeno"},
+        {"sender_id": bob, "chat_id": first_chat, "content": "dos"},
+        {"sender_id": alice, "chat_id": second_chat, "content": "tres"},
+        {"sender_id": alice, "chat_id": first_chat, "content": ""},
+        {"sender_id": alice, "chat_id": "no-existe", "content": "cuatro"},
+    ]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body["created"], body["failed"]) == (3, 3)
+
+    results = body["results"]
+    assert [result["index"] for result in results] == list(range(6))
+    assert [result["status"] for result in results] == ["created", "error", "created", "created", "error", "error"]
+    assert [results[i]["error"] for i in (1, 4, 5)] == ["not_member", "invalid_message", "chat_not_found"]
+    assert [(results[i]["chat_id"], results[i]["seq"]) for i in (0, 2, 3)] == [
+        (first_chat, 1), (first_chat, 2), (second_chat, 1)
+    ]
+
+    with db.cursor() as cur:
+        cur.execute("SELECT id, content FROM messages WHERE id = ANY(%s) ORDER BY id",
+                    ([results[i]["message_id"] for i in (0, 2, 3)],))
+        assert [row[1] for row in cur.fetchall()] == ["uno", "dos", "tres"]
+        # El resumen del chat queda con el último mensaje del lote
+        cur.execute("SELECT last_seq, last_message_id FROM chats WHERE id = %s", (first_chat,))
+        assert cur.fetchone() == (2, results[2]["message_id"])
+
+def test_batch_rejects_empty_and_oversized_requests(client, messages_service):
+    assert client.post("/messages/batch", json={"messages": []}).status_code == 400
+    too_many = [{"sender_id": 1, "chat_id": "x", "content": "x"}] * (messages_service.MAX_BATCH_SIZE + 1)
+    assert client.post("/messages/batch", json={"messages": too_many}).status_code == 400
+
+def test_inserts_without_seq_are_numbered_in_order(send, db, make_user, make_chat):
+    # Filas escritas por código anterior a seq (p. ej. durante un despliegue gradual)
+    alice = make_user()
+    chat_id = make_chat([alice])
+    send(alice, chat_id, "nuevo")
+    with db.cursor() as cur:
+        cur.execute("""
+            INSERT INTO messages (sender_id, chat_id, content, timestamp)
+            VALUES (%s, %s, 'antiguo', now())
+            RETURNING seq
+        """, (alice, chat_id))
+        assert cur.fetchone()[0] == 2
+    assert send(alice, chat_id, "otro")["seq"] == 3
+
+def test_history_etag_answers_304_until_the_chat_changes(client, send, db, make_user, make_chat):
+    alice = make_user()
+    chat_id = make_chat([alice])
+    send(alice, chat_id, "hola")
+    url = f"/chats/{chat_id}/messages?user_id={alice}"
+
+    etag = client.get(url).headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    send(alice, chat_id, "otro")
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert contents(response.get_json()) == ["hola", "otro"]
+
+    # Chats con updated_at NULL (filas antiguas) también tienen ETag
+    with db.cursor() as cur:
+        cur.execute("UPDATE chats SET updated_at = NULL WHERE id = %s", (chat_id,))
+    response = client.get(url)
+    assert response.status_code == 200
+    assert client.get(url, headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+def test_sync_returns_only_new_messages_per_chat(client, send, db, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    busy_chat, quiet_chat, left_chat = make_chat([alice, bob]), make_chat([alice]), make_chat([bob, alice])
+    send(alice, busy_chat, "antes")
+    send(alice, quiet_chat, "antes")
+
+    start = client.get(f"/sync?user_id={alice}").get_json()
+    assert start["chats"] == []
+
+    send(bob, busy_chat, "nuevo 1")
+    send(bob, busy_chat, "nuevo 2")
+    with db.cursor() as cur:
+        cur.execute("DELETE FROM user_chat WHERE user_id = %s AND chat_id = %s", (alice, left_chat))
+
+    delta = client.post("/sync", json={"user_id": alice, "cursor": start["cursor"]}).get_json()
+    assert [(chat["chat_id"], contents(chat)) for chat in delta["chats"]] == [(busy_chat, ["nuevo 1", "nuevo 2"])]
+    assert delta["removed_chat_ids"] == [left_chat]
+
+    again = client.post("/sync", json={"user_id": alice, "cursor": delta["cursor"]}).get_json()
+    assert again["chats"] == []
+    assert again["removed_chat_ids"] == []
+
+def test_sync_pages_large_deltas(client, send, make_user, make_chat):
+    alice = make_user()
+    chat_id = make_chat([alice])
+    cursor = client.get(f"/sync?user_id={alice}").get_json()["cursor"]
+    for n in range(1, 6):
+        send(alice, chat_id, f"m{n}")
+
+    seen = []
+    while True:
+        delta = client.post("/sync", json={"user_id": alice, "cursor": cursor, "limit": 2}).get_json()
+        seen += [content for chat in delta["chats"] for content in contents(chat)]
+        cursor = delta["cursor"]
+        if not delta["has_more"]:
+            break
+    assert seen == ["m1", "m2", "m3", "m4", "m5"]
+
+def test_recent_returns_the_last_messages_of_each_requested_chat(client, send, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    first_chat, second_chat, foreign_chat = make_chat([alice]), make_chat([alice]), make_chat([bob])
+    for n in range(1, 4):
+        send(alice, first_chat, f"a{n}")
+    send(alice, second_chat, "b1")
+
+    body = client.post("/messages/recent", json={
+        "user_id": alice, "limit": 2, "chat_ids": [first_chat, second_chat, foreign_chat]
+    }).get_json()
+    assert {chat["chat_id"]: contents(chat) for chat in body["chats"]} == {
+        first_chat: ["a2", "a3"], second_chat: ["b1"]
+    }
+    assert body["unavailable_chat_ids"] == [foreign_chat]
+
+def test_search_only_matches_the_users_chats_and_pages_by_rank(client, send, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    own_chat, foreign_chat = make_chat([alice]), make_chat([bob])
+    send(alice, own_chat, "revisemos el presupuesto mañana")
+    send(alice, own_chat, "presupuesto, presupuesto y más presupuesto")
+    send(alice, own_chat, "nada que ver")
+    send(bob, foreign_chat, "el presupuesto secreto")
+
+    first = client.get(f"/messages/search?user_id={alice}&q=presupuesto&limit=1").get_json()
+    assert contents(first) == ["presupuesto, presupuesto y más presupuesto"]
+    assert first["has_more"] is True
+
+    second = client.get(f"/messages/search?user_id={alice}&q=presupuesto&limit=1&cursor={first['next_cursor']}").get_json()
+    assert contents(second) == ["revisemos el presupuesto mañana"]
+    assert second["has_more"] is False
+
+    assert client.get(f"/messages/search?user_id={alice}").status_code == 400
+    assert client.get(f"/messages/search?user_id={alice}&q=x&cursor=roto").status_code == 400
+
+def read_export(response):
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    response.close()
+    return lines
+
+def test_export_streams_ndjson_and_resumes_from_after_seq(client, send, make_user, make_chat):
+    alice = make_user()
+    chat_id = make_chat([alice])
+    for n in range(1, 4):
+        send(alice, chat_id, f"m{n}")
+
+    response = client.get(f"/chats/{chat_id}/export?user_id={alice}")
+    assert response.mimetype == "application/x-ndjson"
+    lines = read_export(response)
+    assert [line["content"] for line in lines[:-1]] == ["m1", "m2", "m3"]
+    assert lines[-1] == {"export_complete": True, "chat_id": chat_id, "count": 3, "last_seq": 3}
+
+    lines = read_export(client.get(f"/chats/{chat_id}/export?user_id={alice}&after_seq=2"))
+    assert [line["content"] for line in lines[:-1]] == ["m3"]
+
+def test_export_is_refused_when_all_slots_are_busy(client, messages_service, make_user, make_chat):
+    alice = make_user()
+    chat_id = make_chat([alice])
+    slots = messages_service.export_slots
+    held = 0
+    while slots.acquire(blocking=False):
+        held += 1
+    try:
+        response = client.get(f"/chats/{chat_id}/export?user_id={alice}")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(messages_service.EXPORT_RETRY_AFTER_SECONDS)
+    finally:
+        for _ in range(held):
+            slots.release()
+
+    # Al cerrar la respuesta se libera el hueco ocupado por la exportación
+    read_export(client.get(f"/chats/{chat_id}/export?user_id={alice}"))
+    assert held == messages_service.MAX_CONCURRENT_EXPORTS
+    for _ in range(held):
+        assert slots.acquire(blocking=False)
+    for _ in range(held):
+        slots.release()
+
+def test_export_is_only_available_to_members(client, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice])
+
+    assert client.get(f"/chats/{chat_id}/export?user_id={bob}").status_code == 403
+    assert client.get(f"/chats/{chat_id}/export").status_code == 400
@@ -0,0 +1,41 @@
+import uuid
+
+import pytest
+
+@pytest.fixture
+def client(users_service):
+    return users_service.app.test_client()
+
+def test_batch_lookup_keeps_request_order_and_reports_missing_ids(client, make_user):
+    alice, bob = make_user(), make_user()
+
+    body = client.post("/users/batch", json={"ids": [bob, 2147483647, alice, bob]}).get_json()
+    assert [user["id"] for user in body["users"]] == [bob, alice]
+    assert body["not_found"] == [2147483647]
+
+    body = client.get(f"/users?ids={alice},{bob}").get_json()
+    assert [user["id"] for user in body["users"]] == [alice, bob]
+
+    assert client.post("/users/batch", json={"ids": []}).status_code == 400
+    assert client.post("/users/batch", json={"ids": ["x"]}).status_code == 400
+
+def test_directory_filters_active_users_and_pages_by_username(client, make_user):
+    family = f"Apellido{uuid.uuid4().hex[:8]}"
+    members = sorted([make_user("Ana", family), make_user("Beto", family), make_user("Caro", family)])
+    make_user("Dani", family, is_active=False)
+
+    seen = []
+    cursor = None
+    while True:
+        url = f"/users?q={family.lower()}&limit=2" + (f"&cursor={cursor}" if cursor else "")
+        page = client.get(url).get_json()
+        seen += [(user["username"], user["id"]) for user in page["users"]]
+        cursor = page["next_cursor"]
+        if not page["has_more"]:
+            break
+    assert seen == sorted(seen)
+    assert sorted(user_id for _, user_id in seen) == members
+
+    # Los comodines de LIKE en la búsqueda se toman literalmente
+    assert client.get(f"/users?q={family[:4]}%25{family[-4:]}").get_json()["users"] == []
+    assert client.get("/users?cursor=roto").status_code == 400
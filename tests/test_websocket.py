@@ -0,0 +1,162 @@
+import pytest
+from fastapi.testclient import TestClient
+
+@pytest.fixture
+def ws_client(websocket_service):
+    with TestClient(websocket_service.app) as client:
+        yield client
+
+def assert_idle(socket):
+    # Lo siguiente en la cola es la respuesta al ping: no llegó ningún otro frame antes
+    socket.send_json({"type": "ping"})
+    assert socket.receive_json() == {"type": "pong"}
+
+def test_chat_frames_reach_only_chat_members(ws_client, make_user, make_chat):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    chat_id = make_chat([alice, bob])
+    make_chat([carol])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}") as sender, \
+            ws_client.websocket_connect(f"/ws?user_id={bob}") as member, \
+            ws_client.websocket_connect(f"/ws?user_id={carol}") as outsider:
+        sender.send_json({"chat_id": chat_id, "content": "hola"})
+
+        assert sender.receive_json() == {"seq": 1, "chat_id": chat_id, "content": "hola"}
+        assert member.receive_json() == {"seq": 1, "chat_id": chat_id, "content": "hola"}
+        assert_idle(outsider)
+
+def test_subscribe_ignores_chats_of_other_users(ws_client, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    own_chat = make_chat([alice])
+    foreign_chat = make_chat([bob])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}&chat_ids={own_chat}") as socket:
+        socket.send_json({"type": "subscribe", "chat_ids": [own_chat, foreign_chat]})
+        reply = socket.receive_json()
+        assert reply["type"] == "subscribed"
+        assert reply["chat_ids"] == [own_chat]
+        assert list(reply["cursors"]) == [own_chat]
+
+def test_sending_to_a_foreign_chat_is_forbidden(ws_client, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    foreign_chat = make_chat([bob])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}") as sender, \
+            ws_client.websocket_connect(f"/ws?user_id={bob}") as member:
+        sender.send_json({"chat_id": foreign_chat, "content": "intruso"})
+        assert sender.receive_json() == {"type": "error", "error": "forbidden", "chat_id": foreign_chat}
+        assert_idle(member)
+
+def test_chat_ids_limits_the_initial_subscription(ws_client, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    first_chat = make_chat([alice, bob])
+    second_chat = make_chat([alice, bob])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}&chat_ids={first_chat}") as listener, \
+            ws_client.websocket_connect(f"/ws?user_id={bob}") as sender:
+        sender.send_json({"chat_id": second_chat, "content": "fuera"})
+        assert sender.receive_json()["chat_id"] == second_chat
+        assert_idle(listener)
+
+        sender.send_json({"chat_id": first_chat, "content": "dentro"})
+        assert sender.receive_json()["chat_id"] == first_chat
+        assert listener.receive_json()["content"] == "dentro"
+
+def test_frames_cross_between_json_and_msgpack_clients(ws_client, make_user, make_chat):
+    msgpack = pytest.importorskip("msgpack")
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice, bob])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}&encoding=msgpack") as binary, \
+            ws_client.websocket_connect(f"/ws?user_id={bob}") as text:
+        binary.send_bytes(msgpack.packb({"chat_id": chat_id, "content": "desde msgpack"}))
+        assert msgpack.unpackb(binary.receive_bytes()) == {"seq": 1, "chat_id": chat_id,
+                                                           "content": "desde msgpack"}
+        assert text.receive_json() == {"seq": 1, "chat_id": chat_id, "content": "desde msgpack"}
+
+        text.send_json({"chat_id": chat_id, "content": "desde json"})
+        assert text.receive_json()["seq"] == 2
+        assert msgpack.unpackb(binary.receive_bytes()) == {"seq": 2, "chat_id": chat_id,
+                                                           "content": "desde json"}
+
+def test_msgpack_binary_fields_are_rejected(ws_client, make_user, make_chat):
+    msgpack = pytest.importorskip("msgpack")
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice, bob])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}&encoding=msgpack") as sender, \
+            ws_client.websocket_connect(f"/ws?user_id={bob}") as member:
+        sender.send_bytes(msgpack.packb({"chat_id": chat_id, "content": b"\x00\xff"}, use_bin_type=True))
+        assert msgpack.unpackb(sender.receive_bytes()) == {"type": "error", "error": "invalid_frame",
+                                                           "chat_id": chat_id}
+        assert_idle(member)
+
+        # El rechazo no corta la conexión ni el reparto de los frames siguientes
+        sender.send_bytes(msgpack.packb({"chat_id": chat_id, "content": "texto"}))
+        assert msgpack.unpackb(sender.receive_bytes())["content"] == "texto"
+        assert member.receive_json()["content"] == "texto"
+
+@pytest.mark.parametrize("frame", [
+    '{"chat_id": "%s", "type": "resync_required", "seq": 0}',
+    '{"chat_id": "%s", "content": NaN}',
+])
+def test_control_types_and_non_portable_values_are_rejected(ws_client, make_user, make_chat, frame):
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice, bob])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}") as sender, \
+            ws_client.websocket_connect(f"/ws?user_id={bob}") as member:
+        sender.send_text(frame % chat_id)
+        assert sender.receive_json() == {"type": "error", "error": "invalid_frame", "chat_id": chat_id}
+        assert_idle(member)
+
+def test_server_assigns_seq_over_the_client_value(ws_client, make_user, make_chat):
+    alice = make_user()
+    chat_id = make_chat([alice])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}") as socket:
+        socket.send_json({"chat_id": chat_id, "seq": 99, "content": "hola"})
+        assert socket.receive_json() == {"seq": 1, "chat_id": chat_id, "content": "hola"}
+
+def test_resume_replays_missed_frames(ws_client, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    chat_id = make_chat([alice, bob])
+
+    with ws_client.websocket_connect(f"/ws?user_id={bob}") as sender:
+        with ws_client.websocket_connect(f"/ws?user_id={alice}") as reader:
+            reader.send_json({"type": "subscribe", "chat_ids": [chat_id]})
+            epoch = reader.receive_json()["cursors"][chat_id]["epoch"]
+            sender.send_json({"chat_id": chat_id, "content": "visto"})
+            assert reader.receive_json()["seq"] == 1
+
+        for content in ("perdido 1", "perdido 2"):
+            sender.send_json({"chat_id": chat_id, "content": content})
+            sender.receive_json()
+
+        with ws_client.websocket_connect(f"/ws?user_id={alice}") as reader:
+            reader.send_json({"type": "resume", "chats": {chat_id: {"epoch": epoch, "seq": 1}}})
+            assert [reader.receive_json()["content"] for _ in range(2)] == ["perdido 1", "perdido 2"]
+            assert reader.receive_json() == {"type": "resumed", "chat_id": chat_id, "replayed": 2,
+                                             "epoch": epoch, "seq": 3}
+
+def test_resume_with_unknown_epoch_requires_resync(ws_client, make_user, make_chat):
+    alice = make_user()
+    chat_id = make_chat([alice])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}") as socket:
+        socket.send_json({"chat_id": chat_id, "content": "hola"})
+        socket.receive_json()
+        socket.send_json({"type": "resume", "chats": {chat_id: {"epoch": "otro-nodo-1", "seq": 1}}})
+        reply = socket.receive_json()
+        assert reply["type"] == "resync_required"
+        assert reply["chat_id"] == chat_id
+        assert reply["seq"] == 1
+
+def test_resume_of_a_foreign_chat_is_forbidden(ws_client, make_user, make_chat):
+    alice, bob = make_user(), make_user()
+    foreign_chat = make_chat([bob])
+
+    with ws_client.websocket_connect(f"/ws?user_id={alice}") as socket:
+        socket.send_json({"type": "resume", "chats": {foreign_chat: {"seq": 0}}})
+        assert socket.receive_json() == {"type": "error", "error": "forbidden", "chat_id": foreign_chat}
+        assert_idle(socket)